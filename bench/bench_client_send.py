@@ -0,0 +1,162 @@
+# bench_client_send.py
+# Client send throughput against a running server: one client pushes N
+# public messages as fast as it can, and the clock stops when the server
+# has echoed the last one back to it.
+#
+#   cd server && python3 server.py --engine asyncio &
+#   python3 bench/bench_client_send.py --messages 20000
+#
+# "blocking" sends the way the interactive client used to: one sendall()
+# (one TLS record, one syscall) per message on a blocking socket.
+# "pipelined" uses the asyncio ChatClient from client/api.py, which queues
+# messages and writes whatever piled up as one buffer, waiting only when
+# its queue is over the high-water mark or the server sent FLOW.
+import argparse
+import asyncio
+import json
+import os
+import socket
+import ssl
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'client'))
+
+from api import ChatClient
+from framing import FrameBuffer, recv_message, send_message
+
+TAG = 'bcs:'
+
+
+def make_context(args):
+    context = ssl.create_default_context(cafile=args.cert)
+    context.check_hostname = False
+    return context
+
+
+def echo_of(event, tag):
+    content = event.get('content')
+    return event.get('action') in ('MESSAGE', 'TEMPORARY') and isinstance(content, str) and content.startswith(tag)
+
+
+def run_blocking(args, tag):
+    sock = make_context(args).wrap_socket(socket.create_connection((args.host, args.port)),
+                                          server_hostname=args.host)
+    buffer = FrameBuffer()
+    recv_message(sock, buffer)     # LOGIN prompt
+    send_message(sock, {"username": "bench_blocking", "user_id": None, "token": None})
+    user_id = recv_message(sock, buffer)["user_id"]
+
+    echoes = 0
+    done = threading.Event()
+
+    def receive():
+        nonlocal echoes
+        while True:
+            event = recv_message(sock, buffer)
+            if event is None:
+                break
+            if echo_of(event, tag):
+                echoes += 1
+                if echoes == args.messages:
+                    done.set()
+        done.set()
+
+    threading.Thread(target=receive, daemon=True).start()
+    cpu = time.process_time()
+    start = time.perf_counter()
+    for i in range(args.messages):
+        send_message(sock, {"action": 'MESSAGE', "sender": user_id, "receiver": ["all"],
+                            "content": f"{tag}{i} {args.padding}", "time": "", "private": False,
+                            "optional": None})
+    sent = time.perf_counter() - start
+    done.wait(args.timeout)
+    total = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    send_message(sock, {"action": "EXIT"})
+    sock.close()
+    return {'mode': 'blocking', 'writes': args.messages, 'echoes': echoes}, sent, total, cpu
+
+
+async def run_pipelined(args, tag):
+    chat = await ChatClient.connect("bench_pipelined", host=args.host, port=args.port,
+                                    context=make_context(args), high_water=args.high_water)
+    echoes = 0
+    done = asyncio.Event()
+
+    async def receive():
+        nonlocal echoes
+        async for event in chat.events():
+            if echo_of(event, tag):
+                echoes += 1
+                if echoes == args.messages:
+                    break
+        done.set()
+
+    receiver = asyncio.create_task(receive())
+    cpu = time.process_time()
+    start = time.perf_counter()
+    for i in range(args.messages):
+        await chat.send(f"{tag}{i} {args.padding}")
+    await chat.flush()
+    sent = time.perf_counter() - start
+    try:
+        await asyncio.wait_for(done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    total = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    receiver.cancel()
+    writes = chat.writes
+    await chat.close()
+    return {'mode': 'pipelined', 'writes': writes, 'echoes': echoes,
+            'dropped_events': chat.dropped_events}, sent, total, cpu
+
+
+def result(args, row, sent, total, cpu):
+    row.update({
+        'messages': args.messages,
+        'send_seconds': round(sent, 3),
+        'total_seconds': round(total, 3),
+        'msgs_per_second': round(row['echoes'] / total, 1),
+        'frames_per_write': round(args.messages / max(row['writes'], 1), 1),
+        # Client CPU (sending and reading the echoes) per message.
+        'client_cpu_us_per_msg': round(cpu / max(args.messages, 1) * 1e6, 1),
+    })
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Client send throughput: per-message writes vs pipelined batches")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=65432)
+    parser.add_argument('--cert', default=os.path.join(HERE, '..', 'client', 'cert.pem'))
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--size', type=int, default=64, help="extra content bytes per message")
+    parser.add_argument('--high-water', type=int, default=256 * 1024, help="pipelined client queue, in bytes")
+    parser.add_argument('--mode', choices=('blocking', 'pipelined', 'both'), default='both')
+    parser.add_argument('--timeout', type=float, default=60, help="seconds to wait for the last echo")
+    parser.add_argument('--json', action='store_true', help="print machine-readable results")
+    args = parser.parse_args()
+    args.padding = 'x' * args.size
+
+    results = []
+    # Each run tags its messages so a slow echo from the previous one isn't counted.
+    if args.mode in ('blocking', 'both'):
+        results.append(result(args, *run_blocking(args, f"{TAG}b{os.getpid()}:")))
+    if args.mode in ('pipelined', 'both'):
+        results.append(result(args, *asyncio.run(run_pipelined(args, f"{TAG}p{os.getpid()}:"))))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'mode':>10} {'messages':>9} {'echoed':>7} {'send s':>7} {'total s':>8} {'msg/s':>9} {'frames/write':>13} {'cpu us/msg':>11}")
+    for r in results:
+        print(f"{r['mode']:>10} {r['messages']:>9} {r['echoes']:>7} {r['send_seconds']:>7} "
+              f"{r['total_seconds']:>8} {r['msgs_per_second']:>9} {r['frames_per_write']:>13} {r['client_cpu_us_per_msg']:>11}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+# bench_compression.py
+# Bytes on the wire versus CPU for compressed connections: a crowd of
+# listeners receives messages from one sender, once over plain connections
+# and once over zlib-compressed ones, either as broadcasts to "all" (whose
+# receiver list names every user online) or as messages to a room they
+# all joined.
+#
+#   python3 bench/bench_compression.py --spawn "--engine asyncio" --listeners 200 --messages 2000
+#   python3 bench/bench_compression.py --spawn "--engine asyncio --compress-level 6" --target room --json
+#
+# Bytes are counted below TLS, as the clients read them. Server CPU needs
+# --spawn or --server-pid; client CPU covers every client in this process
+# (decompressing and decoding what they receive).
+import argparse
+import asyncio
+import json
+import os
+import random
+import shlex
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'client'))
+
+from api import ChatClient
+from loadgen import ServerMonitor, make_context, wait_for_server
+
+ROOM = 'benchz'
+VOCABULARY = 5000
+
+
+async def run(args, compression, monitor):
+    context = make_context(args)
+    mode = compression or 'none'
+    tag = f"bz:{mode}:{os.getpid()}:"
+    listeners = [await ChatClient.connect(f"bz_{mode}_{i}", host=args.host, port=args.port, context=context,
+                                          compression=compression) for i in range(args.listeners)]
+    sender = await ChatClient.connect(f"bz_{mode}_sender", host=args.host, port=args.port, context=context,
+                                      compression=compression)
+    room = None
+    if args.target == 'room':
+        room = f"{ROOM}{mode}{os.getpid()}"
+        for client in listeners + [sender]:
+            await client.join(room)
+            await client.flush()
+        await asyncio.sleep(0.5)
+    received = [0] * len(listeners)
+    done = asyncio.Event()
+    remaining = len(listeners)
+
+    async def listen(i, client):
+        nonlocal remaining
+        async for event in client.events():
+            content = event.get('content')
+            if event.get('action') == 'MESSAGE' and isinstance(content, str) and content.startswith(tag):
+                received[i] += 1
+                if received[i] == args.messages:
+                    remaining -= 1
+                    if not remaining:
+                        done.set()
+                    return
+
+    tasks = [asyncio.create_task(listen(i, client)) for i, client in enumerate(listeners)]
+    read_before = sum(client.bytes_read for client in listeners)
+    if monitor is not None:
+        monitor.start()
+    cpu = time.process_time()
+    start = time.perf_counter()
+    # Words drawn at random from a fixed vocabulary, not the same text
+    # every time, which would compress unrealistically well.
+    rng = random.Random(1)
+    words = [''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(2, 9))) for _ in range(VOCABULARY)]
+    for i in range(args.messages):
+        text = ' '.join(rng.choices(words, k=rng.randint(3, 20)))
+        await sender.send(f"{tag}{i} {text} {'x' * args.size}", room=room)
+    await sender.flush()
+    try:
+        await asyncio.wait_for(done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    seconds = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    server_cpu = monitor.cpu_seconds() if monitor is not None else None
+    wire = sum(client.bytes_read for client in listeners) - read_before
+    for task in tasks:
+        task.cancel()
+    for client in listeners + [sender]:
+        await client.close()
+
+    delivered = sum(received)
+    return {
+        'compression': mode,
+        'target': args.target,
+        'listeners': args.listeners,
+        'messages': args.messages,
+        'delivered': delivered,
+        'seconds': round(seconds, 2),
+        'deliveries_per_second': round(delivered / seconds, 1),
+        'wire_bytes_per_delivery': round(wire / max(delivered, 1), 1),
+        'client_cpu_us_per_delivery': round(cpu / max(delivered, 1) * 1e6, 2),
+        'server_cpu_us_per_delivery': (round(server_cpu / max(delivered, 1) * 1e6, 2)
+                                       if server_cpu is not None else None),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Wire bytes and CPU per delivered message, plain vs compressed")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=65432)
+    parser.add_argument('--cert', default=os.path.join(HERE, '..', 'client', 'cert.pem'))
+    parser.add_argument('--insecure', action='store_true', help="don't verify the server certificate")
+    parser.add_argument('--listeners', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=0, help="extra content bytes per message")
+    parser.add_argument('--target', choices=('all', 'room'), default='all')
+    parser.add_argument('--timeout', type=float, default=120, help="seconds to wait for the last delivery")
+    parser.add_argument('--spawn', default=None, metavar='ARGS',
+                        help="start server.py with these arguments (and stop it afterwards)")
+    parser.add_argument('--server-cwd', default=os.path.join(HERE, '..', 'server'),
+                        help="directory to run the spawned server in (needs cert.pem/key.pem)")
+    parser.add_argument('--server-pid', type=int, default=None, help="PID of an already running server, for its CPU")
+    parser.add_argument('--json', action='store_true', help="print machine-readable results")
+    args = parser.parse_args()
+
+    server = None
+    if args.spawn is not None:
+        server = subprocess.Popen([sys.executable, 'server.py'] + shlex.split(args.spawn),
+                                  cwd=args.server_cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        args.server_pid = server.pid
+    monitor = ServerMonitor(args.server_pid) if args.server_pid is not None else None
+    try:
+        asyncio.run(wait_for_server(args))
+        results = [asyncio.run(run(args, compression, monitor)) for compression in (None, 'zlib')]
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'compression':>11} {'delivered':>10} {'deliv/s':>9} {'wire B/deliv':>13} "
+          f"{'client us':>10} {'server us':>10}")
+    for r in results:
+        server_cpu = r['server_cpu_us_per_delivery']
+        print(f"{r['compression']:>11} {r['delivered']:>10} {r['deliveries_per_second']:>9} "
+              f"{r['wire_bytes_per_delivery']:>13} {r['client_cpu_us_per_delivery']:>10} "
+              f"{'-' if server_cpu is None else server_cpu:>10}")
+    plain, packed = results
+    if packed['wire_bytes_per_delivery']:
+        print(f"\n{plain['wire_bytes_per_delivery'] / packed['wire_bytes_per_delivery']:.1f}x fewer bytes "
+              f"per delivery with zlib")
+
+
+if __name__ == '__main__':
+    main()
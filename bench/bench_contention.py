@@ -0,0 +1,123 @@
+# bench_contention.py
+# Before/after comparison of server state locking.
+#
+#   python3 bench/bench_contention.py --threads 1 2 4 8
+#
+# "global"  - every operation runs under one lock, like the old server.py
+# "sharded" - MessageStore's per-shard and per-mailbox locks only
+#
+# Each worker thread stores messages between random users, then deletes
+# (mutates) some of them and reads mailboxes back. Reports throughput and
+# the average time spent waiting to acquire a lock. On a GIL build threads
+# never run Python code in parallel, so expect similar throughput but much
+# lower lock wait for "sharded"; on a free-threaded build (python3.13t)
+# the sharded store also scales with cores.
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from ids import SnowflakeGenerator
+from store import MessageRecord, MessageStore
+
+USERS = [f"user{i}_{1000 + i}" for i in range(1000)]
+
+
+class TimedLock:
+    """Wraps a lock and accumulates how long acquirers waited for it."""
+
+    def __init__(self, lock):
+        self._lock = lock
+        self.wait = 0.0
+        self.acquisitions = 0
+        self._stats_lock = threading.Lock()
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self._lock.acquire()
+        waited = time.perf_counter() - start
+        with self._stats_lock:
+            self.wait += waited
+            self.acquisitions += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+def worker(mode, store, global_lock, shard_locks, ids, ops, seed):
+    rng = random.Random(seed)
+    mine = []
+    for i in range(ops):
+        sender, receiver = rng.sample(USERS, 2)
+        record = MessageRecord(id=str(ids.next_id()), action='MESSAGE', sender=sender,
+                               receiver=(receiver,), content=f"hello {i}", time=None)
+        if mode == 'global':
+            with global_lock:
+                store.add(record)
+        else:
+            with shard_locks[hash(record.id) % len(shard_locks)]:
+                store.add(record)
+        mine.append(record.id)
+
+        if i % 4 == 0:
+            message_id = rng.choice(mine)
+            lock = global_lock if mode == 'global' else shard_locks[hash(message_id) % len(shard_locks)]
+            with lock:
+                store.get(message_id).content = 'THIS MESSAGE IS REMOVED'
+        if i % 8 == 0:
+            if mode == 'global':
+                with global_lock:
+                    store.received_by(receiver)
+            else:
+                store.received_by(receiver)
+
+
+def run(mode, threads, ops):
+    store = MessageStore(shards=1 if mode == 'global' else 16)
+    global_lock = TimedLock(threading.Lock())
+    # The sharded store's own locks, wrapped so their wait time is visible.
+    shard_locks = [TimedLock(shard.lock) for shard in store._shards]
+    ids = SnowflakeGenerator()
+    workers = [threading.Thread(target=worker, args=(mode, store, global_lock, shard_locks, ids, ops, n))
+               for n in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    locks = [global_lock] if mode == 'global' else shard_locks
+    wait = sum(lock.wait for lock in locks)
+    acquisitions = sum(lock.acquisitions for lock in locks)
+    return {
+        'mode': mode,
+        'threads': threads,
+        'ops_per_sec': round(threads * ops / elapsed),
+        'avg_lock_wait_us': round(wait / max(acquisitions, 1) * 1e6, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Global lock vs sharded store contention")
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--ops', type=int, default=50_000, help="messages stored per thread")
+    parser.add_argument('--json', action='store_true', help="print machine-readable results")
+    args = parser.parse_args()
+
+    results = [run(mode, threads, args.ops) for threads in args.threads for mode in ('global', 'sharded')]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'mode':>8} {'threads':>8} {'ops/sec':>10} {'lock wait us':>13}")
+    for r in results:
+        print(f"{r['mode']:>8} {r['threads']:>8} {r['ops_per_sec']:>10} {r['avg_lock_wait_us']:>13}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+# bench_handshake.py
+# TLS handshake throughput and accept latency: many clients connect at
+# once, and each one times its TCP connect, its TLS handshake and the
+# arrival of the server's LOGIN prompt ("accept" latency, from connect()
+# to the server's first frame).
+#
+#   python3 bench/bench_handshake.py --spawn "--engine threaded" --connections 2000 --concurrency 100
+#   python3 bench/bench_handshake.py --spawn "--engine asyncio" --stallers 20 --probes 200 --json
+#
+# "full" connections do a full handshake, "resume" ones present the TLS
+# session of their thread's previous connection. --stallers opens raw TCP
+# connections that never send a byte, --probes sends plain-text requests
+# to the TLS port while the benchmark runs: neither may slow down anybody
+# else. Server CPU needs --spawn or --server-pid.
+import argparse
+import concurrent.futures
+import json
+import os
+import shlex
+import socket
+import ssl
+import subprocess
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'client'))
+
+from framing import FrameBuffer, recv_message
+from loadgen import ServerMonitor, percentile
+
+PROBE = b"GET / HTTP/1.0\r\n\r\n"
+
+
+def connect_once(args, context, session):
+    """Returns (connect, handshake, accept seconds, resumed?, TLS session)."""
+    start = time.perf_counter()
+    raw = socket.create_connection((args.host, args.port), timeout=args.timeout)
+    connected = time.perf_counter()
+    with context.wrap_socket(raw, server_hostname=args.host, session=session) as sock:
+        shaken = time.perf_counter()
+        prompt = recv_message(sock, FrameBuffer())
+        prompted = time.perf_counter()
+        if not prompt or prompt.get('action') != 'LOGIN':
+            raise RuntimeError(f"expected a LOGIN prompt, got {prompt}")
+        return connected - start, shaken - connected, prompted - start, sock.session_reused, sock.session
+
+
+def run(args, context, resume, monitor):
+    results = []
+    errors = 0
+    local = threading.local()
+
+    def one(_):
+        nonlocal errors
+        try:
+            result = connect_once(args, context, getattr(local, 'session', None) if resume else None)
+        except (OSError, ValueError, RuntimeError):
+            errors += 1
+            return
+        local.session = result[4]
+        results.append(result[:4])
+
+    if resume:
+        # Every thread starts with a session to resume.
+        with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+            list(pool.map(one, range(args.concurrency)))
+        results.clear()
+        errors = 0
+    if monitor is not None:
+        monitor.start()
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(one, range(args.connections)))
+    seconds = time.perf_counter() - start
+    server_cpu = monitor.cpu_seconds() if monitor is not None else None
+
+    def ms(column, fraction):
+        values = sorted(r[column] for r in results)
+        return round(percentile(values, fraction) * 1e3, 2) if values else None
+
+    return {
+        'mode': 'resume' if resume else 'full',
+        'connections': args.connections,
+        'completed': len(results),
+        'errors': errors,
+        'resumed': sum(1 for r in results if r[3]),
+        'seconds': round(seconds, 2),
+        'handshakes_per_second': round(len(results) / seconds, 1),
+        'connect_ms_p50': ms(0, 0.5),
+        'handshake_ms_p50': ms(1, 0.5),
+        'handshake_ms_p99': ms(1, 0.99),
+        'accept_ms_p50': ms(2, 0.5),
+        'accept_ms_p99': ms(2, 0.99),
+        'accept_ms_p999': ms(2, 0.999),
+        'server_cpu_us_per_handshake': (round(server_cpu / max(len(results), 1) * 1e6, 1)
+                                        if server_cpu is not None else None),
+    }
+
+
+def open_stallers(args):
+    # Connected, and then silent: the server waits for a ClientHello that never comes.
+    return [socket.create_connection((args.host, args.port)) for _ in range(args.stallers)]
+
+
+def send_probes(args, stop):
+    """Thread body: plain-text requests to the TLS port until `stop` is set."""
+    sent = 0
+    while sent < args.probes and not stop.is_set():
+        try:
+            with socket.create_connection((args.host, args.port), timeout=args.timeout) as sock:
+                sock.sendall(PROBE)
+                while sock.recv(4096):
+                    pass
+        except OSError:
+            pass
+        sent += 1
+        stop.wait(args.probe_interval)
+
+
+def wait_for_server(args, context, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connect_once(args, context, None)
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    raise TimeoutError(f"server did not come up on {args.host}:{args.port}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TLS handshakes per second and accept latency")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=65432)
+    parser.add_argument('--cert', default=os.path.join(HERE, '..', 'client', 'cert.pem'))
+    parser.add_argument('--insecure', action='store_true', help="don't verify the server certificate")
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=50, help="connections in flight at once")
+    parser.add_argument('--mode', choices=('full', 'resume', 'both'), default='both')
+    parser.add_argument('--stallers', type=int, default=0, help="idle TCP connections held open during the run")
+    parser.add_argument('--probes', type=int, default=0, help="plain-text requests sent during the run")
+    parser.add_argument('--probe-interval', type=float, default=0.01)
+    parser.add_argument('--timeout', type=float, default=30, help="seconds per connection before it counts as an error")
+    parser.add_argument('--spawn', default=None, metavar='ARGS',
+                        help="start server.py with these arguments (and stop it afterwards)")
+    parser.add_argument('--server-cwd', default=os.path.join(HERE, '..', 'server'),
+                        help="directory to run the spawned server in (needs cert.pem/key.pem)")
+    parser.add_argument('--server-pid', type=int, default=None, help="PID of an already running server, for its CPU")
+    parser.add_argument('--json', action='store_true', help="print machine-readable results")
+    args = parser.parse_args()
+
+    context = ssl.create_default_context(cafile=None if args.insecure else args.cert)
+    context.check_hostname = False
+    if args.insecure:
+        context.verify_mode = ssl.CERT_NONE
+
+    server = None
+    if args.spawn is not None:
+        server = subprocess.Popen([sys.executable, 'server.py'] + shlex.split(args.spawn),
+                                  cwd=args.server_cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        args.server_pid = server.pid
+    monitor = ServerMonitor(args.server_pid) if args.server_pid is not None else None
+    stop = threading.Event()
+    stallers = []
+    try:
+        wait_for_server(args, context)
+        stallers = open_stallers(args)
+        prober = threading.Thread(target=send_probes, args=(args, stop), daemon=True)
+        prober.start()
+        modes = {'full': [False], 'resume': [True], 'both': [False, True]}[args.mode]
+        results = [run(args, context, resume, monitor) for resume in modes]
+    finally:
+        stop.set()
+        for sock in stallers:
+            sock.close()
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    columns = ('mode', 'completed', 'errors', 'handshakes_per_second', 'handshake_ms_p50', 'handshake_ms_p99',
+               'accept_ms_p50', 'accept_ms_p99', 'accept_ms_p999', 'server_cpu_us_per_handshake')
+    print(f"{'mode':>7} {'done':>6} {'errors':>6} {'hs/s':>8} {'hs p50':>8} {'hs p99':>8} "
+          f"{'accept p50':>11} {'p99':>8} {'p99.9':>8} {'server us':>10}")
+    widths = (7, 6, 6, 8, 8, 8, 11, 8, 8, 10)
+    for r in results:
+        print(' '.join(f"{'-' if r[column] is None else r[column]:>{width}}"
+                       for column, width in zip(columns, widths)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# bench_msglog.py
+# Append throughput, compaction and recovery time of the durable message log.
+#
+#   python3 bench/bench_msglog.py --messages 200000 --threads 4
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from msglog import MessageLog, apply_entry
+
+
+def entry(i):
+    return {
+        'op': 'add', 'id': str(100000 + i), 'action': 'MESSAGE',
+        'sender': f"user{i % 100}_1000", 'receiver': [f"user{(i + 1) % 100}_1000"],
+        'content': f"message number {i} " + 'x' * 60, 'time': "2025-04-20 10:54:03",
+        'private': False, 'optional': None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MessageLog append/compaction/recovery benchmark")
+    parser.add_argument('--messages', type=int, default=200_000)
+    parser.add_argument('--threads', type=int, default=4, help="concurrent appenders")
+    parser.add_argument('--segment-mb', type=int, default=16)
+    parser.add_argument('--delete-ratio', type=float, default=0.3,
+                        help="fraction of messages deleted afterwards (what compaction reclaims)")
+    parser.add_argument('--dir', default=None, help="log directory (default: a temp dir)")
+    parser.add_argument('--json', action='store_true', help="print machine-readable results")
+    args = parser.parse_args()
+
+    data_dir = args.dir or tempfile.mkdtemp(prefix='msglog-bench-')
+    try:
+        log = MessageLog(data_dir, segment_bytes=args.segment_mb * 1024 * 1024)
+        log.recover(lambda entry: None)
+        log.start()
+
+        per_thread = args.messages // args.threads
+
+        def appender(offset):
+            last = 0
+            for i in range(offset, offset + per_thread):
+                last = log.append(entry(i))
+            log.wait_durable(last)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=appender, args=(t * per_thread,)) for t in range(args.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        append_seconds = time.perf_counter() - start
+        appended = per_thread * args.threads
+
+        step = max(int(1 / args.delete_ratio), 1) if args.delete_ratio > 0 else 0
+        if step:
+            for i in range(0, appended, step):
+                log.append({'op': 'update', 'id': str(100000 + i),
+                            'fields': {'content': 'THIS MESSAGE IS REMOVED'}})
+        stats = log.stats()
+        log.close()
+        size_before = sum(os.path.getsize(os.path.join(data_dir, f)) for f in os.listdir(data_dir))
+
+        log = MessageLog(data_dir, segment_bytes=args.segment_mb * 1024 * 1024)
+        start = time.perf_counter()
+        users, records = {}, {}
+        log.recover(lambda entry: apply_entry(entry, users, records))
+        recover_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        dropped = log.compact(force=True)
+        compact_seconds = time.perf_counter() - start
+        log.close()
+        size_after = sum(os.path.getsize(os.path.join(data_dir, f)) for f in os.listdir(data_dir))
+
+        results = {
+            'appends': appended,
+            'appends_per_sec': round(appended / append_seconds),
+            'commits': stats['commits'],
+            'entries_per_fsync': round(stats['appended'] / max(stats['commits'], 1), 1),
+            'recovered_messages': len(records),
+            'recover_seconds': round(recover_seconds, 3),
+            'compact_seconds': round(compact_seconds, 3),
+            'entries_dropped': dropped,
+            'bytes_before_compaction': size_before,
+            'bytes_after_compaction': size_after,
+        }
+    finally:
+        if args.dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for key, value in results.items():
+            print(f"{key:>26}: {value}")
+
+
+if __name__ == '__main__':
+    main()
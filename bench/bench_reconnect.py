@@ -0,0 +1,145 @@
+# bench_reconnect.py
+# Reconnect-storm time against a running server: N clients log in, all of
+# their connections drop at once, then they all reconnect at the same time.
+#
+#   cd server && python3 server.py &
+#   python3 bench/bench_reconnect.py --clients 500 --concurrency 100
+#
+# "full" reconnects the way clients used to: a full TLS handshake and a
+# fresh login that gets a new user ID. "resume" reuses each client's TLS
+# session and resume token, so the handshake is abbreviated and the server
+# hands the old user ID back. Failed attempts retry with the client's
+# jittered backoff.
+import argparse
+import concurrent.futures
+import json
+import os
+import socket
+import ssl
+import statistics
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'client'))
+
+from client import backoff_delay
+from framing import FrameBuffer, recv_message, send_message
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else None
+
+
+class Session:
+    __slots__ = ('name', 'user_id', 'token', 'tls_session', 'sock')
+
+    def __init__(self, name):
+        self.name = name
+        self.user_id = self.token = self.tls_session = self.sock = None
+
+
+def connect_and_login(args, context, session, resume):
+    """Returns (handshake seconds, login seconds, resumed?, retries)."""
+    retries = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            raw = socket.create_connection((args.host, args.port), timeout=args.timeout)
+            sock = context.wrap_socket(raw, server_hostname=args.host,
+                                       session=session.tls_session if resume else None)
+            handshake = time.perf_counter() - start
+            buffer = FrameBuffer()
+            recv_message(sock, buffer)     # LOGIN prompt
+            send_message(sock, {"username": session.name,
+                                "user_id": session.user_id if resume else None,
+                                "token": session.token if resume else None})
+            response = recv_message(sock, buffer) or {}
+        except (OSError, ValueError):
+            retries += 1
+            if retries > args.max_retries:
+                raise
+            time.sleep(backoff_delay(retries - 1, base=args.backoff_base))
+            continue
+        login = time.perf_counter() - start - handshake
+        if response.get("status") != "SUCCESS":
+            raise RuntimeError(f"login failed: {response}")
+        resumed = resume and sock.session_reused and response.get("user_id") == session.user_id
+        session.user_id = response["user_id"]
+        session.token = response.get("token")
+        session.tls_session = sock.session
+        session.sock = sock
+        return handshake, login, resumed, retries
+
+
+def drop_all(sessions):
+    for session in sessions:
+        try:
+            session.sock.close()
+        except OSError:
+            pass
+        session.sock = None
+
+
+def storm(args, context, sessions, resume):
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(lambda s: connect_and_login(args, context, s, resume), sessions))
+    total = time.perf_counter() - start
+    handshakes = [r[0] * 1e3 for r in results]
+    logins = [r[1] * 1e3 for r in results]
+    return {
+        'mode': 'resume' if resume else 'full',
+        'clients': len(sessions),
+        'storm_seconds': round(total, 3),
+        'reconnects_per_second': round(len(sessions) / total, 1),
+        'handshake_ms_p50': round(statistics.median(handshakes), 2),
+        'handshake_ms_p99': round(percentile(handshakes, 0.99), 2),
+        'login_ms_p50': round(statistics.median(logins), 2),
+        'resumed': sum(1 for r in results if r[2]),
+        'retries': sum(r[3] for r in results),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconnect storm: full handshakes vs resumed sessions")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=65432)
+    parser.add_argument('--cert', default=os.path.join(HERE, '..', 'client', 'cert.pem'))
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50, help="reconnects in flight at once")
+    parser.add_argument('--mode', choices=('full', 'resume', 'both'), default='both')
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--max-retries', type=int, default=8)
+    parser.add_argument('--backoff-base', type=float, default=0.05)
+    parser.add_argument('--json', action='store_true', help="print machine-readable results")
+    args = parser.parse_args()
+
+    context = ssl.create_default_context(cafile=args.cert)
+    context.check_hostname = False
+
+    sessions = [Session(f"storm{i}") for i in range(args.clients)]
+    # Everybody logs in once to get a session and a token to resume with.
+    storm(args, context, sessions, resume=False)
+    modes = {'full': [False], 'resume': [True], 'both': [False, True]}[args.mode]
+    results = []
+    for resume in modes:
+        drop_all(sessions)
+        time.sleep(0.5)     # let the server notice
+        results.append(storm(args, context, sessions, resume))
+    drop_all(sessions)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'mode':>7} {'clients':>8} {'storm s':>8} {'conn/s':>8} {'hs p50':>8} {'hs p99':>8} "
+          f"{'login p50':>10} {'resumed':>8} {'retries':>8}")
+    for r in results:
+        print(f"{r['mode']:>7} {r['clients']:>8} {r['storm_seconds']:>8} {r['reconnects_per_second']:>8} "
+              f"{r['handshake_ms_p50']:>8} {r['handshake_ms_p99']:>8} {r['login_ms_p50']:>10} "
+              f"{r['resumed']:>8} {r['retries']:>8}")
+
+
+if __name__ == '__main__':
+    main()
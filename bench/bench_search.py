@@ -0,0 +1,105 @@
+# bench_search.py
+# Latency of SEARCH queries against the server's inverted index as history grows.
+#
+#   python3 bench/bench_search.py --sizes 100000 1000000
+#
+# For each history size it indexes a fresh store, then times first-page
+# queries for a rare word, a common word, a two-word AND, a common word
+# with a pattern post-filter and a time-ranged query, all as seen by one user.
+# Next to them it times the old approach (matching every message's text).
+# A page costs about limit / selectivity index probes, so queries with no
+# hits at all are the worst case: they walk the user's whole posting list.
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from ids import SnowflakeGenerator, id_timestamp
+from search import Pattern, SearchIndex
+from store import MessageRecord, MessageStore
+
+USERS = [f"user{i}_{1000 + i}" for i in range(200)]
+WORDS = ["hello", "world", "meeting", "lunch", "deploy", "server", "client", "later", "thanks", "ok"]
+
+
+def fill(store, index, count):
+    ids = SnowflakeGenerator(clock=lambda: 1.8e9)
+    rng = random.Random(42)
+    for i in range(count):
+        text = f"{rng.choice(WORDS)} {rng.choice(WORDS)} message number {i}"
+        if i % 10_000 == 0:
+            text += " rare"
+        record = store.add(MessageRecord(
+            id=str(ids.next_id()),
+            action='MESSAGE',
+            sender=USERS[i % len(USERS)],
+            receiver=(USERS[(i + 1) % len(USERS)], USERS[(i + 7) % len(USERS)]),
+            content=text,
+            time="2025-04-20 10:54:03",
+        ))
+        index.add(record.id, record.content, record.audience())
+    return record.id
+
+
+def time_query(index, store, user_id, repeat, **query):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results, _ = index.search(user_id=user_id, lookup=store.get, **query)
+    return (time.perf_counter() - start) / repeat * 1e3, len(results)
+
+
+def time_scan(store, user_id, pattern):
+    # What a server without the index would have to do.
+    start = time.perf_counter()
+    hits = [r for r in store.sent_by(user_id) + store.received_by(user_id) if pattern.search(r.content)]
+    return (time.perf_counter() - start) * 1e3, len(hits)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search index query latency")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--json', action='store_true', help="print machine-readable results")
+    args = parser.parse_args()
+
+    user = USERS[0]
+    results = []
+    for count in args.sizes:
+        store, index = MessageStore(), SearchIndex()
+        start = time.perf_counter()
+        last_id = fill(store, index, count)
+        index_s = time.perf_counter() - start
+        recent = id_timestamp(last_id) - 1
+        queries = {
+            'rare': dict(query="rare"),
+            'common': dict(query="hello"),
+            'and': dict(query="hello deploy"),
+            'pattern': dict(query="hello", pattern=Pattern("number *9")),
+            'range': dict(query="hello", since=recent),
+        }
+        row = {'messages': count, 'index_s': round(index_s, 2), 'words': len(index)}
+        for name, query in queries.items():
+            ms, hits = time_query(index, store, user, args.repeat, **query)
+            row[f'{name}_ms'] = round(ms, 3)
+            row[f'{name}_hits'] = hits
+        row['scan_ms'], _ = time_scan(store, user, Pattern("hello"))
+        row['scan_ms'] = round(row['scan_ms'], 3)
+        results.append(row)
+        del store, index
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    names = ['rare', 'common', 'and', 'pattern', 'range']
+    print(f"{'messages':>10} {'index s':>8} " + " ".join(f"{n + ' ms':>10}" for n in names) + f" {'scan ms':>10}")
+    for r in results:
+        print(f"{r['messages']:>10} {r['index_s']:>8} " + " ".join(f"{r[n + '_ms']:>10}" for n in names)
+              + f" {r['scan_ms']:>10}")
+
+
+if __name__ == '__main__':
+    main()
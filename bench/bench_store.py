@@ -0,0 +1,90 @@
+# bench_store.py
+# Memory and latency of the server's MessageStore as history grows.
+#
+#   python3 bench/bench_store.py --sizes 10000 100000 1000000
+#
+# For each history size it fills a fresh store, then times DELETE-style and
+# expiry-style lookups of random message ids. Both should stay flat while
+# history grows; memory per message should stay constant too.
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from store import MessageRecord, MessageStore
+
+USERS = [f"user{i}_{1000 + i}" for i in range(200)]
+
+
+def fill(store, count):
+    for i in range(count):
+        sender = USERS[i % len(USERS)]
+        receiver = (USERS[(i + 1) % len(USERS)], USERS[(i + 7) % len(USERS)])
+        store.add(MessageRecord(
+            id=str(100000 + i),
+            action='TEMPORARY' if i % 10 == 0 else 'MESSAGE',
+            sender=sender,
+            receiver=receiver,
+            content=f"message number {i}",
+            time="2025-04-20 10:54:03",
+        ))
+
+
+def time_ops(store, count, samples):
+    ids = [str(100000 + random.randrange(count)) for _ in range(samples)]
+
+    start = time.perf_counter()
+    for message_id in ids:
+        record = store.get(message_id)
+        record.content = 'THIS MESSAGE IS REMOVED'
+        record.audience()
+    delete_ns = (time.perf_counter() - start) / samples * 1e9
+
+    start = time.perf_counter()
+    for message_id in ids:
+        record = store.get(message_id)
+        if record.action == 'TEMPORARY':
+            record.action = 'DELETE'
+        record.audience()
+    expire_ns = (time.perf_counter() - start) / samples * 1e9
+    return delete_ns, expire_ns
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MessageStore memory and lookup latency")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--samples', type=int, default=100_000)
+    parser.add_argument('--json', action='store_true', help="print machine-readable results")
+    args = parser.parse_args()
+
+    results = []
+    for count in args.sizes:
+        tracemalloc.start()
+        store = MessageStore()
+        fill(store, count)
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        delete_ns, expire_ns = time_ops(store, count, args.samples)
+        results.append({
+            'messages': count,
+            'bytes_per_message': round(memory / count, 1),
+            'delete_ns': round(delete_ns, 1),
+            'expire_ns': round(expire_ns, 1),
+        })
+        del store
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'messages':>10} {'bytes/msg':>10} {'delete ns':>10} {'expire ns':>10}")
+    for r in results:
+        print(f"{r['messages']:>10} {r['bytes_per_message']:>10} {r['delete_ns']:>10} {r['expire_ns']:>10}")
+
+
+if __name__ == '__main__':
+    main()
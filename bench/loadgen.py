@@ -0,0 +1,468 @@
+# loadgen.py
+# End-to-end load generator: thousands of simulated clients speaking the
+# real protocol over TLS, driving a server on localhost.
+#
+#   cd server && python3 server.py --engine asyncio &
+#   python3 bench/loadgen.py --clients 1000 --rate 2000 --duration 30
+#
+# or let it start (and stop) the server itself:
+#
+#   python3 bench/loadgen.py --spawn "--engine asyncio" --clients 1000 --json
+#
+# Every client sends at its share of --rate with Poisson arrivals, picking
+# an action from --mix. With --rooms N client i joins room load<i % N>, and
+# the "room" action posts there. Each message carries its send time, so every
+# delivery to every recipient is one latency sample. --churn makes clients
+# drop and resume their session (EXIT + login with their resume token).
+# Server CPU and RSS come from psutil when installed, /proc otherwise.
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import random
+import shlex
+import ssl
+import subprocess
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'client'))
+
+import framing
+from framing import FrameBuffer, decode_message, encode_message
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+DEFAULT_MIX = "public=40,private=30,temporary=10,reply=15,delete=5"
+ACTIONS = ('public', 'private', 'room', 'temporary', 'reply', 'delete')
+STAMP = 'lg:'               # content prefix carrying the send time
+RECENT = 32                 # message ids each client remembers for REPLY/DELETE
+BARRIER_TIMEOUT = 120       # seconds for every process to get its clients logged in
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ACTIONS:
+            raise argparse.ArgumentTypeError(f"unknown action {name!r}, expected one of {', '.join(ACTIONS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else None
+
+
+class Stats:
+
+    def __init__(self, max_samples):
+        self.max_samples = max_samples
+        self.latencies = []     # seconds, reservoir sample of every delivery
+        self.seen = 0
+        self.sent = collections.Counter()
+        self.delivered = 0
+        self.errors = 0
+        self.churned = 0
+
+    def delivery(self, latency):
+        self.delivered += 1
+        self.seen += 1
+        if len(self.latencies) < self.max_samples:
+            self.latencies.append(latency)
+        else:
+            i = random.randrange(self.seen)
+            if i < self.max_samples:
+                self.latencies[i] = latency
+
+
+class ServerMonitor:
+    """CPU seconds and peak RSS of the server process (and its workers)."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak_rss = 0
+        self._cpu_start = None
+
+    def _pids(self):
+        pids = [self.pid]
+        try:
+            with open(f"/proc/{self.pid}/task/{self.pid}/children") as f:
+                pids += [int(p) for p in f.read().split()]
+        except OSError:
+            pass
+        return pids
+
+    def _sample(self):
+        """Returns (cpu seconds, rss bytes) over the server's processes."""
+        if psutil is not None:
+            try:
+                main = psutil.Process(self.pid)
+                procs = [main] + main.children(recursive=True)
+                cpu = sum(sum(p.cpu_times()[:2]) for p in procs)
+                return cpu, sum(p.memory_info().rss for p in procs)
+            except psutil.Error:
+                return None, 0
+        cpu, rss = 0.0, 0
+        ticks = os.sysconf('SC_CLK_TCK')
+        page = os.sysconf('SC_PAGE_SIZE')
+        for pid in self._pids():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                cpu += (int(fields[11]) + int(fields[12])) / ticks
+                with open(f"/proc/{pid}/statm") as f:
+                    rss += int(f.read().split()[1]) * page
+            except (OSError, IndexError, ValueError):
+                if pid == self.pid:
+                    return None, 0
+        return cpu, rss
+
+    def start(self):
+        self._cpu_start, self.peak_rss = self._sample()
+
+    def rss(self):
+        """Current RSS in bytes."""
+        return self._sample()[1]
+
+    def poll(self):
+        _, rss = self._sample()
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def cpu_seconds(self):
+        cpu, _ = self._sample()
+        if cpu is None or self._cpu_start is None:
+            return None
+        return cpu - self._cpu_start
+
+
+class SimClient:
+
+    def __init__(self, name, args, context, stats, roster, room=None):
+        self.name = name
+        self.room = room
+        self.args = args
+        self.context = context
+        self.stats = stats
+        self.roster = roster        # user ids of every logged-in simulated client
+        self.user_id = None
+        self.token = None
+        self.reader = self.writer = None
+        self.buffer = None
+        self.recent = collections.deque(maxlen=RECENT)     # ids of messages we could reply to
+        self.mine = collections.deque(maxlen=RECENT)       # ids this client sent
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            self.args.host, self.args.port, ssl=self.context,
+            server_hostname=self.args.host if self.args.verify_host else None)
+        self.buffer = FrameBuffer()
+        await self.next_event()        # LOGIN prompt
+        self.send({"username": self.name, "user_id": self.user_id, "token": self.token})
+        response = await self.next_event()
+        if response.get("status") != "SUCCESS":
+            raise RuntimeError(f"login failed: {response}")
+        self.user_id = response["user_id"]
+        self.token = response.get("token")
+        self.roster.add(self.user_id)
+        if self.room is not None:
+            self.send({"action": "JOIN", "room": self.room})
+
+    async def next_event(self):
+        while True:
+            for frame in self.buffer.frames():
+                return decode_message(frame)
+            chunk = await self.reader.read(65536)
+            if not chunk:
+                raise ConnectionError("closed by the server")
+            self.buffer.feed(chunk)
+
+    def send(self, message):
+        self.writer.write(encode_message(message))
+
+    async def close(self, graceful=True):
+        self.roster.discard(self.user_id)
+        if self.writer is None:
+            return
+        try:
+            if graceful:
+                self.send({"action": "EXIT"})
+                await self.writer.drain()
+            self.writer.close()
+            await self.writer.wait_closed()
+        except (OSError, ssl.SSLError):
+            pass
+        self.writer = None
+
+    async def receive(self):
+        while True:
+            try:
+                chunk = await self.reader.read(65536)
+            except (OSError, ssl.SSLError):
+                return
+            if not chunk:
+                return
+            now = time.perf_counter()
+            self.buffer.feed(chunk)
+            for frame in self.buffer.frames():
+                self.handle(decode_message(frame), now)
+
+    def handle(self, event, now):
+        action = event.get('action')
+        if action in ('MESSAGE', 'TEMPORARY', 'REPLY'):
+            if event['sender'] == self.user_id:
+                self.mine.append(event['id'])
+            else:
+                content = event.get('content') or ''
+                if content.startswith(STAMP):
+                    self.stats.delivery(now - float(content[len(STAMP):].split(' ', 1)[0]))
+            self.recent.append(event['id'])
+        elif 'error' in event:
+            self.stats.errors += 1
+
+    def next_message(self, action):
+        stamp = f"{STAMP}{time.perf_counter():.6f} {'x' * self.args.size}"
+        data = {"action": 'MESSAGE', "sender": self.user_id, "receiver": ["all"], "content": stamp,
+                "time": time.strftime("%Y-%m-%d %H:%M:%S"), "private": False, "optional": None}
+        if action == 'private':
+            others = [uid for uid in random.sample(sorted(self.roster), min(3, len(self.roster)))
+                      if uid != self.user_id]
+            if not others:
+                return None
+            data.update(receiver=others[:1], private=True)
+        elif action == 'room':
+            if self.room is None:
+                return None
+            data.update(receiver=[], room=self.room)
+        elif action == 'temporary':
+            data.update(action='TEMPORARY', ttl=self.args.ttl)
+        elif action == 'reply':
+            if not self.recent:
+                return None
+            # The server sends it wherever the replied-to message went.
+            data.update(action='REPLY', receiver=[], optional=random.choice(self.recent))
+        elif action == 'delete':
+            if not self.mine:
+                return None
+            data = {"action": 'DELETE', "sender": self.user_id, "content": self.mine.popleft()}
+        return data
+
+    async def run(self, deadline, rate, actions, weights):
+        receiver = asyncio.create_task(self.receive())
+        try:
+            while True:
+                delay = random.expovariate(rate) if rate > 0 else deadline - time.perf_counter()
+                if time.perf_counter() + delay >= deadline:
+                    await asyncio.sleep(max(deadline - time.perf_counter(), 0))
+                    return
+                await asyncio.sleep(delay)
+                if self.args.churn and random.random() < self.args.churn * delay:
+                    receiver.cancel()
+                    await self.close()
+                    await self.connect()
+                    self.stats.churned += 1
+                    receiver = asyncio.create_task(self.receive())
+                    continue
+                action = random.choices(actions, weights)[0]
+                message = self.next_message(action)
+                if message is None:
+                    continue
+                self.send(message)
+                self.stats.sent[action] += 1
+                await self.writer.drain()
+        except (OSError, ssl.SSLError, ConnectionError, RuntimeError):
+            self.stats.errors += 1
+        finally:
+            receiver.cancel()
+
+
+def make_context(args):
+    context = ssl.create_default_context(cafile=None if args.insecure else args.cert)
+    context.check_hostname = False
+    if args.insecure:
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+async def wait_for_server(args, timeout=15):
+    # A full handshake: a bare TCP probe is a failed handshake to the server.
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection(args.host, args.port, ssl=make_context(args))
+            writer.close()
+            return
+        except ConnectionRefusedError:
+            await asyncio.sleep(0.1)
+    raise TimeoutError(f"server did not come up on {args.host}:{args.port}")
+
+
+async def drive(args, first, count, barrier):
+    """Connects clients first..first+count-1, waits at the barrier, runs the load."""
+    context = make_context(args)
+    stats = Stats(args.max_samples // args.procs)
+    roster = set()
+
+    clients = [SimClient(f"load{i}", args, context, stats, roster,
+                         room=f"load{i % args.rooms}" if args.rooms else None)
+               for i in range(first, first + count)]
+    gate = asyncio.Semaphore(args.connect_concurrency)
+
+    async def connect(client):
+        async with gate:
+            await client.connect()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(connect(c) for c in clients))
+    connect_seconds = time.perf_counter() - start
+    barrier.wait(timeout=BARRIER_TIMEOUT)
+
+    actions, weights = zip(*args.mix.items())
+    deadline = time.perf_counter() + args.duration
+    await asyncio.gather(*(c.run(deadline, args.rate / args.clients, actions, weights) for c in clients))
+    # Let what is still in flight arrive.
+    await asyncio.sleep(args.drain)
+    await asyncio.gather(*(c.close() for c in clients), return_exceptions=True)
+    return {'latencies': stats.latencies, 'sent': stats.sent, 'delivered': stats.delivered,
+            'errors': stats.errors, 'churned': stats.churned, 'connect_s': connect_seconds}
+
+
+def shard(args, first, count, barrier, results):
+    try:
+        results.put(asyncio.run(drive(args, first, count, barrier)))
+    except Exception as e:
+        barrier.abort()
+        results.put({'failed': f"{type(e).__name__}: {e}"})
+
+
+def run(args):
+    server = None
+    if args.spawn is not None:
+        server = subprocess.Popen([sys.executable, 'server.py'] + shlex.split(args.spawn),
+                                  cwd=args.server_cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        args.server_pid = server.pid
+    try:
+        asyncio.run(wait_for_server(args))
+        monitor = ServerMonitor(args.server_pid) if args.server_pid else None
+
+        # One event loop tops out at a few thousand deliveries a second, so
+        # the clients are spread over processes. perf_counter() is the
+        # system-wide monotonic clock on Linux, so send stamps made in one
+        # process are comparable with receive times in another.
+        ctx = multiprocessing.get_context('fork')
+        barrier, results = ctx.Barrier(args.procs + 1), ctx.Queue()
+        sizes = [args.clients // args.procs + (i < args.clients % args.procs) for i in range(args.procs)]
+        procs, first = [], 0
+        for size in sizes:
+            procs.append(ctx.Process(target=shard, args=(args, first, size, barrier, results), daemon=True))
+            first += size
+        for proc in procs:
+            proc.start()
+
+        shards = []
+        try:
+            barrier.wait(timeout=BARRIER_TIMEOUT)
+        except threading.BrokenBarrierError:
+            try:
+                shards = [results.get(timeout=5)]
+            except queue.Empty:
+                shards = [{'failed': "clients did not finish logging in"}]
+        else:
+            if monitor is not None:
+                monitor.start()
+            start = time.perf_counter()
+            while time.perf_counter() < start + args.duration:
+                time.sleep(1)
+                if monitor is not None:
+                    monitor.poll()
+            shards = [results.get() for _ in procs]
+            elapsed = time.perf_counter() - start
+            cpu = monitor.cpu_seconds() if monitor is not None else None
+        for proc in procs:
+            proc.join(timeout=5)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    failed = [s['failed'] for s in shards if 'failed' in s]
+    if failed:
+        sys.exit(f"load generator failed: {failed[0]}")
+
+    latencies = sorted(itertools.chain.from_iterable(s['latencies'] for s in shards))
+    by_action = sum((s['sent'] for s in shards), collections.Counter())
+    sent = sum(by_action.values())
+    delivered = sum(s['delivered'] for s in shards)
+    return {
+        'clients': args.clients,
+        'procs': args.procs,
+        'duration_s': round(elapsed, 2),
+        'connect_s': round(max(s['connect_s'] for s in shards), 2),
+        'sent': sent,
+        'sent_by_action': dict(by_action),
+        'delivered': delivered,
+        'sent_per_s': round(sent / elapsed, 1),
+        'delivered_per_s': round(delivered / elapsed, 1),
+        'latency_ms_p50': round(percentile(latencies, 0.50) * 1e3, 3) if latencies else None,
+        'latency_ms_p99': round(percentile(latencies, 0.99) * 1e3, 3) if latencies else None,
+        'latency_ms_p999': round(percentile(latencies, 0.999) * 1e3, 3) if latencies else None,
+        'errors': sum(s['errors'] for s in shards),
+        'churned': sum(s['churned'] for s in shards),
+        'server_cpu_percent': round(cpu / elapsed * 100, 1) if cpu is not None else None,
+        'server_peak_rss_mb': round(monitor.peak_rss / 2**20, 1) if monitor is not None else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated TLS clients driving the chat server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=65432)
+    parser.add_argument('--cert', default=os.path.join(HERE, '..', 'client', 'cert.pem'))
+    parser.add_argument('--insecure', action='store_true', help="don't verify the server certificate")
+    parser.add_argument('--verify-host', action='store_true', help="send SNI / check the host name")
+    parser.add_argument('--codec', choices=sorted(framing.CODECS), default='json')
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--procs', type=int, default=max(1, min(8, (os.cpu_count() or 2) // 2)),
+                        help="load generator processes the clients are spread over")
+    parser.add_argument('--connect-concurrency', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=10, help="seconds of load")
+    parser.add_argument('--rate', type=float, default=500, help="messages per second, all clients together")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"action weights (default {DEFAULT_MIX})")
+    parser.add_argument('--churn', type=float, default=0.0,
+                        help="reconnects per client per second (e.g. 0.01)")
+    parser.add_argument('--size', type=int, default=32, help="padding bytes per message")
+    parser.add_argument('--rooms', type=int, default=0, help="rooms the clients are spread over")
+    parser.add_argument('--ttl', type=float, default=5, help="lifetime of TEMPORARY messages")
+    parser.add_argument('--drain', type=float, default=1, help="seconds to wait for in-flight messages")
+    parser.add_argument('--max-samples', type=int, default=1_000_000, help="latency samples kept")
+    parser.add_argument('--server-pid', type=int, default=None, help="sample CPU/RSS of this process")
+    parser.add_argument('--spawn', default=None, metavar='ARGS',
+                        help="start server.py with these arguments (e.g. \"--engine asyncio\")")
+    parser.add_argument('--server-cwd', default=os.path.join(HERE, '..', 'server'),
+                        help="directory to start the server in (holds cert.pem/key.pem)")
+    parser.add_argument('--json', action='store_true', help="print machine-readable results")
+    args = parser.parse_args()
+
+    framing.set_codec(args.codec)
+    result = run(args)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    width = max(len(key) for key in result)
+    for key, value in result.items():
+        print(f"{key:<{width}}  {value}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+# soak_memory.py
+# Memory soak: push millions of messages through a server and sample its RSS
+# along the way, to check that --memory-budget keeps it flat.
+#
+#   python3 bench/soak_memory.py --spawn "--engine asyncio --memory-budget 64M" --messages 2000000
+#   python3 bench/soak_memory.py --spawn "--engine asyncio" --messages 2000000
+#
+# A few pipelined clients (client/api.py) send public messages drawn from a
+# fixed vocabulary, so every message lands in several mailboxes and the
+# search index, as fast as the server's backpressure lets them. Every
+# --sample messages the server's RSS is recorded. The summary gives the
+# growth over the second half of the run in MB per million messages: close
+# to zero means memory stays bounded.
+import argparse
+import asyncio
+import json
+import os
+import random
+import shlex
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'client'))
+
+from api import ChatClient
+from loadgen import ServerMonitor, make_context, wait_for_server
+
+VOCABULARY = 5000
+
+
+def slope(samples):
+    """Least-squares RSS growth in MB per million messages."""
+    if len(samples) < 2:
+        return 0.0
+    xs = [s['messages'] / 1e6 for s in samples]
+    ys = [s['rss_mb'] for s in samples]
+    mx, my = sum(xs) / len(xs), sum(ys) / len(ys)
+    var = sum((x - mx) ** 2 for x in xs)
+    return sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / var if var else 0.0
+
+
+async def soak(args, monitor):
+    context = make_context(args)
+    clients = [await ChatClient.connect(f"soak{i}", host=args.host, port=args.port, context=context)
+               for i in range(args.senders)]
+    words = [f"w{n}" for n in range(VOCABULARY)]
+    samples = []
+    sent = 0
+    start = time.perf_counter()
+
+    def sample():
+        rss = monitor.rss()
+        samples.append({'messages': sent, 'seconds': round(time.perf_counter() - start, 1),
+                        'rss_mb': round(rss / 2 ** 20, 1)})
+        if not args.json:
+            print(f"{sent:>12} {samples[-1]['seconds']:>9} {samples[-1]['rss_mb']:>9}", flush=True)
+
+    async def sender(client, count):
+        nonlocal sent
+        rng = random.Random(client.user_id)
+        for _ in range(count):
+            text = ' '.join(rng.choices(words, k=8))
+            await client.send(f"{text} {'x' * rng.randrange(args.size)}")
+            sent += 1
+            if sent % args.sample == 0:
+                sample()
+
+    if not args.json:
+        print(f"{'messages':>12} {'seconds':>9} {'rss MB':>9}")
+    sample()
+    share = args.messages // args.senders
+    await asyncio.gather(*(sender(client, share) for client in clients))
+    for client in clients:
+        await client.flush()
+    await asyncio.sleep(1)      # let the server catch up before the last sample
+    sample()
+    for client in clients:
+        await client.close()
+    return samples, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server RSS over millions of messages")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=65432)
+    parser.add_argument('--cert', default=os.path.join(HERE, '..', 'client', 'cert.pem'))
+    parser.add_argument('--insecure', action='store_true', help="don't verify the server certificate")
+    parser.add_argument('--messages', type=int, default=2_000_000)
+    parser.add_argument('--senders', type=int, default=4)
+    parser.add_argument('--size', type=int, default=100, help="up to this many padding bytes per message")
+    parser.add_argument('--sample', type=int, default=100_000, help="messages between RSS samples")
+    parser.add_argument('--spawn', default=None, metavar='ARGS',
+                        help="start server.py with these arguments (and stop it afterwards)")
+    parser.add_argument('--server-cwd', default=os.path.join(HERE, '..', 'server'),
+                        help="directory to run the spawned server in (needs cert.pem/key.pem)")
+    parser.add_argument('--server-pid', type=int, default=None, help="PID of an already running server")
+    parser.add_argument('--json', action='store_true', help="print machine-readable results")
+    args = parser.parse_args()
+    if (args.spawn is None) == (args.server_pid is None):
+        parser.error("give either --spawn or --server-pid")
+
+    server = None
+    if args.spawn is not None:
+        server = subprocess.Popen([sys.executable, 'server.py'] + shlex.split(args.spawn),
+                                  cwd=args.server_cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        args.server_pid = server.pid
+    try:
+        asyncio.run(wait_for_server(args))
+        samples, seconds = asyncio.run(soak(args, ServerMonitor(args.server_pid)))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    second_half = [s for s in samples if s['messages'] >= args.messages / 2]
+    result = {
+        'server': args.spawn,
+        'messages': samples[-1]['messages'],
+        'seconds': round(seconds, 1),
+        'msgs_per_second': round(samples[-1]['messages'] / seconds, 1),
+        'rss_mb_start': samples[0]['rss_mb'],
+        'rss_mb_peak': max(s['rss_mb'] for s in samples),
+        'rss_mb_end': samples[-1]['rss_mb'],
+        'growth_mb_per_million_second_half': round(slope(second_half), 2),
+        'samples': samples,
+    }
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    print(f"\n{result['messages']} messages in {result['seconds']} s ({result['msgs_per_second']} msg/s)")
+    print(f"RSS start {result['rss_mb_start']} MB, peak {result['rss_mb_peak']} MB, end {result['rss_mb_end']} MB")
+    print(f"growth over the second half: {result['growth_mb_per_million_second_half']} MB per million messages")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+# api.py
+# Non-interactive client for scripts and bots, on asyncio.
+#
+#   from api import ChatClient
+#
+#   async def main():
+#       async with await ChatClient.connect("buildbot", cafile="cert.pem") as chat:
+#           await chat.join("dev")
+#           for i in range(10_000):
+#               await chat.send(f"build {i} passed", room="dev")
+#           async for event in chat.events():
+#               print(event)
+#
+# send() and friends only queue the request. A writer task hands everything
+# queued since its last write to the transport in a single write(), so a
+# burst leaves in a few full TLS records instead of one record per
+# message. send() waits while more than `high_water` bytes are queued or
+# while the server has paused us with a FLOW frame, so a fast producer
+# can't run the process (or the server) out of memory. If the server offers
+# it, the connection is zlib-compressed (compression=None turns that off).
+import asyncio
+import collections
+import ssl
+import time
+
+from framing import Deflater, FrameBuffer, Inflater, decode_message, encode_message
+
+HOST = '127.0.0.1'
+PORT = 65432
+HIGH_WATER = 256 * 1024     # bytes queued before send() waits
+EVENT_LIMIT = 10_000        # unread events kept, the oldest are dropped beyond that
+READ_CHUNK = 64 * 1024
+COMPRESSION = 'zlib'
+
+
+class LoginError(Exception):
+    """The server refused the login, or the connection. `retry_after`: seconds it asked us to wait, if any."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+async def _next_event(reader, buffer):
+    while True:
+        for frame in buffer.frames():
+            return decode_message(frame)
+        chunk = await reader.read(READ_CHUNK)
+        if not chunk:
+            raise ConnectionError("Connection closed by the server")
+        buffer.feed(chunk)
+
+
+def _now():
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+class ChatClient:
+    """
+    A logged in connection. Create it with ChatClient.connect(). Server
+    events (messages, deletes, presence, search results...) are read in the
+    background and handed out by events().
+    """
+
+    def __init__(self, reader, writer, buffer, login, high_water=HIGH_WATER, event_limit=EVENT_LIMIT):
+        self.user_id = login['user_id']
+        self.token = login.get('token')
+        self.high_water = high_water
+        self.paused = False
+        self.closed = False
+        self._resume = None         # timer ending a FLOW pause that had a retry_after
+        self._reader = reader
+        self._writer = writer
+        self._buffer = buffer
+        self.compression = login.get('compress')    # what the server agreed to, or None
+        self._deflater = Deflater() if self.compression else None
+        self._pending = []
+        self._pending_bytes = 0
+        self._wake = asyncio.Event()        # something to write
+        self._space = asyncio.Event()       # send() may queue more
+        self._space.set()
+        self._flushed = asyncio.Event()
+        self._flushed.set()
+        self._events = collections.deque()
+        self._event_limit = event_limit
+        self._event_ready = asyncio.Event()
+        self._error = None
+        self._read_done = False
+        # Counters
+        self.sent_frames = 0
+        self.writes = 0
+        self.bytes_written = 0      # on the connection, after compression
+        self.bytes_read = 0
+        self.dropped_events = 0
+        self._tasks = [asyncio.create_task(self._write_loop()), asyncio.create_task(self._read_loop())]
+
+    @classmethod
+    async def connect(cls, username, host=HOST, port=PORT, cafile='cert.pem', context=None,
+                      user_id=None, token=None, compression=COMPRESSION, **options):
+        """
+        Connect and log in. Pass the `user_id` and `token` of an earlier
+        session to get that user back. Raises LoginError if refused.
+        """
+        if context is None:
+            context = ssl.create_default_context(cafile=cafile)
+            context.check_hostname = False
+        reader, writer = await asyncio.open_connection(host, port, ssl=context)
+        buffer = FrameBuffer()
+        try:
+            prompt = await _next_event(reader, buffer)
+            if prompt.get("action") != "LOGIN":
+                # BUSY: too many connections, or the server is overloaded.
+                raise LoginError(prompt.get("error") or "connection refused", prompt.get("retry_after"))
+            request = {"username": username, "user_id": user_id, "token": token}
+            if compression is not None and compression in (prompt.get("compress") or ()):
+                request["compress"] = compression
+            writer.write(encode_message(request))
+            if "compress" in request:
+                # Both ways compressed from here on, starting with the reply.
+                buffer.inflate(Inflater())
+            response = await _next_event(reader, buffer)
+        except BaseException:
+            writer.close()
+            raise
+        if response.get("status") != "SUCCESS":
+            writer.close()
+            raise LoginError(response.get("error") or "login refused", response.get("retry_after"))
+        return cls(reader, writer, buffer, response, **options)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # Requests
+
+    async def request(self, data):
+        """Queue any request dict; waits while the send queue is over its high-water mark."""
+        while (self._pending_bytes >= self.high_water or self.paused) and self._error is None:
+            self._space.clear()
+            await self._space.wait()
+        if self._error is not None:
+            raise ConnectionError(f"Connection lost: {self._error}")
+        if self.closed:
+            raise ConnectionError("Client is closed")
+        frame = encode_message(data)
+        self._pending.append(frame)
+        self._pending_bytes += len(frame)
+        self._flushed.clear()
+        self._wake.set()
+
+    async def send(self, content, to=None, room=None, ttl=None, private=None):
+        """
+        A message to everybody, to the user ids in `to`, or to `room`.
+        With `ttl` (seconds) it is a temporary message.
+        """
+        await self.request({
+            "action": 'TEMPORARY' if ttl is not None else 'MESSAGE',
+            "sender": self.user_id,
+            "receiver": list(to) if to else ([] if room else ["all"]),
+            "content": content,
+            "time": _now(),
+            "private": bool(to) if private is None else private,
+            "optional": None,
+            **({"room": room} if room else {}),
+            **({"ttl": ttl} if ttl is not None else {}),
+        })
+
+    async def reply(self, message_id, content):
+        """The server sends it wherever `message_id` went."""
+        await self.request({"action": 'REPLY', "sender": self.user_id, "receiver": [],
+                            "content": content, "time": _now(), "private": False, "optional": message_id})
+
+    async def delete(self, message_id):
+        await self.request({"action": 'DELETE', "sender": self.user_id, "content": message_id})
+
+    async def join(self, room):
+        await self.request({"action": 'JOIN', "room": room})
+
+    async def leave(self, room):
+        await self.request({"action": 'LEAVE', "room": room})
+
+    async def search(self, words, pattern=None, limit=None):
+        """Results arrive as SEARCH_RESULT events."""
+        await self.request({"action": 'SEARCH', "content": words, "pattern": pattern, "limit": limit})
+
+    async def history(self, since=None, cursor=None, limit=None):
+        """Pages arrive as HISTORY events."""
+        await self.request({"action": 'HISTORY', "since": since, "cursor": cursor, "limit": limit})
+
+    async def flush(self):
+        """Wait until everything queued so far has been handed to the connection."""
+        await self._flushed.wait()      # also set when the connection fails
+        if self._error is not None:
+            raise ConnectionError(f"Connection lost: {self._error}")
+
+    async def close(self):
+        """Say goodbye, send what is still queued and close the connection."""
+        if self.closed:
+            return
+        if self._error is None:
+            try:
+                await self.request({"action": "EXIT"})
+                await self.flush()
+            except ConnectionError:
+                pass
+        self.closed = True
+        for task in self._tasks:
+            task.cancel()
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except (OSError, ssl.SSLError):
+            pass
+
+    # Events
+
+    async def events(self):
+        """Server events in arrival order, until the connection closes."""
+        while True:
+            while self._events:
+                yield self._events.popleft()
+            if self._read_done:
+                return
+            self._event_ready.clear()
+            await self._event_ready.wait()
+
+    def _event(self, event):
+        if event.get('action') == 'FLOW':
+            # Our queue on the server is backing up, or we hit a rate limit
+            # and the pause ends by itself after `retry_after` seconds.
+            if self._resume is not None:
+                self._resume.cancel()
+                self._resume = None
+            self._pause(bool(event.get('pause')))
+            if self.paused and event.get('retry_after') is not None:
+                self._resume = asyncio.get_running_loop().call_later(event['retry_after'], self._pause, False)
+            return
+        if len(self._events) >= self._event_limit:
+            self._events.popleft()
+            self.dropped_events += 1
+        self._events.append(event)
+        self._event_ready.set()
+
+    def _pause(self, paused):
+        self.paused = paused
+        if not paused:
+            self._space.set()
+            self._wake.set()
+
+    async def _read_loop(self):
+        try:
+            for frame in self._buffer.frames():     # arrived right behind the login reply
+                self._event(decode_message(frame))
+            while True:
+                chunk = await self._reader.read(READ_CHUNK)
+                if not chunk:
+                    break
+                self.bytes_read += len(chunk)
+                self._buffer.feed(chunk)
+                for frame in self._buffer.frames():
+                    self._event(decode_message(frame))
+        except (OSError, ssl.SSLError, ValueError) as e:
+            self._fail(e)
+        else:
+            self._fail(ConnectionError("Connection closed by the server"))
+
+    async def _write_loop(self):
+        try:
+            while True:
+                await self._wake.wait()
+                self._wake.clear()
+                while self._pending and not self.paused:
+                    batch, self._pending, self._pending_bytes = self._pending, [], 0
+                    self._space.set()
+                    data = batch[0] if len(batch) == 1 else b''.join(batch)
+                    if self._deflater is not None:
+                        data = self._deflater.compress(data)
+                    self._writer.write(data)
+                    self.bytes_written += len(data)
+                    self.sent_frames += len(batch)
+                    self.writes += 1
+                    # Requests queued while this waits go out in the next write.
+                    await self._writer.drain()
+                if not self._pending:
+                    self._flushed.set()
+        except (OSError, ssl.SSLError) as e:
+            self._fail(e)
+
+    def _fail(self, error):
+        if self._error is None and not self.closed:
+            self._error = error
+        self._read_done = True
+        self._event_ready.set()
+        self._space.set()
+        self._flushed.set()
@@ -1,30 +1,58 @@
 # client.py
+import atexit
+import itertools
 import socket
 import json
 import threading
 import textwrap
 import ssl
-import os  # For clearing the terminal
-import random
+import os
 import re
+import random
 import subprocess
 import sys
+import time
 from datetime import datetime
 
+import framing
+from framing import Deflater, FrameBuffer, Inflater, decode_message, encode_message, recv_message, send_message
+from messages import MessageStore
+from outbox import Outbox
+from renderer import BubbleCache, Renderer, clip
+
 # Configuration
 IP = "127.0.0.1"
 PORT = 65432
-HEADER_LENGTH = 2048
+CODEC = 'json'  # must match the server's --codec
+COMPRESSION = 'zlib'  # asked for at login if the server offers it, None to turn it off
 BUBBLE_WIDTH = 40  # Maximum characters per line in the bubble
-MESSAGES = []
-ACTIVE_CLIENTS = []
+MESSAGES = MessageStore()  # history: ordered by id, indexed by id and by replied-to id
+ACTIVE_CLIENTS = {}  # user_id -> None, kept in join order
+ROOMS = {}  # rooms we are in: name -> set of member ids
+BUBBLES = BubbleCache()  # rendered speech bubbles by message id
+STATUS = None  # last error or notice, shown above the prompt
+SEARCH_HITS = 0  # results written to search.txt for the running search
+SEARCH_LIMIT = 500  # results asked for per .search
+CACHE_DIR = ".chat_cache"  # history kept between sessions, one file per username
+CACHE_LIMIT = 5000  # newest messages kept in the cache
+HISTORY_LIMIT = 1000  # messages fetched at login, and per .history
+RECONNECT_BASE = 0.5  # seconds, first reconnect waits up to this long
+RECONNECT_CAP = 30  # seconds, longest reconnect wait
+ROSTER_ROWS = 8  # active clients and rooms listed below the history, the rest are counted
+RENDERER = None
 
 
 # Global variable to hold our user id after login.
 my_user_id = None
+my_username = None
+resume_token = None  # lets the server hand our user ID back after a reconnect
+tls_session = None  # reused so a reconnect skips the full TLS handshake
+catch_up_since = None  # newest id we had when we asked for what we missed
+OUTBOX = Outbox()  # requests on their way to the current connection
+closing = False
 lock = threading.Lock()
 
-def speech_bubble(message, sender, msg_id, timestamp, private, optional=None):
+def speech_bubble(message, sender, msg_id, timestamp, private, optional=None, room=None):
     """
     Creates a speech bubble string that contains:
       - The message text,
@@ -71,7 +99,10 @@ def speech_bubble(message, sender, msg_id, timestamp, private, optional=None):
     
     # Bottom block: sender and then the ID and timestamp in light gray.
     bottom = f"\\_{'_' * max_length}_/\n |/\n {sender}"
-    bottom += " (Private)" if private else " (Public)"
+    if room is not None:
+        bottom += f" (#{room})"
+    else:
+        bottom += " (Private)" if private else " (Public)"
     bottom += f"\n\033[90mID: {msg_id} | {timestamp}\033[0m"
 
     main_box = f"{top}\n{middle}\n{bottom}"
@@ -79,99 +110,325 @@ def speech_bubble(message, sender, msg_id, timestamp, private, optional=None):
     #return f"{top}\n{middle}\n{bottom}"
     return reply_box+main_box
 
-def clear_screen():
-    # Clear the terminal screen.
-    os.system('cls' if os.name == 'nt' else 'clear')
-
-def render_messages():
+def message_bubble(msg):
+    optional = None
+
+    if msg['action'] == 'REPLY':
+        reply_sender = msg['sender']
+        reply_id = msg['optional']
+        replied = MESSAGES.get(reply_id)
+        reply_message = replied['content'] if replied is not None else None
+        optional = f"[REPLY]\"{reply_sender}({reply_id}): {reply_message}\""
+
+    return speech_bubble(
+        msg.get('content', ''),
+        msg.get('sender', 'Unknown'),
+        msg.get('id', 'N/A'),
+        msg.get('time', 'N/A'),
+        msg.get('private',False),
+        optional,
+        msg.get('room'),
+    )
+
+def invalidate_message(msg_id):
+    # Its own bubble and every reply quoting it show the old content.
+    BUBBLES.invalidate(msg_id)
+    for reply_id in MESSAGES.replies_to(msg_id):
+        BUBBLES.invalidate(reply_id)
+
+def compose_screen(rows, columns):
     """
-    Clears the screen and reprints all messages using the speech bubble format.
+    Lines of one frame (see renderer.py). Only the newest messages that fit
+    on screen are looked at, and their bubbles come from the cache.
     """
-    global my_user_id
-    clear_screen()
-    print("=== Chat History ===\n")
-    
-    for msg in MESSAGES:
-        optional = None
-        
-        if msg['action'] == 'REPLY':
-            reply_sender = msg['sender']
-            reply_message = None
-            reply_id = msg['optional']
-            for m in MESSAGES:
-                if m['id'] == reply_id:
-                    reply_message = m['content'] 
-                    break
-            optional = f"[REPLY]\"{reply_sender}({reply_id}): {reply_message}\""
-
-
-        bubble = speech_bubble(
-            msg.get('content', ''),
-            msg.get('sender', 'Unknown'),
-            msg.get('id', 'N/A'),
-            msg.get('time', 'N/A'),
-            msg.get('private',False),
-            optional,
-        )
-        print(bubble + "\n")
-    print("=== End of Chat History ===\n")
-    print("++ ACTIVE CLIENTS ++\n")
-    for i, client_id in enumerate(ACTIVE_CLIENTS):
-        print(f"{i+1}: {client_id}")
-    print("++++++++++++++++++++\n")
-    print("Direct messages: @<user_id> <message>")
-    print("Delete a message: .delete <message_id")
-    print("Type '.exit' to quit.")
-
-    print(f"\nYou ({my_user_id})>")
+    header = ["=== Chat History ===", ""]
+    footer = ["=== End of Chat History ===", "", "++ ACTIVE CLIENTS ++", ""]
+    # Long rosters are cut short, otherwise they crowd the history off screen.
+    for i, client_id in enumerate(itertools.islice(ACTIVE_CLIENTS, ROSTER_ROWS)):
+        footer.append(f"{i+1}: {client_id}")
+    if len(ACTIVE_CLIENTS) > ROSTER_ROWS:
+        footer.append(f"... +{len(ACTIVE_CLIENTS) - ROSTER_ROWS} more")
+    if ROOMS:
+        footer.append("++ ROOMS ++")
+        rooms = sorted(ROOMS.items())
+        footer += [f"#{name} ({len(members)} members)" for name, members in rooms[:ROSTER_ROWS]]
+        if len(rooms) > ROSTER_ROWS:
+            footer.append(f"... +{len(rooms) - ROSTER_ROWS} more")
+    footer += [
+        "++++++++++++++++++++",
+        "",
+        "Direct messages: @<user_id> <message>",
+        "Rooms: .join <room>, .leave <room>, #<room> <message>",
+        "Delete a message: .delete <message_id",
+        "Type '.exit' to quit.",
+        "",
+    ]
+    if STATUS:
+        footer.append(STATUS)
+    footer.append(f"You ({my_user_id})>")
+
+    room = rows - len(header) - len(footer)
+    chunks = []
+    used = 0
+    for msg in reversed(MESSAGES):
+        if used >= room:
+            break
+        lines = BUBBLES.get(msg['id'], lambda: message_bubble(msg)) + [""]
+        chunks.append(lines)
+        used += len(lines)
+    history = [line for lines in reversed(chunks) for line in lines]
+    if room > 0:
+        history = history[-room:]
+    else:
+        history = []
+    # One line per row: anything wider would wrap and push the frame off screen.
+    return [clip(line, columns) for line in (header + history + footer)[-rows:]]
+
+def render_messages():
+    """Schedule a repaint; bursts of events end up in a single frame."""
+    if RENDERER is not None:
+        RENDERER.request()
 
 # def generate_message_id():
 #     return f"{random.randint(100000, 999999)}"
 
-def receive_messages(client_socket):
-    global MESSAGES
-    global ACTIVE_CLIENTS
+def receive_messages(client_socket, buffer):
     while True:
         try:
-            raw_msg = client_socket.recv(HEADER_LENGTH).decode('utf-8')
-            if not raw_msg:
-                print("Connection closed by the server.")
+            # A single read may hold several server events, handle them all.
+            for frame in buffer.frames():
+                handle_event(decode_message(frame))
+            if buffer.recv_from(client_socket) == 0:
+                show_status("Connection closed by the server.")
                 break
-
-            data = json.loads(raw_msg)
-            # If a refresh event is received, re-render the entire chat history.
-            if data["action"] == "MESSAGE" or data['action'] == 'TEMPORARY' or data['action'] == 'REPLY':
-                with lock:
-                    MESSAGES.append(data)
-                    MESSAGES = sorted(MESSAGES, key=lambda x: x["time"])
-                    render_messages()
-            elif data["action"] == "DELETE":
-                with lock:
-                    for msg in MESSAGES:
-                        if msg['id'] == data['content']:
-                            msg['content'] = 'THIS MESSAGE IS REMOVED'
-                            break
-                    render_messages()
-            elif data["action"] == 'ACTIVE_CLIENT':
-                with lock:
-                    ACTIVE_CLIENTS = data['receiver'][:]
-                    render_messages()
-            elif data["action"] == 'OUTDATED':
-                with lock:
-                    for msg in MESSAGES:
-                        if msg['id'] == data['content']:
-                            msg['content'] = 'THIS MESSAGE IS EXPIRED'
-                            break
-                    render_messages()    
-            elif "error" in data:
-                print("Error:", data["error"])
-            else:
-                # (If other events are sent, handle them here.)
-                pass
         except Exception as e:
-            print("Error receiving message:", e)
+            show_status(f"Error receiving message: {e}")
             break
 
+def receive_loop(context, client_socket, buffer):
+    # Receiver thread body: handle events, and reconnect whenever the
+    # connection drops until the user leaves.
+    while True:
+        receive_messages(client_socket, buffer)
+        if closing:
+            return
+        client_socket, buffer = reconnect(context)
+
+def show_status(text):
+    global STATUS
+    with lock:
+        STATUS = text
+        render_messages()
+
+def create_tls_context():
+    context = ssl.create_default_context()
+
+    # For development only: disable server cert validation (not secure!)
+    context.check_hostname = False
+    # context.verify_mode = ssl.CERT_NONE
+
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.load_verify_locations('cert.pem')
+    return context
+
+def connect(context, session=None):
+    #Raw socket
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tls_socket = context.wrap_socket(client_socket, server_hostname=IP, session=session)
+    tls_socket.connect((IP, PORT))
+    return tls_socket
+
+def login(tls_socket, buffer, username, user_id=None, token=None):
+    """
+    Answer the server's LOGIN prompt and return its reply (empty if the
+    connection closed). A server that is full or overloaded answers BUSY
+    instead of prompting, which is returned as it is.
+    """
+    response = recv_message(tls_socket, buffer) or {}
+    if response.get("action") != "LOGIN":
+        return response
+    request = {"username": username, "user_id": user_id, "token": token}
+    if COMPRESSION is not None and COMPRESSION in (response.get("compress") or ()):
+        # Everything after this request is compressed, both ways.
+        request["compress"] = COMPRESSION
+        send_message(tls_socket, request)
+        buffer.inflate(Inflater())
+    else:
+        send_message(tls_socket, request)
+    return recv_message(tls_socket, buffer) or {}
+
+def logged_in(tls_socket, response):
+    global my_user_id, resume_token, tls_session
+    my_user_id = response.get("user_id")
+    resume_token = response.get("token")
+    # TLS 1.3 tickets arrive after the handshake, by now they are in.
+    tls_session = tls_socket.session
+    OUTBOX.attach(tls_socket, Deflater() if response.get("compress") else None)
+
+def send_request(data):
+    # Queued for the writer thread, which coalesces whatever piled up into
+    # one write. Blocks while the queue is full.
+    OUTBOX.put(encode_message(data))
+
+def request_history(since=None, cursor=None):
+    # With `since`, handle_event() keeps asking for the next page below the
+    # cursor until the gap after `since` is closed, however long it is.
+    global catch_up_since
+    catch_up_since = since
+    history = {"action": "HISTORY", "limit": HISTORY_LIMIT}
+    if since is not None:
+        history["since"] = since
+    if cursor is not None:
+        history["cursor"] = cursor
+    send_request(history)
+
+def backoff_delay(attempt, base=RECONNECT_BASE, cap=RECONNECT_CAP):
+    # Full jitter: anywhere up to an exponentially growing cap, so clients
+    # cut off at the same moment don't all come back at the same moment.
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def reconnect(context):
+    """Reconnect with jittered backoff and resume our session. Returns (socket, buffer)."""
+    attempt = 0
+    retry_after = 0
+    while True:
+        # A busy server says how long to stay away, at least.
+        delay = max(backoff_delay(attempt), retry_after)
+        show_status(f"Disconnected, reconnecting in {delay:.1f}s...")
+        time.sleep(delay)
+        attempt += 1
+        try:
+            tls_socket = connect(context, tls_session)
+            buffer = FrameBuffer()
+            response = login(tls_socket, buffer, my_username, my_user_id, resume_token)
+        except (OSError, ValueError) as e:
+            show_status(f"Reconnect failed: {e}")
+            continue
+        if response.get("status") != "SUCCESS":
+            tls_socket.close()
+            retry_after = response.get("retry_after") or 0
+            continue
+        with lock:
+            since = MESSAGES.newest_id()
+        logged_in(tls_socket, response)
+        resumed = "resumed TLS session" if tls_socket.session_reused else "full handshake"
+        show_status(f"Reconnected as {my_user_id} ({resumed}).")
+        request_history(since)
+        return tls_socket, buffer
+
+def handle_event(data):
+    global ACTIVE_CLIENTS
+    global STATUS
+    action = data.get("action")
+    # If a refresh event is received, re-render the entire chat history.
+    if action == "MESSAGE" or action == 'TEMPORARY' or action == 'REPLY':
+        with lock:
+            # Server IDs grow with time, so this is almost always an append
+            # and never a full re-sort.
+            MESSAGES.add(data)
+            render_messages()
+    elif action == "DELETE":
+        with lock:
+            if MESSAGES.set_content(data['content'], 'THIS MESSAGE IS REMOVED') is not None:
+                invalidate_message(data['content'])
+            render_messages()
+    elif action == 'ACTIVE_CLIENT':
+        # Full snapshot, only sent right after login.
+        with lock:
+            ACTIVE_CLIENTS = dict.fromkeys(data['receiver'])
+            render_messages()
+    elif action == 'PRESENCE':
+        # Incremental roster change, applied in place.
+        with lock:
+            for client_id in data.get('left', ()):
+                ACTIVE_CLIENTS.pop(client_id, None)
+            for client_id in data.get('joined', ()):
+                if client_id != my_user_id:
+                    ACTIVE_CLIENTS[client_id] = None
+            render_messages()
+    elif action == 'OUTDATED':
+        with lock:
+            if MESSAGES.set_content(data['content'], 'THIS MESSAGE IS EXPIRED') is not None:
+                invalidate_message(data['content'])
+            render_messages()
+    elif action == 'HISTORY':
+        # Backlog pages, newest first, plus earlier messages changed while
+        # we were away.
+        with lock:
+            for msg in data.get('messages') or ():
+                MESSAGES.add(msg)
+            for msg in data.get('changed') or ():
+                if MESSAGES.set_content(msg['id'], msg['content']) is not None:
+                    invalidate_message(msg['id'])
+            render_messages()
+        # More missed messages than one request returns. A cursor from
+        # .history is always below what we had, so it never matches.
+        cursor = data.get('cursor')
+        if data.get('done') and cursor is not None and catch_up_since is not None \
+                and int(cursor) > int(catch_up_since):
+            request_history(catch_up_since, cursor)
+    elif action == 'ROOM':
+        # Member list, on .join and for every room we are in at login.
+        with lock:
+            ROOMS[data['room']] = set(data.get('members') or ())
+            render_messages()
+    elif action == 'JOIN' or action == 'LEAVE':
+        with lock:
+            if action == 'LEAVE' and data.get('sender') == my_user_id:
+                ROOMS.pop(data['room'], None)
+            elif data['room'] in ROOMS:
+                members = ROOMS[data['room']]
+                if action == 'JOIN':
+                    members.add(data['sender'])
+                else:
+                    members.discard(data['sender'])
+            render_messages()
+    elif action == 'FLOW':
+        # The server's queue for us is backing up, or we are sending faster
+        # than it allows: hold our requests back.
+        OUTBOX.pause(bool(data.get('pause')), data.get('retry_after'))
+        if data.get('retry_after') is not None:
+            show_status("Slow down, holding messages back for a moment...")
+        else:
+            show_status("Server busy, holding messages back..." if data.get('pause') else None)
+    elif action == 'SEARCH_RESULT':
+        # Streamed in pages, newest hits first.
+        search_messages(data.get('results') or [], data.get('done', True))
+    elif "error" in data:
+        with lock:
+            STATUS = f"Error: {data['error']}"
+            render_messages()
+    else:
+        # (If other events are sent, handle them here.)
+        pass
+
+def cache_path(username):
+    safe = re.sub(r'[^\w-]', '_', username) or '_'
+    return os.path.join(CACHE_DIR, f"{safe}.json")
+
+def load_cache(username):
+    """Returns (user_id, token, messages) saved by an earlier session, or (None, None, [])."""
+    try:
+        with open(cache_path(username), encoding="utf-8") as f:
+            cache = json.load(f)
+        return cache["user_id"], cache.get("token"), cache["messages"]
+    except (OSError, ValueError, KeyError):
+        return None, None, []
+
+def save_cache():
+    if my_user_id is None:
+        return
+    with lock:
+        cache = {"user_id": my_user_id, "token": resume_token, "messages": MESSAGES.newest(CACHE_LIMIT)}
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        path = cache_path(my_username)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print("Could not save the message cache:", e)
+
 def extract_message_and_users(mssg):
     parts = mssg.split()
     users = []
@@ -189,11 +446,24 @@ def extract_message_and_users(mssg):
     return users, message
 
 def extract_temp_message(input_str):
+    # .temp @user message      -> server default lifetime
+    # .temp:30 @user message   -> expires after 30 seconds
     parts = input_str.strip().split()
 
-    if not parts or parts[0] != ".temp":
+    if not parts or not parts[0].startswith(".temp"):
         return None  # or raise an error
 
+    ttl = None
+    command, _, ttl_text = parts[0].partition(':')
+    if command != ".temp":
+        return None
+    if ttl_text:
+        ttl = int(ttl_text)  # ValueError on a malformed lifetime
+
+    if len(parts) > 1 and len(parts[1]) > 1 and parts[1].startswith('#'):
+        # .temp #room message
+        return parts[1][1:], ' '.join(parts[2:]), ttl
+
     users = []
     message_start_index = None
 
@@ -206,7 +476,12 @@ def extract_temp_message(input_str):
 
     message = ' '.join(parts[message_start_index:]) if message_start_index is not None else ''
 
-    return  users, message
+    return  users, message, ttl
+
+def extract_room_message(input_str):
+    # #room message
+    room, _, message = input_str.partition(' ')
+    return room[1:], message.strip()
 
 def extract_reply_message(input_str):
     parts = input_str.strip().split()
@@ -223,34 +498,44 @@ def extract_reply_message(input_str):
     return msg_id, msg_context
 
 
-# Function to search messages based on a keyword
-def search_messages(keyword):
-    pattern = re.compile(keyword, re.IGNORECASE)
-    matches = []
+def parse_search(query):
+    # .search <words> [/<pattern>/]: the words go through the server's index,
+    # the optional pattern (* and ? wildcards) only filters what they matched.
+    words, pattern = query.strip(), None
+    parts = words.rsplit(maxsplit=1)
+    if len(parts[-1]) > 2 and parts[-1].startswith('/') and parts[-1].endswith('/'):
+        pattern = parts[-1][1:-1]
+        words = parts[0] if len(parts) > 1 else ''
+    return words, pattern
 
-    with lock:
-        for msg in MESSAGES:
-            content = msg.get("content", "")
-            if pattern.search(content):
-                bubble = speech_bubble(
-                    msg.get('content', ''),
-                    msg.get('sender', 'Unknown'),
-                    msg.get('id', 'N/A'),
-                    msg.get('time', 'N/A'),
-                    msg.get('private', False)
-                )
-                matches.append(bubble)
-
-    # Write results to search.txt
-    with open("search.txt", "w", encoding="utf-8") as f:
-        for bubble in matches:
+def search_messages(results, done):
+    """
+    Write one SEARCH_RESULT page to search.txt as it arrives; the first page
+    starts a new file and the last one opens it in a new terminal window.
+    """
+    global SEARCH_HITS
+    mode = "w" if SEARCH_HITS == 0 else "a"
+    with open("search.txt", mode, encoding="utf-8") as f:
+        for msg in results:
+            bubble = speech_bubble(
+                msg.get('content', ''),
+                msg.get('sender', 'Unknown'),
+                msg.get('id', 'N/A'),
+                msg.get('time', 'N/A'),
+                msg.get('private', False),
+                room=msg.get('room'),
+            )
             f.write(bubble + "\n\n")
+    SEARCH_HITS += len(results)
+    if not done:
+        return
+    SEARCH_HITS = 0
 
     # Open search.txt in a new terminal window
     try:
         open_search_txt()
     except Exception as e:
-        print("Something went wrong:", e)
+        show_status(f"Something went wrong: {e}")
 
 def open_search_txt():
     """Open search.txt in a new terminal window and leave it open after printing."""
@@ -292,50 +577,50 @@ def open_search_txt():
             ])
         
 def main():
-    global my_user_id, MESSAGES
+    global my_username, RENDERER, closing
 
-    #Raw socket
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    framing.set_codec(CODEC)
 
     #Create TLS context
-    context = ssl.create_default_context()
-
-    # For development only: disable server cert validation (not secure!)
-    context.check_hostname = False
-    # context.verify_mode = ssl.CERT_NONE
-
-    context.verify_mode = ssl.CERT_REQUIRED
-    context.load_verify_locations('cert.pem')
-
+    context = create_tls_context()
 
     try:
-        tls_socket = context.wrap_socket(client_socket, server_hostname=IP)
-
-        tls_socket.connect((IP, PORT))
+        tls_socket = connect(context)
     except Exception as e:
         print("Unable to connect to the server:", e)
         return
 
     # Login handshake.
-    response = json.loads(tls_socket.recv(HEADER_LENGTH).decode('utf-8'))
-    if response.get("action") == "LOGIN":
-        username = input("Enter your username: ").strip()
-        #user_id = input("Enter your user ID (leave blank if new): ").strip()
-        #login_data = {"username": username, "user_id": user_id}
-        login_data = {"username": username}
-        tls_socket.send(json.dumps(login_data).encode('utf-8'))
-        
-    # Receive login confirmation.
-    response = json.loads(tls_socket.recv(HEADER_LENGTH).decode('utf-8'))
+    # The buffer is handed to the receiver thread afterwards, it may already
+    # hold events the server sent right behind the login confirmation.
+    buffer = FrameBuffer()
+    username = input("Enter your username: ").strip()
+    # A previous session's ID and token get its mailbox back on the server.
+    cached_id, cached_token, cached_messages = load_cache(username)
+    response = login(tls_socket, buffer, username, cached_id, cached_token)
     if response.get("status") == "SUCCESS":
-        my_user_id = response.get("user_id")
+        logged_in(tls_socket, response)
+        my_username = username
         print(f"Connected successfully. Your user ID is: {my_user_id}")
     else:
-        print("Login failed.")
+        print("Login failed.", response.get("error") or "")
         return
 
+    # Reconnecting: start from the cache and only fetch what is newer.
+    if my_user_id == cached_id:
+        for msg in cached_messages:
+            MESSAGES.add(msg)
+    request_history(MESSAGES.newest_id())
+    atexit.register(save_cache)
+
+    if os.name == 'nt':
+        os.system('')  # turns on ANSI escape handling in the Windows console
+    RENDERER = Renderer(compose_screen, lock)
+    RENDERER.start()
+
     # Start a background thread to listen for server events (including refresh).
-    threading.Thread(target=receive_messages, args=(tls_socket,), daemon=True).start()
+    threading.Thread(target=receive_loop, args=(context, tls_socket, buffer), daemon=True).start()
+    threading.Thread(target=OUTBOX.run, daemon=True).start()
 
     # Main loop: read user input and send commands/messages.
     while True:
@@ -350,11 +635,16 @@ def main():
             "optional": None
         }
 
-        user_input = input(f"You ({my_user_id}): ").strip()
+        # The frame already ends with the prompt. Echoing the line and the
+        # Enter that scrolls the terminal happen behind the renderer's back.
+        user_input = input().strip()
+        RENDERER.invalidate()
         if not user_input:
             continue
         if user_input.lower() == ".exit":
-            tls_socket.send(json.dumps({"action": "EXIT"}).encode('utf-8'))
+            closing = True
+            send_request({"action": "EXIT"})
+            OUTBOX.close(timeout=2)
             print("Disconnecting...")
             break
 
@@ -363,7 +653,7 @@ def main():
             try:
                 parts = user_input.split()
                 if len(parts) < 2:
-                    print("Usage: .delete <message_id>")
+                    show_status("Usage: .delete <message_id>")
                     continue
                 message_id_to_delete = parts[1]
                 data["action"] = "DELETE"
@@ -371,40 +661,33 @@ def main():
                 data["sender"] = my_user_id
                 
                 #tls_socket.send(json.dumps(data).encode('utf-8'))
-                print(f"Delete request sent for message ID {message_id_to_delete}")
+                show_status(f"Delete request sent for message ID {message_id_to_delete}")
             except Exception as e:
-                print("Error processing delete command:", e)
+                show_status(f"Error processing delete command: {e}")
         elif user_input.startswith(".reply"):
             # .reply <msg_id> <message>
             try:
                 msg_id_replied, msg_text = extract_reply_message(user_input)
-                
-                receivers = []
-                private_satus = False
-                for msg in MESSAGES:
-                    if msg['id'] == msg_id_replied:
-                        if msg['sender'] == my_user_id: #Reply yourself
-                            receivers = msg["receiver"][:] + [my_user_id]
-                        else: #Reply other's message
-                            receivers = msg["receiver"][:] + [msg["sender"]]
-                        
-                        private_satus = msg["private"]
 
+                # The server sends it wherever the replied-to message went:
+                # its room, everybody, or its sender and recipients.
                 data["action"] = 'REPLY'
                 data["sender"] = my_user_id
-                data["receiver"] = receivers
+                data["receiver"] = []
                 data["content"] = msg_text
                 data["optional"] = msg_id_replied
-                data["private"] = private_satus
 
             except ValueError:
-                print("Invalid format. Use '@username message' for direct messages.")
+                show_status("Invalid format. Use '@username message' for direct messages.")
                 continue
         elif user_input.startswith(".temp"):
             try:
-                recipient, msg_text = extract_temp_message(user_input)
+                recipient, msg_text, ttl = extract_temp_message(user_input)
 
-                if len(recipient) == 0: #no recipient: PUBLIC
+                if isinstance(recipient, str): # #room
+                    data["room"] = recipient
+                    recipient = []
+                elif len(recipient) == 0: #no recipient: PUBLIC
                     recipient = ["all"]
                 else: # PRIVATE messsage
                     data['private'] = True
@@ -413,20 +696,46 @@ def main():
                 data["sender"] = my_user_id
                 data["receiver"] = recipient
                 data["content"] = msg_text
+                if ttl is not None:
+                    data["ttl"] = ttl
 
-            except ValueError:
-                print("Invalid format. Use '@username message' for direct messages.")
+            except (TypeError, ValueError):
+                show_status("Invalid format. Use '.temp[:seconds] @username message' for temporary messages.")
                 continue
+        elif user_input.startswith(".join") or user_input.startswith(".leave"):
+            parts = user_input.split()
+            if len(parts) != 2:
+                show_status("Usage: .join <room> / .leave <room>")
+                continue
+            data["action"] = "JOIN" if parts[0] == ".join" else "LEAVE"
+            data["sender"] = my_user_id
+            data["room"] = parts[1].lstrip('#')
+        elif user_input.startswith('#') and len(user_input) > 1:
+            room, msg_text = extract_room_message(user_input)
+            data["action"] = 'MESSAGE'
+            data["sender"] = my_user_id
+            data["receiver"] = []
+            data["room"] = room
+            data["content"] = msg_text
+        elif user_input.startswith(".history"):
+            # Older messages than anything we have.
+            data["action"] = "HISTORY"
+            data["sender"] = my_user_id
+            with lock:
+                data["cursor"] = MESSAGES.oldest_id()
+            data["limit"] = HISTORY_LIMIT
         elif user_input.startswith(".search"):
-            try:
-                parts = user_input.split(maxsplit=1)
-                if len(parts) < 2:
-                    print("Usage: .search <keyword>")
-                    continue
-                keyword = parts[1]
-                search_messages(keyword)
-            except Exception as e:
-                print("Error processing search command:", e)
+            parts = user_input.split(maxsplit=1)
+            words, pattern = parse_search(parts[1]) if len(parts) > 1 else ('', None)
+            if not words:
+                show_status("Usage: .search <keywords> [/<pattern>/]")
+                continue
+            data["action"] = "SEARCH"
+            data["sender"] = my_user_id
+            data["content"] = words
+            data["limit"] = SEARCH_LIMIT
+            if pattern:
+                data["pattern"] = pattern
         # Otherwise, treat as a normal message.
         elif user_input.startswith('@'):
             try:
@@ -441,7 +750,7 @@ def main():
                 data["content"] = msg_text
                 data['private'] = True
             except ValueError:
-                print("Invalid format. Use '@username message' for direct messages.")
+                show_status("Invalid format. Use '@username message' for direct messages.")
                 continue
         else:
             recipient = ["all"]
@@ -456,7 +765,7 @@ def main():
         data["time"] = timestamp
 
 
-        tls_socket.send(json.dumps(data).encode('utf-8'))
+        send_request(data)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,325 @@
+# framing.py
+# Wire format shared by server.py and client.py (keep both copies identical).
+#
+# Every message is one frame:
+#   +----------------------+---------------------------+
+#   | length (4 bytes, BE) | payload (UTF-8 JSON)      |
+#   +----------------------+---------------------------+
+# so the receiver never depends on how TCP/TLS happened to split or
+# coalesce the bytes.
+#
+# The payload codec is pluggable: JSON by default (through orjson when it is
+# installed, the stdlib otherwise), or msgpack. Both ends must use the same one.
+#
+# A connection may also agree on compression at login. From then on the
+# bytes of the frames, in both directions, go through one zlib stream per
+# direction and connection, flushed after every write, so key names, user
+# ids and words repeated from earlier frames cost a few bytes each.
+import json
+import struct
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+HEADER = struct.Struct('!I')
+HEADER_SIZE = HEADER.size
+MAX_FRAME_SIZE = 16 * 1024 * 1024   # refuse absurd length prefixes
+RECV_BUFFER_SIZE = 4 * 1024         # per-connection buffer while no large frame is in flight
+RECV_CHUNK_SIZE = 64 * 1024         # read at once on a compressed connection
+COMPRESSIONS = ('zlib',)            # what a connection can ask for at login
+COMPRESS_LEVEL = 1                  # the window does most of the work, 6+ costs more CPU than it saves
+COMPRESS_WBITS = 15                 # 32 KB of history per direction
+COMPRESS_MEM_LEVEL = 6              # ~160 KB per compressing side, ~40 KB per decompressing side
+INFLATE_CHUNK = 256 * 1024          # decompressed at a time, bounds what a small input can expand to
+
+
+class FrameError(ValueError):
+    """An oversized frame or a corrupt compressed stream: bad input, like an undecodable payload."""
+
+
+def encode_frame(payload):
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError(f"Frame of {len(payload)} bytes exceeds {MAX_FRAME_SIZE}")
+    return HEADER.pack(len(payload)) + payload
+
+def _json_dumps(message):
+    return json.dumps(message, separators=(',', ':')).encode('utf-8')
+
+def _json_loads(payload):
+    # str() decodes straight out of the memoryview, no intermediate bytes copy.
+    return json.loads(str(payload, 'utf-8'))
+
+# name -> (dumps(message) -> bytes, loads(bytes-like) -> message)
+CODECS = {'json': (_json_dumps, _json_loads)}
+if orjson is not None:
+    # Same wire format as the stdlib, several times faster both ways.
+    CODECS['json'] = (orjson.dumps, orjson.loads)
+if msgpack is not None:
+    CODECS['msgpack'] = (
+        lambda message: msgpack.packb(message, use_bin_type=True),
+        lambda payload: msgpack.unpackb(payload, raw=False),
+    )
+
+_dumps, _loads = CODECS['json']
+
+def set_codec(name):
+    global _dumps, _loads
+    if name not in CODECS:
+        raise ValueError(f"Codec {name!r} is not available (have: {', '.join(CODECS)})")
+    _dumps, _loads = CODECS[name]
+
+def encode_message(message):
+    return encode_frame(_dumps(message))
+
+def decode_message(frame):
+    return _loads(frame)
+
+def send_message(sock, message):
+    sock.sendall(encode_message(message))
+
+
+class EncodedMessage:
+    """
+    A message serialized exactly once. `frame` is an immutable bytes object,
+    so the same buffer can sit in any number of recipients' send queues.
+    """
+    __slots__ = ('message', 'frame')
+
+    def __init__(self, message):
+        self.message = message
+        self.frame = encode_message(message)
+
+
+class Deflater:
+    """
+    Compressing end of one direction of a connection. Every compress()
+    ends with a sync flush, so the peer can decode all of it right away,
+    but the window carries over from one call to the next.
+    """
+    __slots__ = ('_zlib',)
+
+    def __init__(self, level=COMPRESS_LEVEL):
+        self._zlib = zlib.compressobj(level, zlib.DEFLATED, -COMPRESS_WBITS, COMPRESS_MEM_LEVEL)
+
+    def compress(self, data):
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+
+class Inflater:
+    """
+    Decompressing end. Input is held until read() takes it out, at most
+    INFLATE_CHUNK bytes at a time.
+    """
+    __slots__ = ('_zlib', '_pending')
+
+    def __init__(self):
+        self._zlib = zlib.decompressobj(-COMPRESS_WBITS)
+        self._pending = b''
+
+    @property
+    def pending(self):
+        return bool(self._pending)
+
+    def feed(self, data):
+        self._pending = self._pending + data if self._pending else bytes(data)
+
+    def read(self, max_length=INFLATE_CHUNK):
+        try:
+            data = self._zlib.decompress(self._pending, max_length)
+        except zlib.error as e:
+            raise FrameError(f"Corrupt compressed stream: {e}") from None
+        self._pending = self._zlib.unconsumed_tail
+        return data
+
+
+class FrameBuffer:
+    """
+    Reusable receive buffer for one connection.
+
+    Bytes are read with recv_into() directly into a bytearray and complete
+    frames are handed out as memoryview slices of it, so a read that
+    carries many small frames is split without copying and a large frame
+    is received in place once the buffer has grown to fit it.
+
+    The bytearray is allocated on the first read and starts at `size`
+    bytes. It grows for large frames and goes back to `size` once they
+    are consumed, so idle connections stay cheap.
+
+    Chunks handed to feed() as bytes are split in place too, only a frame
+    left incomplete at the end of one is copied into the buffer.
+
+    After inflate() the received bytes are decompressed on their way in.
+
+    A yielded frame is only valid until the next call on the buffer.
+    """
+
+    def __init__(self, size=RECV_BUFFER_SIZE):
+        self._size = size
+        self._buf = bytearray()
+        self._view = memoryview(self._buf)
+        self._start = 0     # first unconsumed byte
+        self._end = 0       # end of received data
+        self._chunk = None  # fed bytes being split in place, ahead of nothing in _buf
+        self._chunk_start = 0
+        self._inflater = None
+
+    def __len__(self):
+        chunk = len(self._chunk) - self._chunk_start if self._chunk is not None else 0
+        return self._end - self._start + chunk
+
+    def _reserve(self, needed):
+        # Make sure `needed` bytes fit after the unconsumed data.
+        pending = self._end - self._start
+        if self._end + needed <= len(self._buf):
+            return
+        if pending + needed <= len(self._buf):
+            # Slide unconsumed bytes to the front, the slice assignment
+            # keeps the size so outstanding views stay valid. Overlapping
+            # ranges go through a temporary copy.
+            tail = self._view[self._start:self._end]
+            self._buf[:pending] = tail if self._start >= pending else bytes(tail)
+        else:
+            size = max(len(self._buf), self._size)
+            while size < pending + needed:
+                size *= 2
+            buf = bytearray(size)
+            buf[:pending] = self._view[self._start:self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+        self._start = 0
+        self._end = pending
+
+    def _settle(self):
+        # Copy what is left of the fed chunk into the buffer, before
+        # anything else is added behind it.
+        chunk, self._chunk = self._chunk, None
+        if chunk is not None and self._chunk_start < len(chunk):
+            self._append(chunk[self._chunk_start:])
+
+    def _wanted(self):
+        # Bytes we still need to complete the frame at the front, so a large
+        # frame gets room for all of it in one go.
+        pending = self._end - self._start
+        if pending >= HEADER_SIZE:
+            (length,) = HEADER.unpack_from(self._buf, self._start)
+            if length > MAX_FRAME_SIZE:
+                raise FrameError(f"Incoming frame of {length} bytes exceeds {MAX_FRAME_SIZE}")
+            return max(HEADER_SIZE + length - pending, 1)
+        return 1
+
+    def inflate(self, inflater):
+        """
+        The rest of the stream is compressed, starting with whatever is
+        buffered behind the frames already handed out.
+        """
+        self._settle()
+        tail = bytes(self._view[self._start:self._end])
+        self._start = self._end = 0
+        self._inflater = inflater
+        inflater.feed(tail)
+
+    def recv_from(self, sock):
+        """Read once from `sock`. Returns the number of bytes read, 0 on EOF."""
+        if self._inflater is not None:
+            data = sock.recv(RECV_CHUNK_SIZE)
+            self._inflater.feed(data)
+            return len(data)
+        self._settle()
+        self._reserve(max(self._wanted(), self._size))
+        nbytes = sock.recv_into(self._view[self._end:])
+        self._end += nbytes
+        return nbytes
+
+    def feed(self, data):
+        """Append bytes that were read elsewhere (e.g. an asyncio StreamReader)."""
+        if self._inflater is not None:
+            self._inflater.feed(data)
+        elif isinstance(data, bytes) and self._chunk is None and self._start == self._end:
+            # Immutable and nothing in front of it: frames are cut out of
+            # it directly by _split().
+            self._chunk = memoryview(data)
+            self._chunk_start = 0
+        else:
+            self._settle()
+            self._append(data)
+
+    def _append(self, data):
+        self._reserve(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def next_frame(self):
+        """Pop one complete frame payload, or None if it has not fully arrived."""
+        while True:
+            frame = self._split()
+            if frame is not None or self._inflater is None or not self._inflater.pending:
+                return frame
+            # Decompress only as much as it takes to get the next frame out.
+            self._append(self._inflater.read())
+
+    def _split(self):
+        if self._chunk is not None:
+            frame = self._split_chunk()
+            if frame is not None:
+                return frame
+        pending = self._end - self._start
+        if pending < HEADER_SIZE:
+            return None
+        (length,) = HEADER.unpack_from(self._buf, self._start)
+        if length > MAX_FRAME_SIZE:
+            raise FrameError(f"Incoming frame of {length} bytes exceeds {MAX_FRAME_SIZE}")
+        if pending < HEADER_SIZE + length:
+            return None
+        begin = self._start + HEADER_SIZE
+        self._start = begin + length
+        frame = self._view[begin:begin + length]
+        if self._start == self._end:
+            self._start = self._end = 0
+            if len(self._buf) > self._size:
+                # Empty again: let go of what a large frame made it grow
+                # to, the frame handed out keeps its own reference.
+                self._buf = bytearray()
+                self._view = memoryview(self._buf)
+        return frame
+
+    def _split_chunk(self):
+        chunk, start = self._chunk, self._chunk_start
+        if len(chunk) - start >= HEADER_SIZE:
+            (length,) = HEADER.unpack_from(chunk, start)
+            if length > MAX_FRAME_SIZE:
+                raise FrameError(f"Incoming frame of {length} bytes exceeds {MAX_FRAME_SIZE}")
+            begin = start + HEADER_SIZE
+            if len(chunk) - begin >= length:
+                self._chunk_start = begin + length
+                if self._chunk_start == len(chunk):
+                    self._chunk = None
+                return chunk[begin:begin + length]
+        # An incomplete frame at the end, it waits in the buffer for the rest.
+        self._settle()
+        return None
+
+    def frames(self):
+        """Yield every complete frame currently buffered."""
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+
+def recv_message(sock, buffer):
+    """Block until one whole message is buffered and return it decoded (None on EOF)."""
+    while True:
+        frame = buffer.next_frame()
+        if frame is not None:
+            return decode_message(frame)
+        if buffer.recv_from(sock) == 0:
+            return None
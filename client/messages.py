@@ -0,0 +1,67 @@
+# messages.py
+# Client-side message history. Messages are kept in arrival order by id
+# (server ids grow with time) plus an id -> message dict and an index of
+# replies, so DELETE, OUTDATED and reply quoting never scan the history.
+import bisect
+
+
+def message_order(msg):
+    return int(msg['id'])
+
+
+class MessageStore:
+    """Not thread-safe on its own, the client guards it with its lock."""
+
+    def __init__(self):
+        self._ordered = []      # messages sorted by id
+        self._by_id = {}        # id -> message
+        self._replies = {}      # id -> ids of the replies quoting it
+
+    def __len__(self):
+        return len(self._ordered)
+
+    def __iter__(self):
+        return iter(self._ordered)
+
+    def __reversed__(self):
+        return reversed(self._ordered)
+
+    def __contains__(self, msg_id):
+        return msg_id in self._by_id
+
+    def add(self, msg):
+        """Insert a message in id order. Returns False if it is already known."""
+        msg_id = msg['id']
+        if msg_id in self._by_id:
+            return False
+        self._by_id[msg_id] = msg
+        if not self._ordered or message_order(msg) > message_order(self._ordered[-1]):
+            # The usual case: newer than anything we have.
+            self._ordered.append(msg)
+        else:
+            bisect.insort(self._ordered, msg, key=message_order)
+        if msg.get('action') == 'REPLY' and msg.get('optional') is not None:
+            self._replies.setdefault(msg['optional'], []).append(msg_id)
+        return True
+
+    def newest_id(self):
+        return self._ordered[-1]['id'] if self._ordered else None
+
+    def oldest_id(self):
+        return self._ordered[0]['id'] if self._ordered else None
+
+    def newest(self, count):
+        return self._ordered[-count:]
+
+    def get(self, msg_id):
+        return self._by_id.get(msg_id)
+
+    def set_content(self, msg_id, content):
+        """Replace a message's text (removed/expired). Returns the message, or None if unknown."""
+        msg = self._by_id.get(msg_id)
+        if msg is not None:
+            msg['content'] = content
+        return msg
+
+    def replies_to(self, msg_id):
+        return self._replies.get(msg_id, ())
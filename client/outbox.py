@@ -0,0 +1,130 @@
+# outbox.py
+# Client send queue. Callers only enqueue encoded frames; one writer thread
+# takes whatever has piled up and writes it as a single buffer, so a burst
+# of messages (a paste, a script) leaves in a few TLS records instead of
+# one record and one syscall per frame. The queue is bounded, which makes
+# put() block when the connection can't keep up, and the server can pause
+# it with a FLOW frame.
+import threading
+from collections import deque
+
+DEFAULT_LIMIT = 1024            # frames queued before put() blocks
+MAX_BATCH_BYTES = 64 * 1024     # bytes handed to a single write
+
+
+class Outbox:
+    """
+    Frames for the current connection. attach() points the writer at a new
+    socket after a (re)connect, with the framing.Deflater the connection
+    agreed on at login if any; frames queued while disconnected are sent
+    then. A batch that was being written when the connection broke is lost,
+    like a message typed just before it did.
+    """
+
+    def __init__(self, limit=DEFAULT_LIMIT, max_batch_bytes=MAX_BATCH_BYTES):
+        self.limit = limit
+        self.max_batch_bytes = max_batch_bytes
+        self.paused = False
+        self.closed = False
+        self._pauses = 0            # tells a stale retry_after timer apart
+        self._frames = deque()
+        self._sock = None
+        self._deflater = None
+        self._writing = False
+        self._cond = threading.Condition(threading.Lock())
+        # Counters
+        self.sent_frames = 0
+        self.writes = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, frame, timeout=None):
+        """Queue one frame, waiting while the queue is full. Returns False on timeout or once closed."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: len(self._frames) < self.limit or self.closed, timeout):
+                return False
+            if self.closed:
+                return False
+            self._frames.append(frame)
+            self._cond.notify_all()
+            return True
+
+    def attach(self, sock, deflater=None):
+        with self._cond:
+            self._sock = sock
+            self._deflater = deflater
+            self.paused = False
+            self._cond.notify_all()
+
+    def pause(self, paused, retry_after=None):
+        """
+        Server FLOW signal: hold queued frames back until it says otherwise,
+        or with `retry_after` (a rate limit) for that many seconds.
+        """
+        with self._cond:
+            self.paused = paused
+            self._pauses += 1
+            self._cond.notify_all()
+            if paused and retry_after is not None:
+                timer = threading.Timer(retry_after, self._resume, (self._pauses,))
+                timer.daemon = True
+                timer.start()
+
+    def _resume(self, pauses):
+        with self._cond:
+            if self._pauses == pauses:
+                self.paused = False
+                self._cond.notify_all()
+
+    def close(self, timeout=None):
+        """Send what is queued (up to `timeout` seconds), then stop the writer."""
+        with self._cond:
+            self._cond.wait_for(lambda: (not self._frames and not self._writing) or self._sock is None, timeout)
+            self.closed = True
+            self._cond.notify_all()
+
+    def _take_batch(self):
+        batch = []
+        size = 0
+        while self._frames and (not batch or size + len(self._frames[0]) <= self.max_batch_bytes):
+            frame = self._frames.popleft()
+            batch.append(frame)
+            size += len(frame)
+        return batch
+
+    def run(self):
+        """Writer thread body."""
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self.closed or (self._frames and self._sock is not None
+                                                            and not self.paused))
+                if self.closed:
+                    return
+                sock, deflater = self._sock, self._deflater
+                batch = self._take_batch()
+                self._writing = True
+                self._cond.notify_all()     # room for blocked put()s
+            try:
+                data = batch[0] if len(batch) == 1 else b''.join(batch)
+                write_all(sock, data if deflater is None else deflater.compress(data))
+                broken = False
+            except OSError:
+                # The receiver notices the broken connection and reconnects.
+                broken = True
+            with self._cond:
+                self._writing = False
+                if broken and self._sock is sock:
+                    self._sock = None
+                if not broken:
+                    self.sent_frames += len(batch)
+                    self.writes += 1
+                self._cond.notify_all()     # close() may be waiting
+
+
+def write_all(sock, data):
+    # send() may take only part of the buffer; carry on from where it stopped.
+    view = memoryview(data)
+    while view:
+        sent = sock.send(view)
+        view = view[sent:]
@@ -0,0 +1,144 @@
+# renderer.py
+# Incremental terminal renderer for the chat client. Instead of clearing
+# the screen and reprinting the whole history on every event, it keeps the
+# lines currently on screen and only rewrites the rows that changed, using
+# ANSI cursor positioning. Bursts of events are coalesced: request() just
+# marks the screen dirty and a render thread draws at most MAX_FPS frames
+# per second.
+import re
+import shutil
+import sys
+import threading
+import time
+
+MAX_FPS = 30
+CSI = '\033['
+ANSI_ESCAPE = re.compile(r'\033\[[0-9;]*[A-Za-z]')
+
+
+def visible_length(line):
+    return len(ANSI_ESCAPE.sub('', line))
+
+
+def clip(line, columns):
+    """
+    Cut `line` to `columns` visible characters, so it never wraps onto a
+    second row. Escape sequences are kept and a clipped line ends with a
+    reset, a colour started before the cut must not leak into the next row.
+    """
+    if visible_length(line) <= columns:
+        return line
+    out = []
+    width = 0
+    pos = 0
+    for match in ANSI_ESCAPE.finditer(line):
+        text = line[pos:match.start()][:columns - width]
+        out.append(text)
+        width += len(text)
+        if width >= columns:
+            break
+        out.append(match.group())
+        pos = match.end()
+    else:
+        out.append(line[pos:][:columns - width])
+    out.append(f"{CSI}0m")
+    return ''.join(out)
+
+
+class BubbleCache:
+    """Rendered bubble lines by message id, rebuilt only when invalidated."""
+
+    def __init__(self):
+        self._lines = {}
+
+    def get(self, msg_id, build):
+        lines = self._lines.get(msg_id)
+        if lines is None:
+            lines = self._lines[msg_id] = build().split('\n')
+        return lines
+
+    def invalidate(self, msg_id):
+        self._lines.pop(msg_id, None)
+
+    def clear(self):
+        self._lines.clear()
+
+
+class Renderer:
+    """
+    `compose(rows, columns)` returns the lines of one frame, at most `rows`
+    of them. It is called on the render thread with `lock` held, so it can
+    read the client's state directly.
+    """
+
+    def __init__(self, compose, lock, max_fps=MAX_FPS, stream=sys.stdout):
+        self.compose = compose
+        self.lock = lock
+        self.interval = 1 / max_fps
+        self.stream = stream
+        self._screen = None         # lines currently on screen, None = unknown
+        self._size = None
+        self._dirty = threading.Event()
+        self._stale = False         # something else wrote to the terminal
+        self._last_frame = 0.0
+        self.frames = 0
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def request(self):
+        """Ask for a repaint. Cheap and non-blocking, safe from any thread."""
+        self._dirty.set()
+
+    def invalidate(self):
+        """
+        Repaint every row. Call it after writing to the terminal directly
+        (input() echo, print()), which may have scrolled what is on screen.
+        """
+        self._stale = True
+        self._dirty.set()
+
+    def _run(self):
+        while True:
+            self._dirty.wait()
+            # Everything arriving until the next frame slot lands in that frame.
+            delay = self._last_frame + self.interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._dirty.clear()
+            try:
+                self.draw()
+            except Exception as e:
+                print("Error rendering:", e)
+                self._stale = True
+            self._last_frame = time.monotonic()
+
+    def draw(self):
+        size = shutil.get_terminal_size()
+        if size != self._size or self._stale:
+            # Resized or scrolled: the old rows no longer mean anything.
+            self._size = size
+            self._stale = False
+            self._screen = None
+        with self.lock:
+            lines = self.compose(size.lines, size.columns)
+        self.stream.write(self._diff(lines))
+        self.stream.flush()
+        self._screen = lines
+        self.frames += 1
+
+    def _diff(self, lines):
+        old = self._screen
+        out = []
+        if old is None:
+            out.append(f"{CSI}H{CSI}2J")
+            old = []
+        for row, line in enumerate(lines):
+            if row >= len(old) or old[row] != line:
+                out.append(f"{CSI}{row + 1};1H{line}{CSI}K")
+        if len(lines) < len(old):
+            out.append(f"{CSI}{len(lines) + 1};1H{CSI}J")
+        # Leave the cursor behind the prompt on the last line.
+        if lines:
+            out.append(f"{CSI}{len(lines)};{visible_length(lines[-1]) + 1}H")
+        return ''.join(out)
@@ -0,0 +1,156 @@
+# admin.py
+# Local admin endpoint on a Unix-domain socket or a loopback TCP port.
+# Speaks just enough HTTP for a Prometheus scrape or curl:
+#
+#   curl -s localhost:9100/metrics          Prometheus text
+#   curl -s localhost:9100/metrics.json     JSON with percentile estimates
+#
+# and, for nc/socat, one command per connection: "metrics" or "json".
+# More commands can be registered with AdminServer.command(). Commands that
+# change something are only taken as such a line, never over HTTP (where
+# any web page the operator visits could send them), and only when the
+# endpoint is a Unix socket or a loopback address.
+import ipaddress
+import json
+import os
+import socket
+import socketserver
+import threading
+
+DEFAULT_HOST = '127.0.0.1'
+MAX_REQUEST_LINE = 4096
+TIMEOUT = 5     # seconds a client gets to send its request
+
+PROMETHEUS_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+JSON_TYPE = 'application/json'
+
+
+def parse_address(text):
+    """'/path/admin.sock' -> path (Unix socket), '9100' or 'host:9100' -> (host, port)."""
+    if os.sep in text or text.endswith('.sock'):
+        return text
+    host, _, port = text.rpartition(':')
+    return (host or DEFAULT_HOST, int(port))
+
+
+def is_local(address):
+    """Whether only this machine can reach `address`: a Unix socket or a loopback host."""
+    if isinstance(address, str):
+        return True
+    host = address[0]
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def worker_address(address, index):
+    """Every --workers process gets its own endpoint: path.i or port + i."""
+    if isinstance(address, str):
+        return f"{address}.{index}"
+    host, port = address
+    return (host, port + index)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    timeout = TIMEOUT
+
+    def handle(self):
+        try:
+            line = self.rfile.readline(MAX_REQUEST_LINE).decode('latin-1').strip()
+        except (OSError, socket.timeout):
+            return
+        parts = line.split()
+        if len(parts) == 3 and parts[2].startswith('HTTP/'):
+            self._http(parts[0], parts[1])
+        elif parts:
+            status, content_type, body = self.server.admin.dispatch(parts[0], parts[1:], http=False)
+            self.wfile.write(body.encode())
+
+    def _http(self, method, path):
+        # Skip the headers, nothing in them matters here.
+        while self.rfile.readline(MAX_REQUEST_LINE).strip():
+            pass
+        if method != 'GET':
+            status, content_type, body = 405, 'text/plain', "only GET\n"
+        else:
+            path, _, query = path.partition('?')
+            args = [arg for arg in query.split('&') if arg]
+            status, content_type, body = self.server.admin.dispatch(path.strip('/') or 'metrics', args)
+        data = body.encode()
+        reason = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+                  405: 'Method Not Allowed'}.get(status, '')
+        self.wfile.write(f"HTTP/1.0 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class AdminServer:
+    """
+    Serves `registry` (metrics.Registry) at `address`, a Unix socket path
+    or a (host, port) pair. Commands are name -> fn(args) returning
+    (status, content type, body). `mutating` ones are refused over HTTP
+    and on addresses other machines can reach.
+    """
+
+    def __init__(self, address, registry):
+        self.address = address
+        self.registry = registry
+        self.local = is_local(address)
+        self._commands = {}
+        self._server = None
+        self.command('metrics', lambda args: (200, PROMETHEUS_TYPE, registry.render_prometheus()))
+        self.command('metrics.json', self._json)
+        self.command('json', self._json)
+
+    def _json(self, args):
+        return 200, JSON_TYPE, json.dumps(self.registry.snapshot(), indent=1) + '\n'
+
+    def command(self, name, fn, mutating=False):
+        self._commands[name] = fn, mutating
+
+    def dispatch(self, name, args, http=True):
+        fn, mutating = self._commands.get(name, (None, False))
+        if fn is None:
+            return 404, 'text/plain', f"unknown command {name!r}, try: {', '.join(sorted(self._commands))}\n"
+        if mutating and not self.local:
+            return 403, 'text/plain', f"{name} is only allowed on a Unix socket or a loopback address\n"
+        if mutating and http:
+            return 405, 'text/plain', f"{name} is not available over HTTP, send it as a line: {name} ARGS\n"
+        try:
+            return fn(args)
+        except ValueError as e:
+            return 400, 'text/plain', f"{e}\n"
+
+    def start(self):
+        if isinstance(self.address, str):
+            try:
+                os.unlink(self.address)     # left over from an earlier run
+            except FileNotFoundError:
+                pass
+            self._server = _UnixServer(self.address, _Handler)
+            os.chmod(self.address, 0o600)
+        else:
+            self._server = _TCPServer(self.address, _Handler)
+        self._server.admin = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            if isinstance(self.address, str):
+                try:
+                    os.unlink(self.address)
+                except OSError:
+                    pass
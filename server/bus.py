@@ -0,0 +1,153 @@
+# bus.py
+# Local message bus for `--workers N`. The parent process runs a BusHub on
+# a Unix-domain socket; every worker connects a BusClient to it. Whatever
+# one worker publishes is relayed to all the others, so each worker can
+# deliver messages and presence changes to the clients it holds.
+#
+# Bus frames use the same length prefix as the client protocol and always
+# carry JSON, whatever codec clients use.
+#
+# The first frame a worker sends is its will: the hub keeps it and relays
+# it to the others once that worker's connection closes, so they can drop
+# whatever they hold on its behalf even when it died without a word.
+import socket
+import threading
+import time
+
+from framing import CODECS, FrameBuffer, encode_frame
+from logs import get_logger
+from outbound import DROP_OLDEST, OutboundQueue, socket_writer
+
+# Events are relayed, not stored, so a worker that stops reading would only
+# lose the oldest ones instead of stalling everybody else.
+BUS_QUEUE_LIMIT = 1_000_000
+CONNECT_TIMEOUT = 10
+
+_dumps, _loads = CODECS['json']
+log = get_logger('bus')
+
+
+def encode_event(event):
+    return encode_frame(_dumps(event))
+
+
+def _read_frames(sock, on_frame):
+    buffer = FrameBuffer()
+    while buffer.recv_from(sock):
+        for frame in buffer.frames():
+            on_frame(frame)
+
+
+class BusHub:
+    """Relay between worker processes. bind() before forking, start() after."""
+
+    def __init__(self, path):
+        self.path = path
+        self._server = None
+        self._peers = []    # OutboundQueue per connected worker
+        self._lock = threading.Lock()   # peers list and relay order
+        self.relayed = 0
+
+    def bind(self, backlog=64):
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.path)
+        self._server.listen(backlog)
+
+    def fileno(self):
+        return self._server.fileno()
+
+    def close_in_child(self):
+        # Workers inherit the listening socket across fork, they must not keep it.
+        self._server.close()
+
+    def start(self):
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def _accept_loop(self):
+        while True:
+            conn, _ = self._server.accept()
+            queue = OutboundQueue(limit=BUS_QUEUE_LIMIT, policy=DROP_OLDEST)
+            with self._lock:
+                self._peers.append(queue)
+            threading.Thread(target=socket_writer, args=(queue, conn), daemon=True).start()
+            threading.Thread(target=self._relay, args=(conn, queue), daemon=True).start()
+
+    def _relay(self, conn, own_queue):
+        will = []
+
+        def forward(frame):
+            if not will:
+                will.append(None if _loads(frame) is None else encode_frame(bytes(frame)))
+                return
+            # Re-framed once, the same bytes go to every other worker. The
+            # lock makes each relay reach all peers before any reaction to
+            # it can, so e.g. a DELETE never overtakes the message it removes.
+            self._broadcast(encode_frame(bytes(frame)), own_queue)
+        try:
+            _read_frames(conn, forward)
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self._lock:
+                self._peers = [q for q in self._peers if q is not own_queue]
+            own_queue.close()
+            conn.close()
+            if will and will[0] is not None:
+                log.warning('bus_peer_gone')
+                self._broadcast(will[0], own_queue)
+
+    def _broadcast(self, data, own_queue):
+        with self._lock:
+            for queue in self._peers:
+                if queue is not own_queue:
+                    queue.put(data)
+            self.relayed += 1
+
+
+class BusClient:
+    """
+    One worker's connection to the hub. on_event(event) runs on the reader
+    thread. `will` is the event the others get once this connection is gone.
+    """
+
+    def __init__(self, path, on_event, will=None):
+        self.path = path
+        self.on_event = on_event
+        self._sock = None
+        self._queue = OutboundQueue(limit=BUS_QUEUE_LIMIT, policy=DROP_OLDEST)
+        self._queue.put(encode_event(will))
+
+    def connect(self, timeout=CONNECT_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                break
+            except OSError:
+                sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        self._sock = sock
+        threading.Thread(target=socket_writer, args=(self._queue, sock), daemon=True).start()
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def publish(self, event):
+        self._queue.put(encode_event(event))
+
+    def _read_loop(self):
+        def handle(frame):
+            try:
+                self.on_event(_loads(frame))
+            except Exception as e:
+                log.error('bus_event_failed', error=e)
+        try:
+            _read_frames(self._sock, handle)
+        except OSError as e:
+            log.error('bus_lost', error=e)
+        else:
+            log.warning('bus_closed')
+
+    def stats(self):
+        return self._queue.stats()
@@ -0,0 +1,167 @@
+# coldstore.py
+# On-disk cold tier of the message store, in an SQLite file. It holds the
+# messages that were spilled out of RAM, with everything needed to page
+# them back in without scanning: the encoded record by id, the mailbox and
+# room timeline entries by (owner, folder, id), removal/expiry times, and a
+# full-text index for SEARCH. It is a cache of what the server holds, not
+# a second source of truth (that is msglog), so it is opened empty on every
+# start and written without journaling or fsync.
+import json
+import os
+import sqlite3
+import threading
+
+from rooms import PUBLIC
+
+SEND, RECEIVE, ROOM = 0, 1, 2   # folder codes
+
+SCHEMA = """
+CREATE TABLE messages (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE folders (owner TEXT NOT NULL, folder INTEGER NOT NULL, id INTEGER NOT NULL,
+                      PRIMARY KEY (owner, folder, id)) WITHOUT ROWID;
+CREATE TABLE changes (changed INTEGER NOT NULL, id INTEGER NOT NULL,
+                      PRIMARY KEY (changed, id)) WITHOUT ROWID;
+CREATE VIRTUAL TABLE words USING fts5(content, audience, room, content='',
+                                      tokenize="unicode61 tokenchars '_'");
+"""
+
+
+def _phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _room_text(room):
+    # The tokenizer drops '*': the public timeline is indexed as "all".
+    # That matches a room named "all" as well, but every hit is checked
+    # for visibility again anyway.
+    return 'all' if room == PUBLIC else room
+
+
+def match_query(words, user_id, rooms=()):
+    """FTS query: every word in the content, and the user in the audience or one of `rooms`."""
+    visible = [f"audience:{_phrase(user_id)}"] + [f"room:{_phrase(_room_text(room))}" for room in rooms]
+    terms = [f"content:{_phrase(word)}" for word in sorted(words)]
+    return ' AND '.join(terms) + ' AND (' + ' OR '.join(visible) + ')'
+
+
+class ColdStore:
+    """One SQLite connection shared by all threads under a lock."""
+
+    def __init__(self, path):
+        self.path = path
+        for suffix in ('', '-journal', '-wal', '-shm'):
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=OFF")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        # Counters
+        self.messages = 0
+        self.reads = 0
+        self.writes = 0
+
+    def __len__(self):
+        return self.messages
+
+    def add(self, rows):
+        """
+        Store spilled messages. `rows` are (id, data, entries, content,
+        audience, room) with `entries` the (owner, folder) pairs filing it.
+        """
+        if not rows:
+            return
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                # A message relayed twice is only indexed once. The same SQL
+                # for every batch size: each distinct text is another cached
+                # statement.
+                keys = [row[0] for row in rows]
+                stored = {key for key, in self._db.execute(
+                    "SELECT id FROM messages WHERE id >= ? AND id <= ?", (min(keys), max(keys)))}
+                stored.intersection_update(keys)
+                self._db.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?)",
+                                     ((key, data) for key, data, *_ in rows))
+                self._db.executemany("INSERT OR IGNORE INTO folders VALUES (?, ?, ?)",
+                                     ((owner, folder, key) for key, _, entries, *_ in rows
+                                      for owner, folder in entries))
+                self._db.executemany("INSERT INTO words (rowid, content, audience, room) VALUES (?, ?, ?, ?)",
+                                     ((key, content, audience, _room_text(room or ''))
+                                      for key, _, _, content, audience, room in rows if key not in stored))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self.messages += len(rows) - len(stored)
+            self.writes += 1
+
+    def update(self, key, data):
+        """Write back a changed message. Its words stay indexed as they were first stored."""
+        with self._lock:
+            self._db.execute("UPDATE messages SET data = ? WHERE id = ?", (data, key))
+            self.writes += 1
+
+    def add_changes(self, changes):
+        """(changed, id) pairs of removals and expiries."""
+        with self._lock:
+            self._db.executemany("INSERT OR IGNORE INTO changes VALUES (?, ?)", changes)
+            self.writes += 1
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT data FROM messages WHERE id = ?", (key,)).fetchone()
+            self.reads += 1
+        return row[0] if row is not None else None
+
+    def get_many(self, keys):
+        """id -> data for those of `keys` that are stored."""
+        with self._lock:
+            self.reads += 1
+            return dict(self._db.execute("SELECT id, data FROM messages WHERE id IN (SELECT value FROM json_each(?))",
+                                         (json.dumps(list(keys)),)))
+
+    def folder(self, owner, folder, before=None, after=None, limit=50):
+        """Ids filed under (owner, folder) strictly between `after` and `before`, newest first."""
+        query = "SELECT id FROM folders WHERE owner = ? AND folder = ?"
+        params = [owner, folder]
+        if before is not None:
+            query += " AND id < ?"
+            params.append(before)
+        if after is not None:
+            query += " AND id > ?"
+            params.append(after)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            self.reads += 1
+            return [key for key, in self._db.execute(query, params)]
+
+    def changed_between(self, since, until):
+        """Ids of messages changed after snowflake `since`, up to and including `until`."""
+        with self._lock:
+            self.reads += 1
+            return [key for key, in self._db.execute(
+                "SELECT id FROM changes WHERE changed > ? AND changed <= ? ORDER BY changed", (since, until))]
+
+    def search(self, match, low, high, limit):
+        """Ids in [low, high) matching the FTS query `match`, newest first."""
+        with self._lock:
+            self.reads += 1
+            return [key for key, in self._db.execute(
+                "SELECT rowid FROM words WHERE words MATCH ? AND rowid >= ? AND rowid < ? "
+                "ORDER BY rowid DESC LIMIT ?", (match, low, high, limit))]
+
+    def size(self):
+        """Bytes on disk (the file may already be unlinked)."""
+        with self._lock:
+            (pages,), = self._db.execute("PRAGMA page_count")
+            (page_size,), = self._db.execute("PRAGMA page_size")
+        return pages * page_size
+
+    def close(self):
+        with self._lock:
+            self._db.close()
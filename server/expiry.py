@@ -0,0 +1,83 @@
+# expiry.py
+# Deadline scheduler for TEMPORARY messages. Instead of sweeping the whole
+# history every few seconds, each message is pushed on a min-heap keyed by
+# its expiry time and a single thread sleeps until the earliest deadline.
+import heapq
+import itertools
+import math
+import threading
+import time
+
+from logs import get_logger
+
+log = get_logger('expiry')
+
+
+class ExpiryScheduler:
+    """
+    schedule() and the pop in run() are O(log n). cancel() is O(1): the
+    heap entry is left in place and skipped when it comes up.
+    `lag` (optional, a metrics.Histogram) records how late each callback ran.
+    """
+
+    def __init__(self, on_expire, clock=time.monotonic, lag=None):
+        self.on_expire = on_expire
+        self.clock = clock
+        self.lag = lag
+        self._heap = []             # (deadline, seq, key)
+        self._deadlines = {}        # key -> deadline of its live entry
+        self._seq = itertools.count()
+        self._cond = threading.Condition(threading.Lock())
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def schedule(self, key, ttl):
+        """
+        Fire on_expire(key) `ttl` seconds from now. Rescheduling a key
+        replaces it. A NaN or infinite `ttl` raises ValueError: its heap
+        entry would never come due and hold up every entry behind it.
+        """
+        if not math.isfinite(ttl):
+            raise ValueError(f"ttl must be a finite number of seconds, got {ttl!r}")
+        deadline = self.clock() + ttl
+        with self._cond:
+            self._deadlines[key] = deadline
+            heapq.heappush(self._heap, (deadline, next(self._seq), key))
+            # Only an entry that became the earliest changes how long run() sleeps.
+            if self._heap[0][2] == key:
+                self._cond.notify()
+        return deadline
+
+    def cancel(self, key):
+        with self._cond:
+            return self._deadlines.pop(key, None) is not None
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(self._heap)
+            if self._deadlines.get(key) == deadline:
+                del self._deadlines[key]
+                due.append((key, deadline))
+        return due
+
+    def run(self):
+        """Scheduler thread body."""
+        while True:
+            with self._cond:
+                while True:
+                    now = self.clock()
+                    due = self._pop_due(now)
+                    if due:
+                        break
+                    timeout = self._heap[0][0] - now if self._heap else None
+                    self._cond.wait(timeout)
+            # Callbacks run without holding the scheduler lock.
+            for key, deadline in due:
+                if self.lag is not None:
+                    self.lag.observe(self.clock() - deadline)
+                try:
+                    self.on_expire(key)
+                except Exception as e:
+                    log.error('expire_failed', key=key, error=e)
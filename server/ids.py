@@ -0,0 +1,77 @@
+# ids.py
+# Snowflake-style 64-bit IDs: | 41 bits ms since EPOCH | 10 bits node | 12 bits sequence |
+# Unique without remembering every ID ever handed out, and they sort by
+# creation time, so a plain numeric sort (or append) keeps history ordered.
+import threading
+import time
+
+EPOCH_MS = 1735689600000        # 2025-01-01T00:00:00Z
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+MAX_NODE = (1 << NODE_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+ID_ALPHABET = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+class SnowflakeGenerator:
+    """
+    Thread-safe generator for one node. It only holds its own tiny lock for
+    a couple of integer updates, never the server's state lock.
+    """
+
+    def __init__(self, node=0, clock=time.time):
+        if not 0 <= node <= MAX_NODE:
+            raise ValueError(f"node must be within 0..{MAX_NODE}")
+        self.node = node
+        self.clock = clock
+        self._last_ms = 0
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        now_ms = int(self.clock() * 1000) - EPOCH_MS
+        with self._lock:
+            if now_ms > self._last_ms:
+                self._last_ms = now_ms
+                self._sequence = 0
+            else:
+                # Same millisecond, or the wall clock went backwards: keep
+                # counting from the last timestamp so IDs stay monotonic. A
+                # full sequence borrows the next millisecond.
+                self._sequence += 1
+                if self._sequence > MAX_SEQUENCE:
+                    self._last_ms += 1
+                    self._sequence = 0
+            return (self._last_ms << (NODE_BITS + SEQUENCE_BITS)) | (self.node << SEQUENCE_BITS) | self._sequence
+
+    def observe(self, existing_id):
+        """Never hand out anything at or below `existing_id` (e.g. recovered from disk)."""
+        existing_ms = int(existing_id) >> (NODE_BITS + SEQUENCE_BITS)
+        with self._lock:
+            if existing_ms >= self._last_ms:
+                self._last_ms = existing_ms
+                self._sequence = MAX_SEQUENCE
+
+
+def id_timestamp(snowflake_id):
+    """Creation time of an ID, in seconds since the Unix epoch."""
+    return ((int(snowflake_id) >> (NODE_BITS + SEQUENCE_BITS)) + EPOCH_MS) / 1000
+
+
+def id_floor(timestamp):
+    """Smallest ID that can be created at Unix time `timestamp`: turns time ranges into ID ranges."""
+    return max(int(timestamp * 1000) - EPOCH_MS, 0) << (NODE_BITS + SEQUENCE_BITS)
+
+
+def id_node(snowflake_id):
+    """Node number of the generator that handed out an ID."""
+    return (int(snowflake_id) >> SEQUENCE_BITS) & MAX_NODE
+
+
+def to_base36(number):
+    digits = []
+    while True:
+        number, rest = divmod(number, 36)
+        digits.append(ID_ALPHABET[rest])
+        if not number:
+            return ''.join(reversed(digits))
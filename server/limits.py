@@ -0,0 +1,204 @@
+# limits.py
+# Admission control: token buckets that pace requests and logins per user
+# and per IP address, caps on open connections, and the overload flag the
+# server raises when its queues or event loop fall behind. Every limit has
+# a name and can be changed while the server runs:
+#
+#   message=20:40        requests per second (and burst) per user
+#   message_ip=100:200   the same, summed over every user of an IP address
+#   login=5:20           logins per second (and burst) per IP address
+#   login_user=1:5       logins per second (and burst) per username
+#   connections=10000    connections open at once
+#   connections_ip=50    connections open at once per IP address
+#   shed_lag=0.5         seconds of event loop lag that mean overload
+#   shed_queued=200000   frames queued for clients that mean overload
+#
+# 0 turns a limit off, which is where they all start.
+import threading
+import time
+
+RATES = ('message', 'message_ip', 'login', 'login_user')
+CAPS = ('connections', 'connections_ip')
+THRESHOLDS = ('shed_lag', 'shed_queued')
+NAMES = RATES + CAPS + THRESHOLDS
+
+PRUNE_INTERVAL = 10         # seconds between sweeps for idle buckets
+BUSY_RETRY = 2.0            # seconds a connection turned away should wait before trying again
+
+
+class RateLimiter:
+    """
+    One token bucket per key, all refilling at `rate` tokens per second up
+    to `burst`. A rate of 0 lets everything through. A bucket that filled
+    up again is no different from a new one, so idle keys are forgotten
+    now and then and a crowd of one-off addresses costs nothing for long.
+    """
+
+    def __init__(self, rate=0, burst=0):
+        self.rate = 0.0
+        self.burst = 0.0
+        self._buckets = {}      # key -> [tokens, time of last refill]
+        self._lock = threading.Lock()
+        self._pruned = time.monotonic()
+        self.configure(rate, burst)
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def configure(self, rate, burst=0):
+        """New rate and burst (default: one second's worth, at least 1)."""
+        if rate < 0 or burst < 0:
+            raise ValueError("rate and burst must not be negative")
+        with self._lock:
+            self.rate = float(rate)
+            self.burst = float(burst) if burst else max(self.rate, 1.0)
+            self._buckets.clear()
+
+    def take(self, key, now=None):
+        """
+        Take a token from `key`'s bucket. Returns 0 if there was one, else
+        the seconds until there will be (and takes nothing).
+        """
+        if not self.rate:
+            return 0.0
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if now - self._pruned >= PRUNE_INTERVAL:
+                self._prune(now)
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / self.rate
+
+    def refund(self, key):
+        """Give back a token take() handed out, for a request something else held back."""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket[0] = min(self.burst, bucket[0] + 1)
+
+    def _prune(self, now):
+        self._pruned = now
+        full = [key for key, (tokens, stamp) in self._buckets.items()
+                if tokens + (now - stamp) * self.rate >= self.burst]
+        for key in full:
+            del self._buckets[key]
+
+    def setting(self):
+        if not self.rate:
+            return 0
+        return f"{self.rate:g}:{self.burst:g}"
+
+
+class AdmissionControl:
+    """
+    The limits of one server process, looked up by name (see the top of
+    this file). admit()/release() keep count of open connections per
+    address; `overloaded` is set by whoever watches the load.
+    """
+
+    def __init__(self):
+        self.rates = {name: RateLimiter() for name in RATES}
+        self.connections = 0            # caps, 0: unlimited
+        self.connections_ip = 0
+        self.shed_lag = 0.0             # overload thresholds, 0: off
+        self.shed_queued = 0
+        self.overloaded = False
+        self.open = 0
+        self._open_by_ip = {}
+        self._lock = threading.Lock()
+
+    def set(self, name, value):
+        """Change one limit from its text form ("20", "20:40"). Raises ValueError."""
+        if name in RATES:
+            rate, _, burst = value.partition(':')
+            self.rates[name].configure(float(rate), float(burst or 0))
+        elif name in CAPS:
+            count = int(value)
+            if count < 0:
+                raise ValueError(f"{name} must not be negative")
+            setattr(self, name, count)
+        elif name in THRESHOLDS:
+            threshold = float(value) if name == 'shed_lag' else int(value)
+            if threshold < 0:
+                raise ValueError(f"{name} must not be negative")
+            setattr(self, name, threshold)
+        else:
+            raise ValueError(f"unknown limit {name!r}, try: {', '.join(NAMES)}")
+
+    def update(self, assignments):
+        """Apply "name=value" strings, all or (on the first bad one) none."""
+        pairs = []
+        for assignment in assignments:
+            name, sep, value = assignment.partition('=')
+            if not sep or name not in NAMES:
+                raise ValueError(f"expected name=value with name one of {', '.join(NAMES)}, got {assignment!r}")
+            pairs.append((name, value))
+        # Parse everything before changing anything.
+        trial = AdmissionControl()
+        for name, value in pairs:
+            trial.set(name, value)
+        for name, value in pairs:
+            self.set(name, value)
+
+    def settings(self):
+        values = {name: self.rates[name].setting() for name in RATES}
+        values.update((name, getattr(self, name)) for name in CAPS + THRESHOLDS)
+        return values
+
+    def admit(self, ip):
+        """
+        Count a new connection from `ip` in, or say why not: returns None,
+        or ('capacity' | 'per_ip' | 'overload', seconds to wait).
+        """
+        with self._lock:
+            if self.overloaded:
+                return 'overload', BUSY_RETRY
+            if self.connections and self.open >= self.connections:
+                return 'capacity', BUSY_RETRY
+            count = self._open_by_ip.get(ip, 0)
+            if self.connections_ip and count >= self.connections_ip:
+                return 'per_ip', BUSY_RETRY
+            self.open += 1
+            self._open_by_ip[ip] = count + 1
+        return None
+
+    def release(self, ip):
+        with self._lock:
+            self.open -= 1
+            count = self._open_by_ip.pop(ip) - 1
+            if count:
+                self._open_by_ip[ip] = count
+
+    def request_delay(self, user_id, ip):
+        """
+        Seconds a request from `user_id` at `ip` has to wait for its turn
+        (0 if it may go now) and the name of the limit that holds it back.
+        Nothing is taken from a bucket for a request that has to wait.
+        """
+        wait = self.rates['message'].take(user_id)
+        if wait:
+            return wait, 'message'
+        wait = self.rates['message_ip'].take(ip)
+        if wait:
+            self.rates['message'].refund(user_id)
+            return wait, 'message_ip'
+        return 0.0, None
+
+    def login_delay(self, ip, username):
+        """Like request_delay() for a login attempt."""
+        wait = self.rates['login'].take(ip)
+        if wait:
+            return wait, 'login'
+        wait = self.rates['login_user'].take(str(username))
+        if wait:
+            self.rates['login'].refund(ip)
+            return wait, 'login_user'
+        return 0.0, None
@@ -0,0 +1,130 @@
+# logs.py
+# Structured, rate-limited server logging on top of the logging module.
+# Every line is an event name plus fields, as logfmt text or JSON, and each
+# event name gets at most BURST lines per INTERVAL: during a failure storm
+# (thousands of clients dropping at once) the log costs a few lines a
+# second instead of becoming the bottleneck itself. What was held back is
+# counted and reported on the event's next line.
+import json
+import logging
+import sys
+import threading
+import time
+
+INTERVAL = 1.0      # seconds
+BURST = 10          # lines per event name per interval
+FORMATS = ('text', 'json')
+
+# Fields added to every line, e.g. the worker index in --workers mode.
+_context = {}
+
+
+def set_context(**fields):
+    _context.update(fields)
+
+
+class EventLogger:
+    """log.info('client_disconnected', address=addr) and friends."""
+    __slots__ = ('_logger',)
+
+    def __init__(self, logger):
+        self._logger = logger
+
+    def _log(self, level, event, fields):
+        if self._logger.isEnabledFor(level):
+            self._logger.log(level, event, extra={'fields': fields})
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self._log(logging.ERROR, event, fields)
+
+
+def get_logger(name):
+    return EventLogger(logging.getLogger(f"chat.{name}"))
+
+
+class RateLimitFilter(logging.Filter):
+    """At most `burst` records per event name per `interval` seconds."""
+
+    def __init__(self, burst=BURST, interval=INTERVAL, on_suppress=None, clock=time.monotonic):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.on_suppress = on_suppress
+        self.clock = clock
+        self._windows = {}      # event -> [window start, lines, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        now = self.clock()
+        with self._lock:
+            window = self._windows.get(record.msg)
+            if window is None:
+                window = self._windows[record.msg] = [now, 0, 0]
+            elif now - window[0] >= self.interval:
+                if window[2]:
+                    record.suppressed = window[2]
+                window[:] = [now, 0, 0]
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+        if self.on_suppress is not None:
+            self.on_suppress()
+        return False
+
+
+def _fields(record):
+    fields = dict(_context)
+    fields.update(getattr(record, 'fields', None) or {})
+    suppressed = getattr(record, 'suppressed', None)
+    if suppressed:
+        fields['suppressed'] = suppressed
+    return fields
+
+
+def _timestamp(record):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f".{int(record.msecs):03d}Z"
+
+
+def _logfmt_value(value):
+    text = str(value)
+    if not text or any(c in text for c in ' "=\\\n'):
+        return json.dumps(text)
+    return text
+
+
+class TextFormatter(logging.Formatter):
+    """ts level=info event=name key=value ... (logfmt)"""
+
+    def format(self, record):
+        parts = [_timestamp(record), f"level={record.levelname.lower()}", f"event={record.msg}"]
+        parts.extend(f"{key}={_logfmt_value(value)}" for key, value in _fields(record).items())
+        return ' '.join(parts)
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {'ts': _timestamp(record), 'level': record.levelname.lower(), 'event': record.msg}
+        entry.update(_fields(record))
+        return json.dumps(entry, default=str)
+
+
+def configure(level='info', fmt='text', stream=None, on_suppress=None, burst=BURST, interval=INTERVAL):
+    """Route every chat.* logger to `stream` (stdout), rate limited."""
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+    handler.addFilter(RateLimitFilter(burst, interval, on_suppress))
+    root = logging.getLogger('chat')
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
+    root.propagate = False
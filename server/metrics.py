@@ -0,0 +1,221 @@
+# metrics.py
+# In-process counters, gauges and fixed-bucket histograms, rendered as
+# Prometheus text or JSON by the admin endpoint (admin.py). Recording is a
+# bisect plus a few additions under a per-metric lock, cheap enough for
+# every request; gauges are callbacks evaluated only when scraped.
+import bisect
+import math
+import threading
+import time
+
+# Seconds, from 100 µs up to 10 s.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Counts (fan-out sizes, queue depths).
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+
+class Counter:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def sample(self):
+        return self.value
+
+
+class Gauge:
+    """Current value computed by `fn` at scrape time."""
+    __slots__ = ('fn',)
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def sample(self):
+        return self.fn()
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)     # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """Context manager observing the seconds spent in its body."""
+        return _Timer(self)
+
+    def sample(self):
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+    def quantile(self, q, counts=None):
+        """Estimate from the buckets: upper bound of the bucket holding the q-th value."""
+        counts = counts if counts is not None else self.sample()[0]
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for bound, n in zip(self.bounds + (math.inf,), counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return math.inf
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class TimedLock:
+    """
+    Wraps a Lock/RLock and records how long contended acquisitions waited.
+    Uncontended ones take the lock without a clock read or an observation.
+    """
+    __slots__ = ('_lock', '_wait')
+
+    def __init__(self, lock, wait):
+        self._lock = lock
+        self._wait = wait
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self._lock.acquire(True, timeout)
+        self._wait.observe(time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+def _label_text(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Registry:
+    """
+    Metric families by name; each family holds one metric per label set.
+    counter()/histogram()/gauge() return the existing metric for the same
+    name and labels, so callers can look them up once and keep them.
+    """
+
+    def __init__(self):
+        self._families = {}     # name -> [type, help, {labels tuple: metric}]
+        self._lock = threading.Lock()
+
+    def _get(self, kind, name, help, labels, factory):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._families.setdefault(name, [kind, help, {}])
+            if family[0] != kind:
+                raise ValueError(f"{name} is already registered as a {family[0]}")
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = factory()
+            return metric
+
+    def counter(self, name, help, **labels):
+        return self._get(COUNTER, name, help, labels, Counter)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        return self._get(HISTOGRAM, name, help, labels, lambda: Histogram(buckets))
+
+    def gauge(self, name, help, fn, **labels):
+        return self._get(GAUGE, name, help, labels, lambda: Gauge(fn))
+
+    def _collect(self):
+        with self._lock:
+            return [(name, kind, help, list(metrics.items()))
+                    for name, (kind, help, metrics) in sorted(self._families.items())]
+
+    def render_prometheus(self):
+        """Prometheus text exposition format, version 0.0.4."""
+        lines = []
+        for name, kind, help, metrics in self._collect():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in metrics:
+                if kind != HISTOGRAM:
+                    lines.append(f"{name}{_label_text(labels)} {_number(metric.sample())}")
+                    continue
+                counts, total, count = metric.sample()
+                cumulative = 0
+                for bound, n in zip(metric.bounds + (math.inf,), counts):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{_label_text(labels, [('le', _number(bound))])} {cumulative}")
+                lines.append(f"{name}_sum{_label_text(labels)} {_number(total)}")
+                lines.append(f"{name}_count{_label_text(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """Everything as plain data for JSON, histograms with p50/p99/p999 estimates."""
+        result = {}
+        for name, kind, help, metrics in self._collect():
+            values = []
+            for labels, metric in metrics:
+                entry = {'labels': dict(labels)}
+                if kind == HISTOGRAM:
+                    counts, total, count = metric.sample()
+                    entry.update(count=count, sum=total)
+                    for label, q in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999)):
+                        estimate = metric.quantile(q, counts)
+                        entry[label] = None if estimate in (None, math.inf) else estimate
+                else:
+                    entry['value'] = metric.sample()
+                values.append(entry)
+            result[name] = {'type': kind, 'help': help, 'values': values}
+        return result
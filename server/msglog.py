@@ -0,0 +1,363 @@
+# msglog.py
+# Durable, segmented, append-only log of server state changes.
+#
+#   <data_dir>/00000001.log, 00000002.log, ...
+#
+# Each entry is   | length (4B) | crc32 (4B) | JSON payload |
+# Appends only encode the entry and hand it to a background writer that
+# commits whatever has piled up with a single write() + fsync() (group
+# commit). Segments are rolled at SEGMENT_BYTES. Once enough of the log is
+# dead (updates, which fold into the message they change, and superseded
+# user entries), the sealed segments are compacted into one holding only
+# the final state of every user and message. Startup recovery mmaps the
+# segments and streams their entries, in order, to a callback.
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from framing import CODECS
+from logs import get_logger
+
+ENTRY_HEADER = struct.Struct('!II')
+SEGMENT_BYTES = 64 * 1024 * 1024
+COMMIT_INTERVAL = 0.005         # max seconds an append waits for its fsync
+COMPACT_INTERVAL = 300          # seconds between compaction checks
+COMPACT_RATIO = 0.5             # dead fraction of the entries that makes compaction worth it
+COMPACT_MIN_DEAD = 10000        # ... and how many dead entries at least
+COMPACTED = {'op': 'compacted'}  # first entry of a compacted segment: older segments are covered
+SUFFIX = '.log'
+
+_dumps, _loads = CODECS['json']
+log = get_logger('msglog')
+
+
+def encode_entry(entry):
+    payload = _dumps(entry)
+    return ENTRY_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_entries(path):
+    """
+    Yield (entry, end_offset) for every intact entry of a segment. Stops at
+    the first torn or corrupted entry, which can only be an unfinished tail.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            offset = 0
+            while offset + ENTRY_HEADER.size <= size:
+                length, crc = ENTRY_HEADER.unpack_from(mm, offset)
+                start = offset + ENTRY_HEADER.size
+                end = start + length
+                if end > size:
+                    break
+                payload = view[start:end]
+                if zlib.crc32(payload) != crc:
+                    break
+                entry = _loads(payload)
+                del payload
+                offset = end
+                yield entry, offset
+        finally:
+            view.release()
+
+
+def apply_entry(entry, users, records):
+    """
+    Fold one log entry into `users` (user_id -> latest user entry) and `records`
+    (message id -> entry dict, insertion ordered), for tools that want the
+    whole state at once.
+    """
+    op = entry.get('op')
+    if op == 'user':
+        users[entry['user_id']] = entry
+    elif op == 'add':
+        records[entry['id']] = entry
+    elif op == 'update':
+        record = records.get(entry['id'])
+        if record is not None:
+            record.update(entry['fields'])
+
+
+def segment_numbers(data_dir):
+    numbers = []
+    for name in os.listdir(data_dir):
+        if name.endswith(SUFFIX) and name[:-len(SUFFIX)].isdigit():
+            numbers.append(int(name[:-len(SUFFIX)]))
+    return sorted(numbers)
+
+
+def live_segments(data_dir, numbers):
+    """
+    The segments that still count: everything from the newest compacted one
+    on. Older ones are only left over from a compaction interrupted before
+    it could remove them.
+    """
+    for i in range(len(numbers) - 1, 0, -1):
+        path = os.path.join(data_dir, f"{numbers[i]:08d}{SUFFIX}")
+        if next((entry for entry, _ in read_entries(path)), None) == COMPACTED:
+            return numbers[i:]
+    return numbers
+
+
+def load_dir(data_dir, apply):
+    """
+    Replay another process's log directory without opening it for writing
+    (e.g. a sibling worker's): like recover(), `apply(entry)` for every entry.
+    """
+    for number in live_segments(data_dir, segment_numbers(data_dir)):
+        for entry, _ in read_entries(os.path.join(data_dir, f"{number:08d}{SUFFIX}")):
+            apply(entry)
+
+
+class MessageLog:
+
+    def __init__(self, data_dir, segment_bytes=SEGMENT_BYTES, commit_interval=COMMIT_INTERVAL):
+        self.data_dir = data_dir
+        self.segment_bytes = segment_bytes
+        self.commit_interval = commit_interval
+        os.makedirs(data_dir, exist_ok=True)
+
+        self._pending = []
+        self._pending_seq = 0       # seq of the last queued entry
+        self._durable_seq = 0       # seq of the last fsync'ed entry
+        self._cond = threading.Condition(threading.Lock())
+        self._io_lock = threading.Lock()    # segment file, roll and compaction
+        self._file = None
+        self._segment = 0
+        self._closed = False
+        self._writer = None
+        self._users = set()         # user ids with an entry in the log
+        self._entries = 0           # entries in the log, under _cond
+        self._dead = 0              # ... that compaction would drop
+        # Counters
+        self.appended = 0
+        self.commits = 0
+        self.bytes_written = 0
+
+    # Segments
+
+    def _path(self, number):
+        return os.path.join(self.data_dir, f"{number:08d}{SUFFIX}")
+
+    def segments(self):
+        return segment_numbers(self.data_dir)
+
+    def _open_segment(self, number):
+        self._segment = number
+        self._file = open(self._path(number), 'ab')
+
+    def _roll(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._open_segment(self._segment + 1)
+
+    # Recovery
+
+    def recover(self, apply):
+        """
+        Replay every segment, calling `apply(entry)` for each entry in log
+        order, so the caller can rebuild its state without the whole log
+        in memory. Must be called once, before the first append.
+        """
+        numbers = self.segments()
+        live = live_segments(self.data_dir, numbers)
+        for number in numbers[:len(numbers) - len(live)]:
+            # Finish a compaction that was interrupted.
+            os.remove(self._path(number))
+        for number in live:
+            path = self._path(number)
+            end = 0
+            for entry, end in read_entries(path):
+                self._count(entry)
+                apply(entry)
+            if end < os.path.getsize(path):
+                # Torn tail from a crash mid-commit, drop it.
+                with open(path, 'r+b') as f:
+                    f.truncate(end)
+        self._open_segment(live[-1] if live else 1)
+
+    def _count(self, entry):
+        # Caller holds _cond, or nobody else runs yet (recovery).
+        op = entry.get('op')
+        if op in ('add', 'update', 'user'):
+            self._entries += 1
+        if op == 'update':
+            self._dead += 1
+        elif op == 'user':
+            if entry['user_id'] in self._users:
+                self._dead += 1
+            else:
+                self._users.add(entry['user_id'])
+
+    # Appending
+
+    def append(self, entry):
+        """Queue one entry for the next group commit. Returns its sequence number."""
+        data = encode_entry(entry)
+        with self._cond:
+            if self._closed:
+                raise ValueError("Message log is closed")
+            self._pending.append(data)
+            self._count(entry)
+            self._pending_seq += 1
+            self.appended += 1
+            if len(self._pending) == 1:
+                self._cond.notify_all()
+            return self._pending_seq
+
+    def wait_durable(self, seq, timeout=None):
+        """Block until entry `seq` has been fsync'ed."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._durable_seq >= seq, timeout)
+
+    def _commit(self, batch, seq):
+        data = b''.join(batch)
+        with self._io_lock:
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            if self._file.tell() >= self.segment_bytes:
+                self._roll()
+        with self._cond:
+            self._durable_seq = seq
+            self.commits += 1
+            self.bytes_written += len(data)
+            self._cond.notify_all()
+
+    def start(self):
+        """Start the group-commit and compaction threads."""
+        self._writer = threading.Thread(target=self._run, daemon=True)
+        self._writer.start()
+        threading.Thread(target=self.compact_loop, daemon=True).start()
+
+    def _run(self):
+        # Group-commit thread body.
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending and self._closed:
+                    return
+            # Let concurrent appends join this commit.
+            time.sleep(self.commit_interval)
+            with self._cond:
+                batch, self._pending = self._pending, []
+                seq = self._pending_seq
+            self._commit(batch, seq)
+
+    def close(self):
+        """Flush everything still pending and close the active segment."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._writer is not None:
+            self._writer.join()
+        else:
+            with self._cond:
+                batch, self._pending = self._pending, []
+                seq = self._pending_seq
+            if batch:
+                self._commit(batch, seq)
+        with self._io_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    # Compaction
+
+    def compact(self, force=False):
+        """
+        Rewrite all sealed segments as one holding only final state, if
+        enough of the log is dead (or `force`). The active segment is
+        sealed first so everything up to now is covered. Returns the
+        number of entries dropped.
+        """
+        with self._cond:
+            if not force and (self._dead < COMPACT_MIN_DEAD or self._dead < self._entries * COMPACT_RATIO):
+                return 0
+        with self._io_lock:
+            if self._file.tell() > 0:
+                self._roll()
+            sealed = [n for n in self.segments() if n < self._segment]
+        if not sealed:
+            return 0
+
+        # Two passes, so only the changes are held in memory, never every
+        # message: the first collects users and updates, the second copies
+        # each message with its updates folded in.
+        users, updates = {}, {}
+        read = 0
+        for number in sealed:
+            for entry, _ in read_entries(self._path(number)):
+                op = entry.get('op')
+                read += op != 'compacted'
+                if op == 'user':
+                    users[entry['user_id']] = entry
+                elif op == 'update':
+                    updates.setdefault(entry['id'], {}).update(entry['fields'])
+
+        target = self._path(sealed[-1])
+        tmp = target + '.compact'
+        written = 0
+        with open(tmp, 'wb') as f:
+            f.write(encode_entry(COMPACTED))
+            for user in users.values():
+                f.write(encode_entry(user))
+            written += len(users)
+            for number in sealed:
+                for entry, _ in read_entries(self._path(number)):
+                    if entry.get('op') == 'add':
+                        entry.update(updates.get(entry['id'], ()))
+                        f.write(encode_entry(entry))
+                        written += 1
+            f.flush()
+            os.fsync(f.fileno())
+        # The compacted file takes the newest sealed number so it still
+        # replays before the active segment. It starts with COMPACTED, so
+        # should removing the older ones below be cut short, recover()
+        # finishes the job.
+        os.replace(tmp, target)
+        for number in sealed[:-1]:
+            os.remove(self._path(number))
+        self._fsync_dir()
+        with self._cond:
+            self._entries -= read - written
+            self._dead = max(self._dead - (read - written), 0)
+        return read - written
+
+    def compact_loop(self, interval=COMPACT_INTERVAL):
+        while not self._closed:
+            time.sleep(interval)
+            try:
+                self.compact()
+            except OSError as e:
+                log.error('compaction_failed', error=e)
+
+    def _fsync_dir(self):
+        try:
+            fd = os.open(self.data_dir, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def stats(self):
+        return {
+            'appended': self.appended,
+            'commits': self.commits,
+            'bytes_written': self.bytes_written,
+            'pending': len(self._pending),
+            'segment': self._segment,
+        }
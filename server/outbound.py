@@ -0,0 +1,217 @@
+# outbound.py
+# Per-client outbound queue. Senders only enqueue already framed bytes, a
+# dedicated writer (thread or asyncio task) drains the queue with batched
+# sendall()/write() calls, so one slow reader never blocks anyone else.
+import threading
+from collections import deque
+
+DROP_OLDEST = 'drop_oldest'     # discard the oldest queued frame to make room
+DISCONNECT = 'disconnect'       # give up on the slow consumer and close it
+OVERFLOW_POLICIES = (DROP_OLDEST, DISCONNECT)
+
+DEFAULT_LIMIT = 1024            # frames buffered per client
+MAX_BATCH_BYTES = 256 * 1024    # bytes handed to a single write
+
+
+class OutboundQueue:
+    """
+    Bounded FIFO of encoded frames for one client.
+
+    put() is O(1) and never blocks. When the queue is full the overflow
+    policy decides: DROP_OLDEST keeps the newest frames, DISCONNECT closes
+    the queue and calls `on_overflow` so the connection can be torn down.
+
+    `wakeup` (optional) is called whenever the queue goes from empty to
+    non-empty; the asyncio engine uses it to poke its writer task.
+
+    `on_pressure` (optional) is called with True once the queue fills up to
+    `high` frames and with False once it drained down to `low` again, so
+    the client can be asked to hold back before the overflow policy bites
+    (and with False when a pressured queue is closed). The calls happen
+    without the queue's lock held, one at a time, and in order.
+
+    `compress` (optional, may be set later) turns every batch into the
+    bytes to write, e.g. a framing.Deflater's compress(). Only frames
+    queued after it is set may depend on it being applied.
+    """
+
+    def __init__(self, limit=DEFAULT_LIMIT, policy=DROP_OLDEST, on_overflow=None, wakeup=None,
+                 on_pressure=None, high=None, low=None, compress=None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy!r}")
+        self.limit = limit
+        self.policy = policy
+        self.on_overflow = on_overflow
+        self.wakeup = wakeup
+        self.on_pressure = on_pressure
+        self.compress = compress
+        self.high = high if high is not None else max(limit * 3 // 4, 1)
+        self.low = low if low is not None else limit // 4
+        self.pressured = False
+        self.closed = False
+        self._frames = deque()
+        self._bytes = 0
+        lock = threading.Lock()
+        self._cond = threading.Condition(lock)
+        self._drained = threading.Condition(lock)   # pressure went away
+        self._signal_lock = threading.RLock()       # on_pressure may put() a frame
+        self._signalled = False
+        # Counters
+        self.enqueued = 0
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self):
+        return len(self._frames)
+
+    def put(self, frame):
+        """Queue one frame. Returns False if the frame was not accepted."""
+        overflowed = False
+        pressured = False
+        with self._cond:
+            if self.closed:
+                return False
+            if len(self._frames) >= self.limit:
+                if self.policy == DROP_OLDEST:
+                    self._bytes -= len(self._frames.popleft())
+                    self.dropped += 1
+                else:
+                    self.closed = True
+                    self.dropped += len(self._frames) + 1
+                    self._frames.clear()
+                    self._bytes = 0
+                    overflowed = True
+            if not overflowed:
+                was_empty = not self._frames
+                self._frames.append(frame)
+                self._bytes += len(frame)
+                self.enqueued += 1
+                if len(self._frames) > self.max_depth:
+                    self.max_depth = len(self._frames)
+                if self.on_pressure is not None and not self.pressured and len(self._frames) >= self.high:
+                    self.pressured = pressured = True
+            self._cond.notify()
+
+        if overflowed:
+            if self.on_overflow is not None:
+                self.on_overflow()
+            return False
+        if was_empty and self.wakeup is not None:
+            self.wakeup()
+        if pressured:
+            self._signal()
+        return True
+
+    def _signal(self):
+        # put() and the writer report pressure changes after letting go of
+        # the queue lock, so their reports can race. Serialising them and
+        # reporting the current state, not the change just made, keeps the
+        # last report right.
+        with self._signal_lock:
+            pressured = self.pressured
+            if pressured != self._signalled:
+                self._signalled = pressured
+                self.on_pressure(pressured)
+
+    def _pop_batch(self, max_bytes):
+        batch = []
+        size = 0
+        while self._frames and (not batch or size + len(self._frames[0]) <= max_bytes):
+            frame = self._frames.popleft()
+            batch.append(frame)
+            size += len(frame)
+        self._bytes -= size
+        self.sent_frames += len(batch)
+        self.sent_bytes += size
+        relieved = self.pressured and len(self._frames) <= self.low
+        if relieved:
+            self.pressured = False
+            self._drained.notify_all()
+        return batch, relieved
+
+    def pop_batch(self, max_bytes=MAX_BATCH_BYTES):
+        """Take as many queued frames as fit in `max_bytes` (at least one), without waiting."""
+        with self._cond:
+            batch, relieved = self._pop_batch(max_bytes)
+        if relieved:
+            self._signal()
+        return batch
+
+    def wait_batch(self, max_bytes=MAX_BATCH_BYTES):
+        """Like pop_batch() but block until something is queued. Returns [] once closed."""
+        with self._cond:
+            while not self._frames and not self.closed:
+                self._cond.wait()
+            batch, relieved = self._pop_batch(max_bytes)
+        if relieved:
+            self._signal()
+        return batch
+
+    def wait_drained(self, timeout=None):
+        """Block while the queue is under pressure. Returns False on timeout."""
+        with self._cond:
+            return self._drained.wait_for(lambda: not self.pressured or self.closed, timeout)
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            relieved, self.pressured = self.pressured, False
+            self._cond.notify_all()
+            self._drained.notify_all()
+        if self.wakeup is not None:
+            self.wakeup()
+        if relieved:
+            self._signal()
+
+    def stats(self):
+        return {
+            'depth': len(self._frames),
+            'bytes': self._bytes,
+            'max_depth': self.max_depth,
+            'enqueued': self.enqueued,
+            'sent_frames': self.sent_frames,
+            'sent_bytes': self.sent_bytes,
+            'dropped': self.dropped,
+        }
+
+
+def batch_bytes(queue, batch):
+    data = batch[0] if len(batch) == 1 else b''.join(batch)
+    return data if queue.compress is None else queue.compress(data)
+
+
+def socket_writer(queue, sock, on_error=None):
+    """Writer thread body for a blocking socket: drain `queue` until it is closed."""
+    try:
+        while True:
+            batch = queue.wait_batch()
+            if not batch:
+                return
+            # One sendall per batch: coalesced frames leave in as few
+            # TLS records / syscalls as possible.
+            sock.sendall(batch_bytes(queue, batch))
+    except OSError:
+        queue.close()
+        if on_error is not None:
+            on_error()
+
+
+async def stream_writer(queue, writer, wake):
+    """
+    Writer task for an asyncio StreamWriter. `wake` is the asyncio.Event
+    the queue's wakeup callback sets.
+    """
+    while True:
+        await wake.wait()
+        wake.clear()
+        while True:
+            batch = queue.pop_batch()
+            if not batch:
+                break
+            writer.write(batch_bytes(queue, batch))
+            await writer.drain()
+        if queue.closed and not queue.depth:
+            return
@@ -0,0 +1,63 @@
+# presence.py
+# Coalesces join/leave events into periodic PRESENCE deltas so a login
+# storm costs one small broadcast per window instead of a full roster
+# rebuild per client per event.
+import threading
+import time
+
+JOIN = 'join'
+LEAVE = 'leave'
+WINDOW = 0.2    # seconds of churn folded into a single delta
+
+
+class PresenceTracker:
+    """
+    Pending roster changes since the last flush, one entry per user holding
+    the latest change. Changes are not cancelled against each other: a client
+    that got its login snapshot in the middle of a window may already list a
+    user that joined and left again, so the final state is always announced
+    and clients apply it idempotently.
+    """
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self._pending = {}      # user_id -> JOIN / LEAVE, insertion ordered
+        self._cond = threading.Condition(threading.Lock())
+
+    def joined(self, user_id):
+        self._record(user_id, JOIN)
+
+    def left(self, user_id):
+        self._record(user_id, LEAVE)
+
+    def _record(self, user_id, change):
+        with self._cond:
+            self._pending.pop(user_id, None)
+            self._pending[user_id] = change
+            self._cond.notify()
+
+    def take(self):
+        """Return (joined, left) accumulated so far and reset."""
+        with self._cond:
+            pending, self._pending = self._pending, {}
+        joined = [uid for uid, change in pending.items() if change == JOIN]
+        left = [uid for uid, change in pending.items() if change == LEAVE]
+        return joined, left
+
+    def wait(self):
+        # Block until there is something to announce.
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+
+    def run(self, publish):
+        """
+        Flusher thread body: once a change arrives, keep collecting for one
+        window, then hand the net delta to publish(joined, left).
+        """
+        while True:
+            self.wait()
+            time.sleep(self.window)
+            joined, left = self.take()
+            if joined or left:
+                publish(joined, left)
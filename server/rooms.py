@@ -0,0 +1,61 @@
+# rooms.py
+# Room subscriptions. Members are user ids and stay members while offline;
+# a message to a room is delivered to whichever members are connected and
+# stored once, on the room's timeline, instead of once per recipient.
+import re
+import threading
+
+ROOM_NAME = re.compile(r'[\w-]{1,64}')
+PUBLIC = '*'    # timeline of the messages sent to "all", read by everybody; no room can be called that
+
+
+def valid_room(name):
+    return isinstance(name, str) and ROOM_NAME.fullmatch(name) is not None
+
+
+class RoomIndex:
+    """room -> members and user -> rooms, kept in step under one lock."""
+
+    def __init__(self):
+        self._members = {}      # room -> set of user ids
+        self._rooms = {}        # user id -> set of rooms
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._members)
+
+    def join(self, room, user_id):
+        """Returns False if the user already was a member."""
+        with self._lock:
+            members = self._members.setdefault(room, set())
+            if user_id in members:
+                return False
+            members.add(user_id)
+            self._rooms.setdefault(user_id, set()).add(room)
+            return True
+
+    def leave(self, room, user_id):
+        """Returns False if the user was not a member."""
+        with self._lock:
+            members = self._members.get(room)
+            if members is None or user_id not in members:
+                return False
+            members.discard(user_id)
+            if not members:
+                del self._members[room]
+            rooms = self._rooms[user_id]
+            rooms.discard(room)
+            if not rooms:
+                del self._rooms[user_id]
+            return True
+
+    def is_member(self, room, user_id):
+        return user_id in self._members.get(room, ())
+
+    def members(self, room):
+        with self._lock:
+            return list(self._members.get(room, ()))
+
+    def rooms_of(self, user_id):
+        with self._lock:
+            return sorted(self._rooms.get(user_id, ()))
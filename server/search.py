@@ -0,0 +1,200 @@
+# search.py
+# Incremental inverted index over message content for the SEARCH action.
+# Every word maps to a posting list of message ids kept in ascending order
+# (ids are snowflakes, so that is also time order). A query intersects the
+# posting lists of its words walking backwards from a cursor, newest first,
+# so a page of results costs O(page * log n) instead of a scan of all text.
+# Who may see a message is indexed the same way, under '@<user_id>' and
+# '#<room>' (words never contain either), so visibility is one more list to
+# intersect, or a union of lists for a user in rooms. Time
+# ranges become id ranges, and patterns are only checked on the candidates
+# the index already matched, outside the index lock. Nothing else is ever
+# locked while the index lock is held.
+import bisect
+import re
+import threading
+from array import array
+
+from ids import id_floor
+
+TOKEN = re.compile(r'\w+')
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+SCAN_BUDGET = 20000     # candidates examined per page before handing back a cursor
+BATCH = 256             # candidates taken under the lock at a time, checked without it
+
+
+def tokenize(text):
+    return set(TOKEN.findall(text.lower())) if text else set()
+
+
+def audience_key(user_id):
+    return '@' + user_id
+
+
+def room_key(room):
+    return '#' + room
+
+
+class Pattern:
+    """
+    The SEARCH filter: text that must occur in the message, ignoring case,
+    where * stands for any run of characters and ? for any one character.
+    Each piece between stars becomes a regex without quantifiers, and they
+    are found left to right, so a match costs at most about
+    len(content) * len(pattern) steps whatever the pattern: there is no
+    backtracking for a hostile pattern to blow up. Raises ValueError for a
+    pattern with nothing to match.
+    """
+    __slots__ = ('text', '_pieces')
+
+    def __init__(self, text):
+        self.text = text
+        self._pieces = [re.compile(''.join('.' if c == '?' else re.escape(c) for c in piece),
+                                   re.IGNORECASE | re.DOTALL)
+                        for piece in text.split('*') if piece]
+        if not self._pieces:
+            raise ValueError("pattern matches everything")
+
+    def search(self, content):
+        position = 0
+        for piece in self._pieces:
+            found = piece.search(content, position)
+            if found is None:
+                return False
+            position = found.end()
+        return True
+
+
+def _contains(postings, key):
+    i = bisect.bisect_left(postings, key)
+    return i < len(postings) and postings[i] == key
+
+
+class SearchIndex:
+    """
+    add() is called for every new or changed message; changed content only
+    adds words, stale ones are weeded out when a hit is verified against the
+    message's current content.
+    """
+
+    def __init__(self):
+        self._postings = {}     # word -> array('q') of message ids, ascending
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._postings)
+
+    def add(self, message_id, content, audience=(), room=None):
+        """
+        Index new words of a message; `audience` (sender and recipients) and
+        `room` only when it is new.
+        """
+        try:
+            key = int(message_id)
+        except (TypeError, ValueError):
+            return
+        words = tokenize(content)
+        words.update(audience_key(user_id) for user_id in audience)
+        if room is not None:
+            words.add(room_key(room))
+        with self._lock:
+            for word in words:
+                postings = self._postings.get(word)
+                if postings is None:
+                    self._postings[word] = array('q', [key])
+                elif postings[-1] < key:
+                    postings.append(key)    # the usual case: newest message
+                elif not _contains(postings, key):
+                    # From another worker, slightly out of order.
+                    postings.insert(bisect.bisect_left(postings, key), key)
+
+    def forget(self, horizon):
+        """Drop the postings of every message id up to `horizon` (they went to the cold tier)."""
+        with self._lock:
+            for word in list(self._postings):
+                postings = self._postings[word]
+                cut = bisect.bisect_right(postings, horizon)
+                if cut == len(postings):
+                    del self._postings[word]
+                elif cut:
+                    del postings[:cut]
+
+    def search(self, query, user_id, lookup, since=None, until=None, pattern=None,
+               cursor=None, limit=DEFAULT_LIMIT, budget=SCAN_BUDGET, rooms=(), floor=0):
+        """
+        Messages `user_id` (a member of `rooms`) can see holding every word
+        of `query`, newest first. `lookup(message_id)` returns the stored
+        message. since/until are Unix timestamps, `pattern` a Pattern
+        matched against the content, and `cursor` the value returned with
+        the previous page. Only ids above `floor` are looked at. Returns
+        (messages, next_cursor); the cursor is None once there is nothing left.
+
+        Only the posting lists are read under the index lock, a batch of
+        candidate ids at a time. Looking the messages up (which may read the
+        cold tier) and checking them happens after letting go of it, so
+        senders indexing their messages never wait for a search.
+        """
+        words = tokenize(query)
+        if not words:
+            return [], None
+        low = max(id_floor(since) if since is not None else 0, floor + 1)
+        high = id_floor(until) if until is not None else None
+        if cursor is not None:
+            high = int(cursor) if high is None else min(high, int(cursor))
+
+        results = []
+        scanned = 0
+        while True:
+            keys, examined, high = self._candidates(words, user_id, rooms, low, high, limit - len(results),
+                                                    min(BATCH, budget - scanned))
+            scanned += examined
+            for key in keys:
+                record = lookup(str(key))
+                if record is None or not words <= tokenize(record.content):
+                    continue    # indexed under content it no longer has
+                if pattern is not None and not pattern.search(record.content):
+                    continue
+                results.append(record)
+            if high is None:
+                return results, None
+            if len(results) == limit or scanned >= budget:
+                return results, str(high)
+
+    def _candidates(self, words, user_id, rooms, low, high, count, budget):
+        """
+        Up to `count` ids from `high` (exclusive, None: the newest) down to
+        `low` that are in the list of every word and visible to the user,
+        looking at no more than `budget` ids of the shortest list. Returns
+        (ids, ids looked at, id to resume below), the last one None once
+        there is nothing left.
+        """
+        with self._lock:
+            lists = [self._postings.get(word) for word in words]
+            visible = [self._postings.get(key) for key in
+                       [audience_key(user_id)] + [room_key(room) for room in rooms]]
+            visible = [postings for postings in visible if postings]
+            if not all(lists) or not visible:
+                return [], 0, None
+            if len(visible) == 1:
+                # Just the user's own messages: one more list to intersect.
+                lists += visible
+                visible = None
+            lists.sort(key=len)
+            rarest, others = lists[0], lists[1:]
+            start = bisect.bisect_left(rarest, low)
+            i = len(rarest) if high is None else bisect.bisect_left(rarest, high)
+            keys = []
+            scanned = 0
+            while i > start:
+                if len(keys) == count or scanned == budget:
+                    return keys, scanned, rarest[i]
+                i -= 1
+                scanned += 1
+                key = rarest[i]
+                if not all(_contains(postings, key) for postings in others):
+                    continue
+                if visible is not None and not any(_contains(postings, key) for postings in visible):
+                    continue
+                keys.append(key)
+            return keys, scanned, None
@@ -1,314 +1,1486 @@
 # server.py
-import socket
-import threading
+import argparse
+import asyncio
+import hashlib
+import hmac
 import json
+import math
+import multiprocessing
 import os
-import random
+import secrets
+import select
+import shutil
+import socket
+import tempfile
+import threading
 import ssl
 import time
-from datetime import datetime
+
+import framing
+import logs
+from framing import CODECS, COMPRESSIONS, Deflater, EncodedMessage, FrameBuffer, Inflater, decode_message, \
+    encode_message, recv_message
+from admin import JSON_TYPE, AdminServer, parse_address, worker_address
+from bus import BusClient, BusHub
+from expiry import ExpiryScheduler
+from ids import SnowflakeGenerator, id_node, to_base36
+from limits import RATES, AdmissionControl
+from logs import get_logger
+from metrics import SIZE_BUCKETS, Registry, TimedLock
+from msglog import MessageLog, load_dir
+from presence import PresenceTracker
+from rooms import PUBLIC, RoomIndex, valid_room
+from search import DEFAULT_LIMIT, MAX_LIMIT, Pattern, SearchIndex
+from store import MessageRecord, MessageStore, parse_size
+from coldstore import ColdStore
+from outbound import DROP_OLDEST, OVERFLOW_POLICIES, OutboundQueue, socket_writer, stream_writer
 
 # Configuration
 IP = '127.0.0.1'
 PORT = 65432
-HEADER_LENGTH = 2048
-BACK_LOG = 100
-TIME_TO_LIVE = 10
-INTERVAL = 5
-USED_MSSG_ID = set()
-# A dictionary mapping user_id to a dict: {'socket': client_socket, 'username': username}
+BACK_LOG = 4096               # accepting is cheap now, the kernel caps this at somaxconn
+READ_CHUNK = 64 * 1024
+COLD_READS = ('HISTORY', 'SEARCH')  # may page through the on-disk cold tier
+OUTBOUND_LIMIT = 1024        # frames queued per client before the overflow policy kicks in
+OVERFLOW_POLICY = DROP_OLDEST
+CODEC = 'json'               # payload codec, clients must be configured with the same one
+COMPRESSION = 'zlib'         # offered to clients at login, None to turn it off
+COMPRESS_LEVEL = 1
+TIME_TO_LIVE = 10           # default lifetime of a TEMPORARY message, in seconds
+MAX_TIME_TO_LIVE = 24 * 3600
+SEARCH_PAGE = 50             # results per SEARCH_RESULT frame
+COLD_FILE = 'cold.db'        # cold tier of the message store, with --memory-budget
+TLS_TICKETS = 2              # session tickets sent per TLS 1.3 handshake
+TLS_CIPHERS = 'ECDHE+AESGCM:ECDHE+CHACHA20'     # TLS 1.2 only, the 1.3 suites are all AEAD
+HANDSHAKE_TIMEOUT = 10       # seconds a new connection gets to finish the TLS handshake
+HISTORY_PAGE = 100           # messages per HISTORY frame
+MAX_HISTORY = 1000           # messages per HISTORY request
+MAX_PATTERN_LENGTH = 200
+NODE_ID = 0                  # 0..1023, must differ between servers sharing users/messages
+REUSE_PORT = False           # set in --workers mode, every worker binds IP:PORT itself
+LOAD_INTERVAL = 0.25         # seconds between overload checks
+SHED_DELAY = 0.1             # seconds every request waits while the server is overloaded
+REQUEST_ACTIONS = ('MESSAGE', 'TEMPORARY', 'REPLY', 'DELETE', 'SEARCH', 'HISTORY', 'JOIN', 'LEAVE', 'EXIT')
+LOGIN_RESULTS = ('new', 'resumed', 'reconnected', 'refused')
+HANDSHAKE_RESULTS = ('full', 'resumed', 'failed', 'timeout')
+BUSY_REASONS = {'capacity': "Server full, try again later.",
+                'per_ip': "Too many connections from your address.",
+                'overload': "Server busy, try again later."}
+log = get_logger('server')
+# Counters and histograms, served by the admin endpoint (--admin)
+METRICS = Registry()
+
+def timed_lock(lock, kind):
+    # Contended waits on the shared locks end up in chat_lock_wait_seconds.
+    return TimedLock(lock, METRICS.histogram('chat_lock_wait_seconds',
+                                             "Time spent waiting for a contended lock", lock=kind))
+
+CONNECTIONS_ACCEPTED = METRICS.counter('chat_connections_accepted_total', "Connections accepted")
+CONNECTIONS_CLOSED = METRICS.counter('chat_connections_closed_total', "Connections closed")
+HANDSHAKES = {result: METRICS.counter('chat_tls_handshakes_total',
+                                      "TLS handshakes by outcome (failures: threaded engine only)", result=result)
+              for result in HANDSHAKE_RESULTS}
+HANDSHAKE_SECONDS = METRICS.histogram('chat_tls_handshake_seconds', "Time from accept to the end of the TLS handshake "
+                                                                    "(threaded engine)")
+ACCEPT_ERRORS = METRICS.counter('chat_accept_errors_total', "accept() calls that failed")
+CONNECTION_ERRORS = METRICS.counter('chat_connection_errors_total', "Connections that ended with an error")
+LOGIN_SECONDS = METRICS.histogram('chat_login_seconds', "Time to process a login")
+LOGINS = {result: METRICS.counter('chat_logins_total', "Logins by outcome", result=result)
+          for result in LOGIN_RESULTS}
+REQUEST_SECONDS = {action: METRICS.histogram('chat_request_seconds', "Time to handle a request, by action",
+                                             action=action)
+                   for action in REQUEST_ACTIONS + ('other',)}
+FANOUT_RECIPIENTS = METRICS.histogram('chat_fanout_recipients', "Recipients per delivered frame",
+                                      buckets=SIZE_BUCKETS)
+FRAMES_QUEUED = METRICS.counter('chat_frames_queued_total', "Frames queued for delivery to clients")
+FLOW_SIGNALS = METRICS.counter('chat_flow_signals_total', "FLOW pause/resume frames sent to clients")
+COMPRESS_INPUT = METRICS.counter('chat_compress_input_bytes_total', "Bytes written to compressed connections, before compression")
+COMPRESS_OUTPUT = METRICS.counter('chat_compress_output_bytes_total', "Bytes written to compressed connections, after compression")
+CONNECTIONS_REFUSED = {reason: METRICS.counter('chat_connections_refused_total', "Connections turned away, by reason",
+                                               reason=reason)
+                       for reason in BUSY_REASONS}
+RATE_LIMITED = {limit: METRICS.counter('chat_rate_limited_total', "Requests and logins held back, by limit",
+                                       limit=limit)
+                for limit in RATES + ('shed',)}
+THROTTLED_SECONDS = METRICS.counter('chat_throttled_seconds_total', "Time requests were held back by limits")
+LOOP_LAG = METRICS.histogram('chat_event_loop_lag_seconds', "How late the asyncio event loop ran a timer")
+LOG_SUPPRESSED = METRICS.counter('chat_log_lines_suppressed_total', "Log lines dropped by the rate limit")
+# A dictionary mapping user_id to a dict: {'socket': client_socket, 'username': username, 'queue': OutboundQueue}
 CLIENTS = {}
-MESSAGES = {}
+# Users connected to other workers (--workers only): user_id -> worker index
+REMOTE_CLIENTS = {}
+# Every message ever sent, indexed by id, plus each user's send/receive id lists
+STORE = MessageStore(wrap_lock=timed_lock)
 USERS = {}
-lock = threading.Lock()
+# Guards CLIENTS and USERS membership changes. Messages are guarded by the
+# store's own shard/mailbox locks, IDs by the generator's.
+roster_lock = timed_lock(threading.Lock(), 'roster')
+IDS = SnowflakeGenerator(node=NODE_ID)
+PRESENCE = PresenceTracker()
+# Room memberships, by room and by user. Changed under roster_lock so the
+# log and the bus see them in order.
+ROOMS = RoomIndex()
+SEARCH = SearchIndex()
+EXPIRY = ExpiryScheduler(on_expire=lambda message_id: expire_message(message_id),
+                         lag=METRICS.histogram('chat_expiry_lag_seconds',
+                                               "How late temporary messages expired"))
+# Durable log of users and messages, only with --data-dir
+LOG = None
+# Link to the other workers and this worker's index, only with --workers
+BUS = None
+WORKER = None
+# Admin endpoint, only with --admin
+ADMIN = None
+# Rate limits, connection caps and the overload flag (--limit, "limits" admin command)
+ADMISSION = AdmissionControl()
+LOOP_LAG_SECONDS = 0.0       # latest event loop lag, asyncio engine only
 
-# # Ensure persistence files exist.
-# if not os.path.exists('users.json'):
-#     with open('users.json', 'w') as f:
-#         json.dump({}, f)
+def owns(message_id):
+    # With workers, every worker keeps all messages but only the one that
+    # created a message logs and expires it.
+    return BUS is None or id_node(message_id) == IDS.node
 
-# # Create directories for storing user message
-# if not os.path.exists('message_db'):
-#     os.makedirs('message_db')
+def publish(event):
+    if BUS is not None:
+        BUS.publish(event)
 
-#     # with open('messages.json', 'w') as f:
-#     #     json.dump([], f)
+def log_user(user_id, user):
+    # Persistence helpers: no-ops unless the server runs with --data-dir.
+    # Called with the lock guarding the changed state held (roster_lock,
+    # STORE.lock_for(id)), so the log order matches the order of changes.
+    if LOG is not None:
+        # Stamped, so the newest entry wins when the logs of several
+        # workers are merged.
+        LOG.append({'op': 'user', 'user_id': user_id, 'username': user['username'], 'token': user.get('token'),
+                    'rooms': ROOMS.rooms_of(user_id), 'stamp': IDS.next_id()})
 
-# with open('users.json', 'r') as f:
-#     USERS = json.load(f)
-# # with open('messages.json', 'r') as f:
-# #     MESSAGES = json.load(f)
+def log_record(record):
+    if LOG is not None and owns(record.id):
+        entry = record.to_entry()
+        entry['op'] = 'add'
+        if record.ttl is not None:
+            entry['expires_at'] = time.time() + record.ttl
+        LOG.append(entry)
 
-def create_client_message_folder(user_id):
-    data = {
-        'send': [],
-        'receive': []
-    }
-    # with open(f'./message_db/{user_id}.json', 'w') as f:
-    #     json.dump(data, f, indent=4)
+def log_update(record, *fields):
+    if LOG is not None and owns(record.id):
+        LOG.append({'op': 'update', 'id': record.id,
+                    'fields': {name: getattr(record, name) for name in fields}})
 
-# def save_users():
-#     with open('users.json', 'w') as f:
-#         json.dump(USERS, f, indent=4)
+def load_state(sibling_dirs=()):
+    """
+    Rebuild USERS, STORE and pending expiries from the message log, plus
+    the other workers' logs in --workers mode. Messages go into STORE as
+    they are read, so the log never has to fit in memory at once.
+    """
+    users = {}
+    expiring = {}       # id -> expires_at, for our own TEMPORARY messages
+    messages = 0
 
-# def save_messages():
-#     with open('messages.json', 'w') as f:
-#         json.dump(MESSAGES, f, indent=4)
+    def replay(entry):
+        nonlocal messages
+        op = entry.get('op')
+        if op == 'user':
+            # The newest entry wins, whichever worker logged it.
+            known = users.get(entry['user_id'])
+            if known is None or entry.get('stamp', 0) >= known.get('stamp', 0):
+                users[entry['user_id']] = entry
+        elif op == 'add':
+            STORE.throttle()
+            record = STORE.add(MessageRecord.from_message(entry))
+            SEARCH.add(record.id, record.content, record.audience(), record.timeline)
+            IDS.observe(record.id)
+            messages += 1
+            if record.action == 'TEMPORARY' and entry.get('expires_at') is not None and owns(record.id):
+                expiring[record.id] = entry['expires_at']
+        elif op == 'update':
+            fields = entry['fields']
+            with STORE.lock_for(entry['id']):
+                record = STORE.get(entry['id'])
+                if record is None:
+                    return
+                for name, value in fields.items():
+                    setattr(record, name, value)
+                STORE.save(record)
+                if 'changed' in fields:
+                    STORE.changed(record)
+            index_change(record, fields)
+            if record.action != 'TEMPORARY':
+                expiring.pop(record.id, None)
+
+    LOG.recover(replay)
+    for data_dir in sibling_dirs:
+        load_dir(data_dir, replay)
+    for user_id, user in users.items():
+        if user.get('stamp'):
+            IDS.observe(user['stamp'])
+        USERS[user_id] = {"username": user['username'], "token": user.get('token')}
+        STORE.open_mailbox(user_id)
+        for room in user.get('rooms') or ():
+            ROOMS.join(room, user_id)
+    now = time.time()
+    for message_id, expires_at in expiring.items():
+        # A non-finite deadline (logged before TTLs were checked) is due now.
+        delay = expires_at - now
+        EXPIRY.schedule(message_id, max(delay, 0) if math.isfinite(delay) else 0)
+    log.info('recovered', users=len(users), messages=messages, data_dir=LOG.data_dir)
 
 def generate_user_id(username):
-    return f"{username}_{random.randint(1000, 9999)}"
+    # Short base36 form of a fresh snowflake, unique without any lookups.
+    return f"{username}_{to_base36(IDS.next_id())}"
+
+def hash_token(token):
+    # Only a hash is kept (and logged), the token itself is the client's secret.
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def check_token(user, token):
+    return bool(token) and user.get('token') is not None and \
+        hmac.compare_digest(user['token'], hash_token(token))
 
 def generate_message_id():
-    return f"{random.randint(100000, 999999)}"
+    # Time-ordered: later messages always get larger IDs.
+    return str(IDS.next_id())
+
+
+
+def new_outbound_queue(on_overflow, wakeup=None, on_pressure=None):
+    # A client whose queue backs up gets FLOW pause=True: it should stop
+    # sending (its own messages come back through this queue too) until a
+    # FLOW pause=False says the queue has drained. Until then its reader
+    # also stops taking requests off the connection, so what it sent before
+    # hearing about it waits in the socket buffers instead of overflowing
+    # the queue. `on_pressure` is the engine's hook for that.
+    def pressure(paused):
+        send_flow(queue, paused)
+        if on_pressure is not None:
+            on_pressure(paused)
+
+    queue = OutboundQueue(limit=OUTBOUND_LIMIT, policy=OVERFLOW_POLICY, on_overflow=on_overflow, wakeup=wakeup,
+                          on_pressure=pressure)
+    return queue
 
+def send_flow(queue, paused, retry_after=None):
+    # With `retry_after` the pause ends by itself after that many seconds.
+    flow = {"action": 'FLOW', "pause": paused}
+    if retry_after is not None:
+        flow["retry_after"] = round(retry_after, 3)
+    if queue.put(encode_message(flow)):
+        FLOW_SIGNALS.inc()
 
+def queue_message(queue, message):
+    # Never blocks: the client's writer thread/task does the actual send.
+    if isinstance(message, EncodedMessage):
+        return queue.put(message.frame)
+    return queue.put(encode_message(message))
 
 def broadcast_message(user,message):
+    queue_message(user['queue'], message)
+
+def fanout(client_ids, message):
+    """
+    Queue the same message for every connected client in `client_ids`.
+    The message is serialized once and every queue shares those bytes.
+    """
+    encoded = message if isinstance(message, EncodedMessage) else EncodedMessage(message)
+    queued = 0
+    for client_id in client_ids:
+        client = CLIENTS.get(client_id)
+        if client is not None:
+            client['queue'].put(encoded.frame)
+            queued += 1
+    FANOUT_RECIPIENTS.observe(queued)
+    FRAMES_QUEUED.inc(queued)
+
+def outbound_stats():
+    """Totals over every connected client's outbound queue."""
+    totals = {'clients': 0, 'depth': 0, 'max_depth': 0, 'enqueued': 0, 'dropped': 0}
+    for client in list(CLIENTS.values()):
+        stats = client['queue'].stats()
+        totals['clients'] += 1
+        totals['depth'] += stats['depth']
+        totals['max_depth'] = max(totals['max_depth'], stats['depth'])
+        totals['enqueued'] += stats['enqueued']
+        totals['dropped'] += stats['dropped']
+    return totals
+
+def online_users():
+    """Everybody connected, to this process or (with --workers) to another worker."""
+    return list(CLIENTS.keys()) + list(REMOTE_CLIENTS.keys())
+
+def timelines(user_id):
+    """What `user_id` reads besides its own mailbox: its rooms, and the public timeline."""
+    return ROOMS.rooms_of(user_id) + [PUBLIC]
+
+def is_online(user_id):
+    return user_id in CLIENTS or user_id in REMOTE_CLIENTS
+
+def audience(record):
+    """
+    Everybody who gets this message and its updates: a room's members,
+    everybody online for a public one, or the recipients; and the sender.
+    """
+    if record.public:
+        online = online_users()
+        return online if record.sender in online else online + [record.sender]
+    if record.room is None:
+        return record.audience()
+    members = ROOMS.members(record.room)
+    return members if record.sender in members else members + [record.sender]
+
+def remove_connection(client_id, conn=None):
+    """
+    Drop a client from CLIENTS and close its socket. With `conn`, only if
+    that is still the client's connection (it may have resumed on a new one).
+    Returns True if the client was still registered.
+    """
+    with roster_lock:
+        client = CLIENTS.get(client_id)
+        if client is None or (conn is not None and client['socket'] is not conn):
+            return False
+        del CLIENTS[client_id]
+        log.info('client_removed', user_id=client_id)
+    close_client(client_id, client)
+    return True
+
+def close_client(client_id, client):
+    client['queue'].close()
+    client_socket = client['socket']
     try:
-        user['socket'].send(json.dumps(message).encode('utf-8'))
+        client_socket.close()
     except Exception as e:
-                print(f"Error sending message to {user['username']}: {e}")
-
-def remove_connection(client_id):
-    with lock:
-        if client_id in CLIENTS:
-            client_socket = CLIENTS[client_id]['socket']
-            print(f"Removing client: {client_id}")
-            del CLIENTS[client_id]
-            try:
-                client_socket.close()
-            except Exception as e:
-                print(f"Error closing client socket {client_id}: {e}")
+        log.warning('close_failed', user_id=client_id, error=e)
 
-def update_active_client_list():
+def send_active_client_list(user_id, outbound):
+    """Full roster snapshot, sent once to a client right after it logs in."""
     data = {
             "id": None,
             "action": 'ACTIVE_CLIENT',
             "sender": None,
-            "receiver": None,
+            "receiver": [id for id in online_users() if id != user_id],
             "content": None,
             "time": None,
             "private": False,
     }
-        
-    for client_id in list(CLIENTS.keys()):
-        sending_list = [id for id in list(CLIENTS.keys()) if id != client_id]
-        data['receiver'] = sending_list #Assign active client list for receiver to make it easier
-        broadcast_message(CLIENTS[client_id],data)
+    queue_message(outbound, data)
+
+def publish_presence(joined, left):
+    # Everybody else learns about roster changes as one coalesced delta.
+    # Every worker runs its own flusher for its own clients.
+    data = {
+            "action": 'PRESENCE',
+            "joined": joined,
+            "left": left,
+    }
+    fanout(list(CLIENTS.keys()), data)
 
 
-def clean_expired_message(ttl = TIME_TO_LIVE):
-    now = time.time()
-    global MESSAGES
-    with lock:
-        for client_msg in MESSAGES:
+def change_record(record, fields):
+    # Caller holds STORE.lock_for(record.id) and calls index_change() after
+    # releasing it. A removed or expired message must not expire (again)
+    # later.
+    for name, value in fields.items():
+        setattr(record, name, value)
+    STORE.save(record)
+    if 'changed' in fields:
+        STORE.changed(record)
+    log_update(record, *fields)
+    EXPIRY.cancel(record.id)
+
+def index_change(record, fields):
+    # Outside the store lock, so the index lock is never taken inside a
+    # shard lock (nor the other way round: search() looks records up after
+    # releasing it).
+    if 'content' in fields:
+        SEARCH.add(record.id, record.content)
+
+def update_and_notify(message_id, fields, notify):
+    """Apply a change another worker made and tell our clients who hold the message."""
+    with STORE.lock_for(message_id):
+        record = STORE.get(message_id)
+        if record is None:
+            return
+        change_record(record, fields)
+        sending_list = audience(record)
+    index_change(record, fields)
+    fanout(sending_list, notify)
 
-            for msg in MESSAGES[client_msg]['send']:
-                mssg_timestamp = datetime.strptime(msg['time'],"%Y-%m-%d %H:%M:%S").timestamp()
+def expire_message(message_id):
+    """Called by the expiry scheduler once a TEMPORARY message's TTL is up."""
+    fields = {'content': 'THIS MESSAGE IS EXPIRED.', 'action': 'DELETE', 'changed': IDS.next_id()}
+    with STORE.lock_for(message_id):
+        record = STORE.get(message_id)
+        if record is None or record.action != 'TEMPORARY':
+            return
+        change_record(record, fields)
+        sending_list = audience(record)
+    index_change(record, fields)
+
+    data = {
+        "id": None,
+        "action": 'OUTDATED',
+        "sender": None,
+        "receiver": None,
+        "content": message_id,
+        "time": None,
+        "private": False,
+    }
+    fanout(sending_list, data)
+    publish({'type': 'update', 'id': message_id, 'fields': fields, 'notify': data})
+
+def message_ttl(data):
+    # Clients may ask for their own TTL, within [1, MAX_TIME_TO_LIVE] seconds.
+    # NaN would slip through min()/max(), every comparison with it is false.
+    try:
+        ttl = float(data.get('ttl') or TIME_TO_LIVE)
+    except (TypeError, ValueError):
+        ttl = TIME_TO_LIVE
+    if not math.isfinite(ttl):
+        ttl = TIME_TO_LIVE
+    return min(max(ttl, 1), MAX_TIME_TO_LIVE)
 
-                if msg['action'] == 'TEMPORARY' and (now - mssg_timestamp) > ttl:
-                    msg_id = msg['id']
-                    receiver_list = msg['receiver'][:]
-                    sending_list = receiver_list + [msg['sender']]
 
-                    data = {
-                        "id": None,
-                        "action": 'OUTDATED',
-                        "sender": None,
-                        "receiver": None,
-                        "content": msg['id'],
-                        "time": None,
-                        "private": False,
-                    }
+def message_error(action, data):
+    """
+    What is wrong with a MESSAGE/TEMPORARY/REPLY request, or None. Checked
+    before anything is stored or logged.
+    """
+    content = data.get('content')
+    if content is not None and not isinstance(content, str):
+        return "content must be text"
+    receiver = data.get('receiver')
+    if action != 'REPLY' and receiver is not None and \
+            not (isinstance(receiver, list) and all(isinstance(uid, str) for uid in receiver)):
+        return "receiver must be a list of user IDs"
+    return None
 
-                    for msg_receiver in receiver_list:
-                        if msg_receiver in MESSAGES:
-                            for m in MESSAGES[msg_receiver]['receive']:
-                                if m['id'] == msg_id:
-                                    msg['content'] = 'THIS MESSAGE IS EXPIRED.'
-                                    msg['action'] = 'DELETE'
-                                    
+def new_record(user_id, data, action, recipients, room=None, public=False):
+    return MessageRecord(
+        id=generate_message_id(),
+        action=action,
+        sender=user_id,
+        receiver=tuple(recipients),
+        content=data.get('content') or '',
+        time=data.get('time'),
+        private=bool(data.get('private')),
+        room=room,
+        public=public,
+    )
 
-                    for client_id in sending_list:
-                        if client_id in CLIENTS:
-                            broadcast_message(CLIENTS[client_id],data)
+def reply_target(user_id, message_id):
+    """
+    Where a reply to `message_id` goes: (recipients, room, public, private)
+    taken from that message, or None if `user_id` can't see it.
+    """
+    if not isinstance(message_id, str):
+        return None
+    with STORE.lock_for(message_id):
+        original = STORE.get(message_id)
+        if original is None or not original.visible_to(user_id, timelines(user_id)):
+            return None
+        if original.room is not None:
+            return [], original.room, False, False
+        if original.public:
+            return [], None, True, False
+        audience = set(original.receiver)
+        audience.add(original.sender)
+    recipients = [uid for uid in audience if uid != user_id and STORE.has_mailbox(uid)]
+    return recipients, None, False, original.private
 
-                    
+def store_and_deliver(record):
+    # Stored once, both mailboxes only keep its id.
+    with STORE.lock_for(record.id):
+        STORE.add(record)
+        log_record(record)
+    SEARCH.add(record.id, record.content, record.audience(), record.timeline)
+    fanout(audience(record), record.to_message())
 
+def send_new_message(record):
+    # Local clients get it right away, other workers through the bus.
+    store_and_deliver(record)
+    publish({'type': 'message', 'record': record.to_entry()})
 
 
-def cleanup_loop(interval=INTERVAL, ttl=TIME_TO_LIVE):
+def send_search_results(user_id, data, outbound):
+    """
+    Answer a SEARCH request with up to `limit` hits, newest first, streamed
+    as SEARCH_RESULT frames of SEARCH_PAGE messages. The last frame has
+    done=True and a cursor to continue from (None when nothing is left).
+    """
+    query = data.get('content') or ''
+    pattern = data.get('pattern')
+    cursor = data.get('cursor')
+    try:
+        if not isinstance(query, str):
+            raise ValueError("content must be text")
+        if pattern:
+            if not isinstance(pattern, str) or len(pattern) > MAX_PATTERN_LENGTH:
+                raise ValueError(f"pattern must be text of up to {MAX_PATTERN_LENGTH} characters")
+            pattern = Pattern(pattern)
+        limit = min(max(int(data.get('limit') or DEFAULT_LIMIT), 1), MAX_LIMIT)
+        since = float(data['since']) if data.get('since') is not None else None
+        until = float(data['until']) if data.get('until') is not None else None
+        if not all(math.isfinite(bound) for bound in (since, until) if bound is not None):
+            raise ValueError("since and until must be finite timestamps")
+        if cursor is not None:
+            cursor = int(cursor)
+    except (TypeError, ValueError) as e:
+        queue_message(outbound, {"error": f"Invalid search: {e}"})
+        return
+
+    rooms = timelines(user_id)
+    sent = 0
     while True:
-        clean_expired_message(ttl=ttl)
-        time.sleep(interval)  # Wait before running again
-                        
+        page = min(SEARCH_PAGE, limit - sent)
+        # The index covers the messages above the store's horizon, the
+        # cold tier those below it.
+        horizon = STORE.horizon
+        records, next_cursor = SEARCH.search(query, user_id, STORE.get, since=since, until=until,
+                                             pattern=pattern or None, cursor=cursor, limit=page, rooms=rooms,
+                                             floor=horizon)
+        if next_cursor is None and len(records) < page and horizon:
+            more, next_cursor = STORE.search_cold(query, user_id, since=since, until=until, pattern=pattern or None,
+                                                  cursor=cursor, limit=page - len(records), rooms=rooms)
+            records += more
+        cursor = next_cursor
+        sent += len(records)
+        # A page that used up its scan budget on stale or pattern-rejected
+        # hits ends the request, its cursor lets the client go on. Looping
+        # here instead could walk the whole index in one call.
+        done = cursor is None or sent >= limit or not records
+        queue_message(outbound, {
+            "action": 'SEARCH_RESULT',
+            "content": query,
+            "results": [record.to_message() for record in records],
+            "cursor": cursor,
+            "done": done,
+        })
+        if done:
+            return
 
-def handle_client(client_socket, client_address):
+def send_history(user_id, data, outbound):
+    """
+    Answer a HISTORY request with up to `limit` of the user's messages,
+    newest first, as HISTORY frames of HISTORY_PAGE messages. `cursor`
+    continues below an earlier page. `since` (the newest id the client
+    already has) only asks for newer messages, and the first frame then
+    also carries the older ones removed or expired since then in `changed`.
+    The last frame has done=True and a cursor for the next older page
+    (None when nothing is left).
+    """
     try:
-        # Send initial login prompt.
-        client_socket.send(json.dumps({"action": "LOGIN"}).encode('utf-8'))
-        data = json.loads(client_socket.recv(HEADER_LENGTH).decode('utf-8'))
-        username = data.get("username")
-        user_id = None
-        with lock:
-            # if user_id in USERS and USERS[user_id]['username'] == username:
-            #     print(f"{username} reconnected with ID {user_id}")
-            # else:
-            # Check unique user_id
-            # Generrate client's ID until the client's ID is unique
-            while True:
-                user_id = generate_user_id(username)
-                if user_id not in CLIENTS:
-                    break
-        
-            USERS[user_id] = {"username": username}
-            #save_users()
-            print(f"New user created: {username} with ID {user_id}")
-            CLIENTS[user_id] = {"socket": client_socket, "username": username}
-            MESSAGES[user_id] = {
-                'send' : [],
-                'receive' : []
-            }
-            create_client_message_folder(user_id=user_id)
-
-        # Send login confirmation.
-        client_socket.send(json.dumps({"status": "SUCCESS", "user_id": user_id}).encode('utf-8'))
-        
-        update_active_client_list()
-        
+        limit = min(max(int(data.get('limit') or HISTORY_PAGE), 1), MAX_HISTORY)
+        cursor = data.get('cursor')
+        since = data.get('since')
+        if cursor is not None:
+            int(cursor)
+        if since is not None:
+            int(since)
+    except (TypeError, ValueError) as e:
+        queue_message(outbound, {"error": f"Invalid history request: {e}"})
+        return
+
+    rooms = timelines(user_id)
+    changed = []
+    if since is not None:
+        changed = [record.to_message() for record in STORE.changed_since(user_id, since, rooms)]
+    sent = 0
+    while True:
+        page = min(HISTORY_PAGE, limit - sent)
+        records = STORE.history(user_id, before=cursor, after=since, limit=page, rooms=rooms)
+        sent += len(records)
+        # A full page may have more behind it.
+        cursor = records[-1].id if len(records) == page else None
+        done = cursor is None or sent >= limit
+        queue_message(outbound, {
+            "action": 'HISTORY',
+            "messages": [record.to_message() for record in records],
+            "changed": changed,
+            "cursor": cursor,
+            "done": done,
+        })
+        changed = []
+        if done:
+            return
+
+def send_room(room, outbound):
+    """Member list of a room, sent on JOIN and for every room at login."""
+    queue_message(outbound, {"action": 'ROOM', "room": room, "members": ROOMS.members(room)})
+
+def notify_room(room, user_id, action):
+    # The room's connected members, and the user who just left it.
+    fanout(ROOMS.members(room) + ([user_id] if action == 'LEAVE' else []),
+           {"action": action, "room": room, "sender": user_id})
+
+def change_room(user_id, action, room, outbound):
+    """JOIN or LEAVE a room on behalf of `user_id`."""
+    if not valid_room(room):
+        queue_message(outbound, {"error": f"Invalid room name: {room!r}"})
+        return
+    with roster_lock:
+        changed = ROOMS.join(room, user_id) if action == 'JOIN' else ROOMS.leave(room, user_id)
+        if changed:
+            log_user(user_id, USERS[user_id])
+    if changed:
+        notify_room(room, user_id, action)
+        publish({'type': 'room', 'room': room, 'user_id': user_id, 'action': action})
+    if action == 'JOIN':
+        send_room(room, outbound)
+
+def login_prompt():
+    prompt = {"action": "LOGIN"}
+    if COMPRESSION is not None:
+        prompt["compress"] = [COMPRESSION]
+    return prompt
+
+def negotiate_compression(data, buffer, outbound):
+    """
+    Turn on the compression a login request asked for, if it is the one
+    offered. Both directions are compressed from right after that request
+    on, starting with the reply to it. Returns its name if the connection
+    is compressed (by this request or an earlier, refused one), else None:
+    every login reply says so, so a client retrying a refused login knows
+    to keep compressing.
+    """
+    if outbound.compress is not None:
+        return COMPRESSION
+    if COMPRESSION is None or data.get("compress") != COMPRESSION:
+        return None
+    buffer.inflate(Inflater())
+    deflater = Deflater(COMPRESS_LEVEL)
+
+    def compress(batch):
+        data = deflater.compress(batch)
+        COMPRESS_INPUT.inc(len(batch))
+        COMPRESS_OUTPUT.inc(len(data))
+        return data
+
+    outbound.compress = compress
+    return COMPRESSION
+
+def login_client(username, conn, outbound, user_id=None, token=None, compress=None):
+    """
+    Register a freshly logged in client and return its user ID, or None if
+    the login was refused. A known `user_id` gets its mailbox back if the
+    client proves it with the resume `token` handed out at its last login
+    (or, for users from before tokens, with the same username); a valid
+    token also takes over a connection the server still believes is alive.
+    Anything else gets a new ID. Every successful login gets a new token.
+    `conn` is anything with close(): a TLS socket for the threaded engine
+    or an AsyncConnection for the asyncio engine. Everything sent to the
+    client goes through its `outbound` queue. `compress` is what
+    negotiate_compression() returned, for the reply.
+    """
+    start = time.perf_counter()
+    refused = None
+    stale = None
+    new_token = secrets.token_urlsafe(24)
+    with roster_lock:
+        known = USERS.get(user_id) if user_id else None
+        resumed = known is not None and check_token(known, token)
+        if known is not None and (resumed or (known.get('token') is None and known['username'] == username)):
+            if resumed:
+                # Probably a reconnect that beat the old connection's timeout.
+                stale = CLIENTS.pop(user_id, None)
+                if REMOTE_CLIENTS.pop(user_id, None) is not None:
+                    publish({'type': 'takeover', 'user_id': user_id})
+            elif is_online(user_id):
+                refused = f"{user_id} is already connected."
+            if refused is None:
+                username = known['username']
+                result = 'resumed' if resumed else 'reconnected'
+        else:
+            user_id = generate_user_id(username)
+            result = 'new'
+        if refused is None:
+            USERS[user_id] = {"username": username, "token": hash_token(new_token)}
+            log_user(user_id, USERS[user_id])
+            CLIENTS[user_id] = {"socket": conn, "username": username, "queue": outbound}
+            STORE.open_mailbox(user_id)
+
+    if refused is not None:
+        reply = {"status": "FAILED", "error": refused}
+        if compress is not None:
+            reply["compress"] = compress
+        queue_message(outbound, reply)
+        LOGINS['refused'].inc()
+        LOGIN_SECONDS.observe(time.perf_counter() - start)
+        return None
+    if stale is not None:
+        close_client(user_id, stale)
+
+    # Send login confirmation.
+    reply = {"status": "SUCCESS", "user_id": user_id, "token": new_token}
+    if compress is not None:
+        reply["compress"] = compress
+    queue_message(outbound, reply)
+
+    send_active_client_list(user_id, outbound)
+    for room in ROOMS.rooms_of(user_id):
+        send_room(room, outbound)
+    PRESENCE.joined(user_id)
+    publish({'type': 'join', 'user_id': user_id, 'username': username,
+             'token': USERS[user_id]['token'], 'worker': WORKER})
+    LOGINS[result].inc()
+    LOGIN_SECONDS.observe(time.perf_counter() - start)
+    log.info('login', result=result, username=username, user_id=user_id)
+    return user_id
+
+def disconnect_client(user_id, conn=None):
+    if user_id is not None and remove_connection(user_id, conn):
+        PRESENCE.left(user_id)
+        publish({'type': 'leave', 'user_id': user_id, 'worker': WORKER})
+
+def refuse_connection(ip):
+    """
+    Count a new connection from `ip` in (ADMISSION.release() counts it out
+    again), or return the BUSY frame to send it instead of the LOGIN prompt
+    before closing it: too many connections, or the server is overloaded.
+    The threaded engine asks before the TLS handshake, so it has no way to
+    send the frame and just closes the connection.
+    """
+    refused = ADMISSION.admit(ip)
+    if refused is None:
+        return None
+    reason, retry_after = refused
+    CONNECTIONS_REFUSED[reason].inc()
+    log.info('connection_refused', address=ip, reason=reason)
+    return {"action": "BUSY", "error": BUSY_REASONS[reason], "retry_after": retry_after}
+
+def login_allowed(data, ip, outbound, compress=None):
+    """
+    Check a login request against the login rate limits. If it is over
+    them it gets a FAILED reply with `retry_after` instead, and may be
+    tried again on the same connection once that time has passed.
+    `compress` is what negotiate_compression() returned.
+    """
+    wait, limit = ADMISSION.login_delay(ip, data.get("username"))
+    if not wait:
+        return True
+    RATE_LIMITED[limit].inc()
+    reply = {"status": "FAILED", "error": "Too many logins, try again shortly.", "retry_after": round(wait, 3)}
+    if compress is not None:
+        reply["compress"] = compress
+    queue_message(outbound, reply)
+    return False
+
+def request_delay(user_id, ip):
+    """
+    Seconds the next request of `user_id` has to wait, 0 if it may go now,
+    and what holds it back: a rate limit, or 'shed' while the server is
+    overloaded, which stops every connection's requests until it is not.
+    """
+    if ADMISSION.overloaded:
+        return SHED_DELAY, 'shed'
+    return ADMISSION.request_delay(user_id, ip)
+
+def hold_back(outbound, wait, limit):
+    # The request waits in the reader, and what the client sends after it
+    # waits in the socket buffers; a client that minds the FLOW frame
+    # doesn't send it in the first place.
+    RATE_LIMITED[limit].inc()
+    send_flow(outbound, True, wait)
+
+def handle_bus_event(event):
+    """Apply something that happened on another worker (--workers only)."""
+    kind = event.get('type')
+    if kind == 'message':
+        store_and_deliver(MessageRecord.from_message(event['record']))
+    elif kind == 'update':
+        update_and_notify(event['id'], event['fields'], event['notify'])
+    elif kind == 'join':
+        user_id = event['user_id']
+        with roster_lock:
+            USERS[user_id] = {"username": event['username'], "token": event.get('token')}
+            REMOTE_CLIENTS[user_id] = event['worker']
+            STORE.open_mailbox(user_id)
+        PRESENCE.joined(user_id)
+    elif kind == 'room':
+        with roster_lock:
+            if event['action'] == 'JOIN':
+                ROOMS.join(event['room'], event['user_id'])
+            else:
+                ROOMS.leave(event['room'], event['user_id'])
+        notify_room(event['room'], event['user_id'], event['action'])
+    elif kind == 'takeover':
+        # The user resumed on another worker, drop our stale connection
+        # without announcing a leave.
+        remove_connection(event['user_id'])
+    elif kind == 'leave':
+        user_id = event['user_id']
+        with roster_lock:
+            # A late leave from a worker the user already resumed away from.
+            if REMOTE_CLIENTS.get(user_id) != event['worker']:
+                return
+            del REMOTE_CLIENTS[user_id]
+        PRESENCE.left(user_id)
+    elif kind == 'exit':
+        # The worker is gone (its will, relayed by the hub): nobody is
+        # connected there any more, whether it said goodbye or not.
+        with roster_lock:
+            gone = [user_id for user_id, worker in REMOTE_CLIENTS.items() if worker == event['worker']]
+            for user_id in gone:
+                del REMOTE_CLIENTS[user_id]
+        for user_id in gone:
+            PRESENCE.left(user_id)
+
+def process_request(user_id, data, outbound):
+    """
+    Handle one request from a logged in client, timed per action.
+    Returns False once the client asked to leave.
+    """
+    action = data.get('action')
+    timer = REQUEST_SECONDS.get(action) if isinstance(action, str) else None
+    with (timer or REQUEST_SECONDS['other']).time():
+        return handle_request(user_id, action, data, outbound)
+
+def handle_request(user_id, action, data, outbound):
+    #TEST DATA
+    #print(data)
+
+    #HANDLE RECEIVING MESSAGE
+    if action in ('MESSAGE', 'TEMPORARY', 'REPLY'):
+        error = message_error(action, data)
+        if error is not None:
+            queue_message(outbound, {"error": f"Invalid message: {error}"})
+            return True
+    room = data.get('room')
+    if room is not None and action in ('MESSAGE', 'TEMPORARY', 'REPLY') and \
+            not (valid_room(room) and ROOMS.is_member(room, user_id)):
+        queue_message(outbound, {"error": f"You are not in #{room}."})
+        return True
+
+    if action == 'MESSAGE' or action == 'TEMPORARY':
+        receiver = data.get('receiver') or []
+        public = room is None and "all" in receiver
+        if room is not None:
+            # Stored once on the room's timeline, members are looked up on delivery.
+            recipients = []
+        elif public:
+            # Stored once on the public timeline, sent to everybody online.
+            recipients = []
+        else:
+            #Send toward ACTIVE user
+            recipients = [uid for uid in set(receiver) if is_online(uid) and uid != user_id]
+
+        record = new_record(user_id, data, action, recipients, room, public)
+        if action == 'TEMPORARY':
+            record.ttl = message_ttl(data)
+        send_new_message(record)
+        if action == 'TEMPORARY':
+            EXPIRY.schedule(record.id, record.ttl)
+
+    elif action == "REPLY":
+        # Goes wherever the message it answers went; clients only name that.
+        target = reply_target(user_id, data.get('optional'))
+        if target is None:
+            queue_message(outbound, {"error": f"No message {data.get('optional')} to reply to."})
+            return True
+        recipients, room, public, private = target
+        if room is not None and not ROOMS.is_member(room, user_id):
+            queue_message(outbound, {"error": f"You are not in #{room}."})
+            return True
+        record = new_record(user_id, data, action, recipients, room, public)
+        record.optional = data.get('optional')
+        record.private = private
+        send_new_message(record)
 
+    elif action == "DELETE":
+        message_id = data.get('content')
+        if not isinstance(message_id, str):
+            queue_message(outbound, {"error": f"Message ID {message_id} not found or belong to the user."})
+            return True
+
+        fields = {'content': 'THIS MESSAGE IS REMOVED', 'changed': IDS.next_id()}
+        sending_list = None
+        with STORE.lock_for(message_id):
+            record = STORE.get(message_id)
+            if record is not None and record.sender == user_id:
+                change_record(record, fields)
+                sending_list = audience(record)
+
+        if sending_list is None:
+            queue_message(outbound, {"error": f"Message ID {message_id} not found or belong to the user."})
+            return True
+
+        index_change(record, fields)
+        fanout(sending_list, data)
+        publish({'type': 'update', 'id': message_id, 'fields': fields, 'notify': data})
+
+
+    elif action == "SEARCH":
+        send_search_results(user_id, data, outbound)
+
+    elif action == "HISTORY":
+        send_history(user_id, data, outbound)
+
+    elif action == "JOIN" or action == "LEAVE":
+        change_room(user_id, action, data.get('room'), outbound)
+
+    elif action == "EXIT":
+        log.info('exit_requested', user_id=user_id)
+        return False
+    return True
+
+def shutdown_socket(sock):
+    # Wakes up the reader thread blocked in recv() so it can clean up.
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def wait_socket(sock, writing, timeout):
+    """Wait up to `timeout` seconds for `sock` to be readable (or writable). False on timeout."""
+    timeout = max(timeout, 0)
+    if hasattr(select, 'poll'):
+        # No FD_SETSIZE limit, unlike select().
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT if writing else select.POLLIN)
+        return bool(poller.poll(timeout * 1000))
+    readable, writable, _ = select.select([] if writing else [sock], [sock] if writing else [], [], timeout)
+    return bool(readable or writable)
+
+def tls_handshake(raw_socket, client_address, context):
+    """
+    Server side of the TLS handshake on a freshly accepted socket. It is
+    driven non-blocking against a deadline, so a client gets
+    HANDSHAKE_TIMEOUT seconds for all of it however slowly it trickles its
+    bytes in. Returns the TLS socket, blocking again, or None once the
+    connection is closed.
+    """
+    start = time.perf_counter()
+    deadline = time.monotonic() + HANDSHAKE_TIMEOUT
+    sock = raw_socket
+    try:
+        raw_socket.setblocking(False)
+        sock = context.wrap_socket(raw_socket, server_side=True, do_handshake_on_connect=False)
         while True:
-            data = json.loads(client_socket.recv(HEADER_LENGTH).decode('utf-8'))
-            action = data.get('action')
-            #TEST DATA
-            #print(data)
-            if not data:    
-                print("Client {client_address} disconnected")
-                remove_connection(user_id)
-                update_active_client_list()
+            try:
+                sock.do_handshake()
                 break
+            except ssl.SSLWantReadError:
+                ready = wait_socket(sock, False, deadline - time.monotonic())
+            except ssl.SSLWantWriteError:
+                ready = wait_socket(sock, True, deadline - time.monotonic())
+            if not ready:
+                raise TimeoutError(f"no TLS handshake within {HANDSHAKE_TIMEOUT}s")
+    except OSError as e:
+        # A plain TCP probe, a client that doesn't speak our TLS, a reset...
+        result = 'timeout' if isinstance(e, TimeoutError) else 'failed'
+        HANDSHAKES[result].inc()
+        log.info('handshake_failed', address=address_text(client_address), result=result, error=e)
+        sock.close()
+        return None
+    sock.setblocking(True)
+    HANDSHAKE_SECONDS.observe(time.perf_counter() - start)
+    HANDSHAKES['resumed' if sock.session_reused else 'full'].inc()
+    return sock
 
-            #HANDLE RECEIVING MESSAGE
-            if action == 'MESSAGE' or action == 'TEMPORARY':
-                
-                # Check unique message_id
-                # Generate ID until the message ID is unique
-                message_id = None
-                with lock:
-                    while(True):
-                        message_id = generate_message_id()
-                        if message_id not in USED_MSSG_ID:
-                            USED_MSSG_ID.add(message_id)
-                            break
-
-                receiver = data.get('receiver')
-                
-                
-                data['id'] = message_id
-                sending_list = []
-                if "all" in receiver:
-                    sending_list =list(CLIENTS.keys())
-                    data['receiver'] = [uid for uid in sending_list if uid != user_id]
-                else:
-                    #Send toward ACTIVE user
-                    sending_list = list(set(receiver) & set(CLIENTS.keys())) + [user_id]
-
-
-                with lock:
-                    for client_id in sending_list:
-                        if client_id == user_id:
-                            MESSAGES[user_id]['send'].append(data)
-                        else:
-                            MESSAGES[client_id]['receive'].append(data)
-                
-                for client_id in sending_list:
-                    broadcast_message(CLIENTS[client_id],message=data)
-            elif action == "REPLY":
-                
-                message_id = None
-
-                with lock:
-                    while(True):
-                        message_id = generate_message_id()
-                        if message_id not in USED_MSSG_ID:
-                            USED_MSSG_ID.add(message_id)
-                            break
-                
-                # data = {
-                #         "id": None,
-                #         "action": 'REPLY',
-                #         "sender": sender_id,
-                #         "receiver": receivers,
-                #         "content": msg_content,
-                #         "time": None,
-                #         "private": False,
-                #         "optional": msg_id_replied
-                # }
-
-                data['id'] = message_id
-                
-                sending_list = data["receiver"]
-
-                with lock:
-                    for client_id in sending_list:
-                        if client_id == user_id:
-                            MESSAGES[user_id]['send'].append(data)
-                        else:
-                            MESSAGES[client_id]['receive'].append(data)
-
-                for client_id in sending_list:
-                    
-                    broadcast_message(CLIENTS[client_id],message=data)
-                    
-
-
-            elif action == "DELETE":
-                message_id = data['content']
-                sender_id = data['sender']
-                
-                with lock:
-                    message_to_delete = False
-                    for msg in MESSAGES[sender_id]['send']:
-                        if message_id == msg['id']:
-                            msg['content'] = 'THIS MESSAGE IS REMOVED'
-                            sending_list = msg['receiver'][:] + [sender_id]
-                            for client_id in sending_list:
-                                broadcast_message(CLIENTS[client_id],message=data)
-                            message_to_delete = True
-                            break
-
-                    if message_to_delete == False:
-                        client_socket.send(json.dumps({"error": f"Message ID {message_id} not found or belong to the user."}).encode('utf-8'))
-                        continue
-
-
-            elif action == "EXIT":
-                print(f"{username} requested disconnect.")
-                remove_connection(user_id)
-                update_active_client_list()
+def handle_client(raw_socket, client_address, context):
+    # run_threaded() already counted the connection in.
+    ip = client_address[0]
+    client_socket = tls_handshake(raw_socket, client_address, context)
+    if client_socket is None:
+        CONNECTIONS_CLOSED.inc()
+        ADMISSION.release(ip)
+        return
+    user_id = None
+    buffer = FrameBuffer()
+    outbound = new_outbound_queue(on_overflow=lambda: shutdown_socket(client_socket))
+    threading.Thread(target=socket_writer, args=(outbound, client_socket, lambda: shutdown_socket(client_socket)), daemon=True).start()
+    try:
+        # Send initial login prompt.
+        queue_message(outbound, login_prompt())
+        while user_id is None:
+            data = recv_message(client_socket, buffer)
+            if data is None:
+                return
+            compress = negotiate_compression(data, buffer, outbound)
+            if login_allowed(data, ip, outbound, compress):
+                user_id = login_client(data.get("username"), client_socket, outbound,
+                                       data.get("user_id"), data.get("token"), compress)
+
+        connected = True
+        while connected:
+            if buffer.recv_from(client_socket) == 0:
+                log.info('client_disconnected', address=address_text(client_address))
                 break
+            # One read may carry several requests (or only part of one).
+            for frame in buffer.frames():
+                wait, limit = request_delay(user_id, ip)
+                if wait:
+                    hold_back(outbound, wait, limit)
+                    start = time.monotonic()
+                    while wait:
+                        time.sleep(wait)
+                        wait, limit = request_delay(user_id, ip)
+                    THROTTLED_SECONDS.inc(time.monotonic() - start)
+                if not process_request(user_id, decode_message(frame), outbound):
+                    connected = False
+                    break
+                if outbound.pressured:
+                    outbound.wait_drained()
     except Exception as e:
-        print(f"Error with client {client_address}: {e}")
+        CONNECTION_ERRORS.inc()
+        log.warning('client_error', address=address_text(client_address), error=e)
     finally:
+        CONNECTIONS_CLOSED.inc()
+        disconnect_client(user_id, client_socket)
+        outbound.close()
         client_socket.close()
+        ADMISSION.release(ip)
 
-def main():
 
+class AsyncConnection:
+    """
+    Socket-like handle on an asyncio StreamWriter for the shared protocol
+    code. Calls coming from other threads (e.g. the cleanup loop enqueueing
+    into this client's outbound queue) are handed over to the event loop
+    instead of touching the transport directly.
+    """
+    __slots__ = ('writer', 'loop', 'loop_thread', 'wake', 'drained')
+
+    def __init__(self, writer, loop):
+        self.writer = writer
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.wake = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.drained.set()
+
+    def _call(self, callback):
+        if threading.get_ident() == self.loop_thread:
+            callback()
+        else:
+            self.loop.call_soon_threadsafe(callback)
+
+    def wakeup(self):
+        # Outbound queue went non-empty: let the writer task run.
+        self._call(self.wake.set)
+
+    def pressure(self, paused):
+        # Outbound queue backed up (or drained again): pause/resume reading.
+        self._call(self.drained.clear if paused else self.drained.set)
+
+    def close(self):
+        self._call(self.writer.close)
+
+    def abort(self):
+        # close() would wait for the peer to take the buffered data first,
+        # which a slow consumer never does.
+        self._call(self.writer.transport.abort)
+
+
+def reads_cold(action):
+    # Only once something has spilled, until then everything is in RAM.
+    return action in COLD_READS and bool(STORE.horizon or STORE.changes_horizon)
+
+async def handle_client_async(reader, writer):
+    CONNECTIONS_ACCEPTED.inc()
+    client_address = writer.get_extra_info('peername')
+    # asyncio ran the handshake (ssl_handshake_timeout), failed ones never get here.
+    HANDSHAKES['resumed' if writer.get_extra_info('ssl_object').session_reused else 'full'].inc()
+    ip = client_address[0]
+    busy = refuse_connection(ip)
+    if busy is not None:
+        # close() sends what was written first.
+        writer.write(encode_message(busy))
+        CONNECTIONS_CLOSED.inc()
+        writer.close()
+        return
+    conn = AsyncConnection(writer, asyncio.get_running_loop())
+    buffer = FrameBuffer()
+    outbound = new_outbound_queue(on_overflow=conn.abort, wakeup=conn.wakeup, on_pressure=conn.pressure)
+    writer_task = asyncio.create_task(stream_writer(outbound, writer, conn.wake))
+    user_id = None
+    try:
+        # Send initial login prompt.
+        queue_message(outbound, login_prompt())
+        connected = True
+        while connected:
+            chunk = await reader.read(READ_CHUNK)
+            if not chunk:
+                log.info('client_disconnected', address=address_text(client_address))
+                break
+            buffer.feed(chunk)
+            for frame in buffer.frames():
+                data = decode_message(frame)
+                if user_id is None:
+                    compress = negotiate_compression(data, buffer, outbound)
+                    if login_allowed(data, ip, outbound, compress):
+                        user_id = login_client(data.get("username"), conn, outbound,
+                                               data.get("user_id"), data.get("token"), compress)
+                else:
+                    wait, limit = request_delay(user_id, ip)
+                    if wait:
+                        hold_back(outbound, wait, limit)
+                        start = time.monotonic()
+                        while wait:
+                            await asyncio.sleep(wait)
+                            wait, limit = request_delay(user_id, ip)
+                        THROTTLED_SECONDS.inc(time.monotonic() - start)
+                    if reads_cold(data.get('action')):
+                        # Disk reads under the cold tier's lock would stall
+                        # every connection on the loop, a worker thread waits
+                        # for them instead. This connection's next request
+                        # still waits for the answer.
+                        keep = await conn.loop.run_in_executor(None, process_request, user_id, data, outbound)
+                    else:
+                        keep = process_request(user_id, data, outbound)
+                    if not keep:
+                        connected = False
+                        break
+                if outbound.pressured:
+                    await conn.drained.wait()
+    except Exception as e:
+        CONNECTION_ERRORS.inc()
+        log.warning('client_error', address=address_text(client_address), error=e)
+    finally:
+        CONNECTIONS_CLOSED.inc()
+        disconnect_client(user_id, conn)
+        outbound.close()
+        writer_task.cancel()
+        writer.close()
+        ADMISSION.release(ip)
+
+
+def raise_open_file_limit():
+    # Every idle connection costs a file descriptor, lift the soft limit
+    # as far as the hard limit allows.
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+def create_tls_context():
     #TLS/SSL
     context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
     context.load_cert_chain(certfile='cert.pem', keyfile='key.pem')
+    # Forward secret AEAD suites in our order, not the client's, and no
+    # renegotiation: each one would cost another full handshake.
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.set_ciphers(TLS_CIPHERS)
+    context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE | ssl.OP_NO_RENEGOTIATION
+    # Session tickets let reconnecting clients skip the full handshake.
+    # Their keys live in this context, so they are valid until a restart.
+    context.num_tickets = TLS_TICKETS
+    return context
+
+def watch_load():
+    """
+    Thread body: raise ADMISSION.overloaded while the event loop lags or
+    the clients' outbound queues hold more than the shed_* limits allow,
+    and lower it again once they don't.
+    """
+    while True:
+        time.sleep(LOAD_INTERVAL)
+        lagging = ADMISSION.shed_lag and LOOP_LAG_SECONDS > ADMISSION.shed_lag
+        queued = outbound_stats()['depth'] if ADMISSION.shed_queued else 0
+        overloaded = bool(lagging or (ADMISSION.shed_queued and queued > ADMISSION.shed_queued))
+        if overloaded != ADMISSION.overloaded:
+            ADMISSION.overloaded = overloaded
+            if overloaded:
+                log.warning('overloaded', loop_lag=round(LOOP_LAG_SECONDS, 3), queued=queued)
+            else:
+                log.info('overload_cleared', loop_lag=round(LOOP_LAG_SECONDS, 3), queued=queued)
+
+async def watch_loop_lag():
+    # A timer that fires late means callbacks queued behind it wait as long.
+    global LOOP_LAG_SECONDS
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOAD_INTERVAL)
+        LOOP_LAG_SECONDS = max(0.0, loop.time() - start - LOAD_INTERVAL)
+        LOOP_LAG.observe(LOOP_LAG_SECONDS)
 
+def start_background_threads():
+    threading.Thread(target=EXPIRY.run, daemon=True).start()
+    threading.Thread(target=PRESENCE.run, args=(publish_presence,), daemon=True).start()
+    threading.Thread(target=watch_load, daemon=True).start()
+
+def run_threaded(context):
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if REUSE_PORT:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server_socket.bind((IP, PORT))
     server_socket.listen(BACK_LOG)
-    print(f"Server listening on {IP}:{PORT}")
+    log.info('listening', address=f"{IP}:{PORT}", engine='threaded')
 
-    with context.wrap_socket(server_socket, server_side=True) as tls_server:
-        threading.Thread(target=cleanup_loop, daemon=True).start()
+    with server_socket:
+        start_background_threads()
         while True:
-            client_socket, client_address = tls_server.accept()
-            threading.Thread(target=handle_client, args=(client_socket, client_address), daemon=True).start()
+            # Plain accept: the TLS handshake runs on the connection's own
+            # thread, so a client that stalls it only holds up itself.
+            try:
+                client_socket, client_address = server_socket.accept()
+            except OSError as e:
+                # Out of file descriptors, or a connection reset before we
+                # got to it. Keep serving the others.
+                ACCEPT_ERRORS.inc()
+                log.warning('accept_failed', error=e)
+                time.sleep(0.1)
+                continue
+            CONNECTIONS_ACCEPTED.inc()
+            # Counted in before the handshake: a connection still shaking
+            # hands holds a thread, so it counts against the caps too.
+            if refuse_connection(client_address[0]) is not None:
+                CONNECTIONS_CLOSED.inc()
+                client_socket.close()
+                continue
+            threading.Thread(target=handle_client, args=(client_socket, client_address, context),
+                             daemon=True).start()
+
+async def serve_async(context):
+    raise_open_file_limit()
+    server = await asyncio.start_server(
+        handle_client_async, IP, PORT,
+        ssl=context,
+        ssl_handshake_timeout=HANDSHAKE_TIMEOUT,
+        backlog=BACK_LOG,
+        reuse_address=True,
+        reuse_port=REUSE_PORT or None,
+    )
+    log.info('listening', address=f"{IP}:{PORT}", engine='asyncio')
+    # The expiry scheduler and presence flusher run on their own threads, they
+    # only touch shared state under its own locks and reach sockets through
+    # the clients' outbound queues.
+    start_background_threads()
+    lag_watcher = asyncio.create_task(watch_loop_lag())
+    async with server:
+        await server.serve_forever()
+    lag_watcher.cancel()
+
+def register_gauges():
+    """Scrape-time views of state the server keeps anyway."""
+    def outbound(field):
+        return lambda: outbound_stats()[field]
+    METRICS.gauge('chat_clients_connected', "Clients connected to this process", lambda: len(CLIENTS))
+    METRICS.gauge('chat_clients_remote', "Clients connected to other workers", lambda: len(REMOTE_CLIENTS))
+    METRICS.gauge('chat_users', "Known users", lambda: len(USERS))
+    METRICS.gauge('chat_messages_stored', "Messages in the store", lambda: len(STORE))
+    METRICS.gauge('chat_rooms', "Rooms with at least one member", lambda: len(ROOMS))
+    METRICS.gauge('chat_expiries_pending', "Temporary messages waiting to expire", lambda: len(EXPIRY))
+    METRICS.gauge('chat_outbound_queue_depth', "Frames queued, over all clients", outbound('depth'))
+    METRICS.gauge('chat_outbound_queue_max_depth', "Frames queued for the most backed up client",
+                  outbound('max_depth'))
+    METRICS.gauge('chat_outbound_frames_dropped', "Frames the connected clients' queues dropped",
+                  outbound('dropped'))
+    METRICS.gauge('chat_connections_open', "Connections open, logged in or not", lambda: ADMISSION.open)
+    METRICS.gauge('chat_overloaded', "1 while requests and new connections are being shed",
+                  lambda: int(ADMISSION.overloaded))
+    if LOG is not None:
+        METRICS.gauge('chat_msglog_pending', "Log entries waiting for their commit", lambda: LOG.stats()['pending'])
+        METRICS.gauge('chat_msglog_commits', "Group commits since start", lambda: LOG.stats()['commits'])
+    if STORE.budget is not None:
+        def store(field):
+            return lambda: STORE.stats()[field]
+        METRICS.gauge('chat_store_hot_bytes', "Estimated bytes of the messages held in RAM", store('hot_bytes'))
+        METRICS.gauge('chat_store_hot_messages', "Messages held in RAM", store('hot_messages'))
+        METRICS.gauge('chat_store_cold_messages', "Messages spilled to the cold tier", store('cold_messages'))
+        METRICS.gauge('chat_store_spills', "Spill batches written to the cold tier", store('spills'))
+        METRICS.gauge('chat_store_paged_in', "Cold messages read back into RAM", store('paged_in'))
+        METRICS.gauge('chat_store_cold_bytes', "Size of the cold tier file", store('cold_bytes'))
+    if BUS is not None:
+        METRICS.gauge('chat_bus_queue_depth', "Events queued for the other workers", lambda: BUS.stats()['depth'])
+
+def address_text(address):
+    # Unix socket path or (host, port, ...) tuple.
+    return address if isinstance(address, str) else f"{address[0]}:{address[1]}"
+
+def admin_limits(args):
+    """Admin command "limits": every limit as JSON."""
+    if args:
+        raise ValueError("limits only shows the limits, change them with: set-limits name=value ...")
+    state = dict(ADMISSION.settings(), open=ADMISSION.open, overloaded=ADMISSION.overloaded)
+    return 200, JSON_TYPE, json.dumps(state, indent=1) + '\n'
+
+def admin_set_limits(args):
+    """
+    Admin command "set-limits message=20:40 connections=5000": applies the
+    changes, then answers like "limits". A line command only (see admin.py).
+    """
+    if not args:
+        raise ValueError("usage: set-limits name=value ...")
+    ADMISSION.update(args)
+    log.info('limits_changed', changes=' '.join(args))
+    return admin_limits(())
+
+def start_admin(address):
+    global ADMIN
+    register_gauges()
+    ADMIN = AdminServer(address, METRICS)
+    ADMIN.command('limits', admin_limits)
+    ADMIN.command('set-limits', admin_set_limits, mutating=True)
+    ADMIN.start()
+    log.info('admin_listening', address=address_text(address))
+
+def open_cold_store(budget, data_dir=None):
+    # The cold tier is scratch space rebuilt on every start: next to the
+    # message log when there is one, otherwise a temporary file that is
+    # unlinked right away and lives as long as the open connection.
+    if data_dir is not None:
+        os.makedirs(data_dir, exist_ok=True)
+        cold = ColdStore(os.path.join(data_dir, COLD_FILE))
+    else:
+        fd, path = tempfile.mkstemp(prefix='chat-cold-', suffix='.db')
+        os.close(fd)
+        cold = ColdStore(path)
+        os.remove(path)
+    STORE.enable_cold(cold, budget, on_spill=SEARCH.forget)
+    log.info('memory_budget', budget=budget, cold_file=cold.path)
+
+def open_log(data_dir, sibling_dirs=()):
+    global LOG
+    LOG = MessageLog(data_dir)
+    load_state(sibling_dirs)
+    LOG.start()
+
+def run_engine(engine, context):
+    try:
+        if engine == 'asyncio':
+            asyncio.run(serve_async(context))
+        else:
+            run_threaded(context)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if LOG is not None:
+            LOG.close()
+
+def worker_data_dir(data_dir, index):
+    return os.path.join(data_dir, f"worker-{index}")
+
+def run_worker(index, args, hub, context):
+    """
+    Body of one --workers process: its own listening socket on the shared
+    port, its own node ID, its own log directory, and the bus for
+    everything that involves clients of other workers.
+    """
+    global IDS, BUS, WORKER, REUSE_PORT
+    hub.close_in_child()
+    WORKER = index
+    REUSE_PORT = True
+    IDS = SnowflakeGenerator(node=args.node_id + index)
+    logs.set_context(worker=index)
+    log.info('worker_started', pid=os.getpid(), node=IDS.node)
+    BUS = BusClient(hub.path, on_event=handle_bus_event, will={'type': 'exit', 'worker': index})
+    BUS.connect()
+    if args.memory_budget:
+        open_cold_store(args.memory_budget, worker_data_dir(args.data_dir, index) if args.data_dir else None)
+    if args.data_dir:
+        # Every worker replays all logs, since it keeps every message.
+        siblings = [os.path.join(args.data_dir, name) for name in sorted(os.listdir(args.data_dir))
+                    if name.startswith('worker-') and name != f"worker-{index}"]
+        open_log(worker_data_dir(args.data_dir, index), siblings)
+    if args.admin:
+        start_admin(worker_address(args.admin, index))
+    run_engine(args.engine, context)
+
+def run_workers(args):
+    """Fork the workers and relay bus traffic between them until they exit."""
+    bus_dir = tempfile.mkdtemp(prefix='chat-bus-')
+    hub = BusHub(os.path.join(bus_dir, 'bus.sock'))
+    hub.bind()
+    if args.data_dir:
+        os.makedirs(args.data_dir, exist_ok=True)
+    # One TLS context for all workers: they share its session ticket keys,
+    # so a client can resume its session on whichever worker it lands on.
+    context = create_tls_context()
+    fork = multiprocessing.get_context('fork')
+    workers = [fork.Process(target=run_worker, args=(index, args, hub, context), name=f"worker-{index}")
+               for index in range(args.workers)]
+    # Fork before the hub starts any thread.
+    for worker in workers:
+        worker.start()
+    hub.start()
+    log.info('workers_started', workers=args.workers, address=f"{IP}:{PORT}")
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # The workers got the same SIGINT, give them time to flush their logs.
+        for worker in workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.terminate()
+    finally:
+        shutil.rmtree(bus_dir, ignore_errors=True)
+
+def main():
+    global OUTBOUND_LIMIT, OVERFLOW_POLICY, COMPRESSION, COMPRESS_LEVEL, HANDSHAKE_TIMEOUT, IDS
+    parser = argparse.ArgumentParser(description="TLS chat server")
+    parser.add_argument('--engine', choices=('threaded', 'asyncio'), default='threaded',
+                        help="threaded: one OS thread per connection (default); "
+                             "asyncio: single event loop for all connections")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of server processes sharing the port (SO_REUSEPORT); "
+                             "worker i uses node ID --node-id + i")
+    parser.add_argument('--outbound-limit', type=int, default=OUTBOUND_LIMIT,
+                        help="frames buffered per client before the overflow policy applies")
+    parser.add_argument('--overflow-policy', choices=OVERFLOW_POLICIES, default=OVERFLOW_POLICY,
+                        help="what to do with a client whose outbound queue is full")
+    parser.add_argument('--codec', choices=sorted(CODECS), default=CODEC,
+                        help="payload codec, must match the clients' CODEC setting")
+    parser.add_argument('--compression', choices=COMPRESSIONS + ('none',), default=COMPRESSION,
+                        help="stream compression offered to clients at login (default: %(default)s)")
+    parser.add_argument('--compress-level', type=int, choices=range(1, 10), default=COMPRESS_LEVEL, metavar='1-9',
+                        help="zlib level for compressed connections (default: %(default)s)")
+    parser.add_argument('--handshake-timeout', type=float, default=HANDSHAKE_TIMEOUT, metavar='SECONDS',
+                        help="time a new connection gets to complete the TLS handshake (default: %(default)s)")
+    parser.add_argument('--node-id', type=int, default=NODE_ID,
+                        help="ID generator node number (0-1023)")
+    parser.add_argument('--data-dir', default=None,
+                        help="keep users and messages in an append-only log in this directory "
+                             "(default: memory only)")
+    parser.add_argument('--memory-budget', type=parse_size, default=None, metavar='SIZE',
+                        help="keep about this much message data in RAM (e.g. 256M) and spill older "
+                             "messages to an on-disk cold tier (default: keep everything in RAM)")
+    parser.add_argument('--admin', type=parse_address, default=None, metavar='ADDR',
+                        help="serve metrics on a Unix socket path or [host:]port: Prometheus text "
+                             "at /metrics, JSON at /metrics.json, limits at /limits "
+                             "(worker i uses path.i or port + i)")
+    parser.add_argument('--limit', action='append', default=[], metavar='NAME=VALUE',
+                        help="a rate limit, connection cap or overload threshold, e.g. message=20:40 "
+                             "or connections=10000 (repeatable, all off by default; see limits.py)")
+    parser.add_argument('--log-level', choices=('debug', 'info', 'warning', 'error'), default='info')
+    parser.add_argument('--log-format', choices=logs.FORMATS, default='text',
+                        help="text: logfmt lines; json: one JSON object per line")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    try:
+        ADMISSION.update(args.limit)
+    except ValueError as e:
+        parser.error(f"--limit: {e}")
+    if args.workers > 1:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            parser.error("--workers needs SO_REUSEPORT, which this platform lacks")
+        if args.node_id + args.workers - 1 > 1023:
+            parser.error("--node-id + --workers - 1 must not exceed 1023")
+
+    logs.configure(args.log_level, args.log_format, on_suppress=LOG_SUPPRESSED.inc)
+    OUTBOUND_LIMIT = args.outbound_limit
+    OVERFLOW_POLICY = args.overflow_policy
+    framing.set_codec(args.codec)
+    COMPRESSION = None if args.compression == 'none' else args.compression
+    COMPRESS_LEVEL = args.compress_level
+    HANDSHAKE_TIMEOUT = args.handshake_timeout
+    if args.workers > 1:
+        run_workers(args)
+        return
+
+    IDS = SnowflakeGenerator(node=args.node_id)
+    if args.memory_budget:
+        open_cold_store(args.memory_budget, args.data_dir)
+    if args.data_dir:
+        open_log(args.data_dir)
+    if args.admin:
+        start_admin(args.admin)
+    run_engine(args.engine, create_tls_context())
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,590 @@
+# store.py
+# Server-side message store. Every message is kept exactly once as a compact
+# MessageRecord in an id -> record hash index; user mailboxes and room
+# timelines are just lists of message ids in id (= time) order, so lookups by id (DELETE,
+# expiry, replies) are O(1) and a page of history is O(page + log n) no
+# matter how much history there is.
+#
+# With a memory budget (enable_cold()) that is only true of the hot tier:
+# a background thread spills the oldest messages, with their mailbox
+# entries and removal records, into the on-disk cold tier (coldstore.py)
+# whenever the estimated size of what is in RAM goes over the budget.
+# Messages are spilled strictly in id order, so everything up to `horizon`
+# is cold and everything above it is hot; reads below the horizon page
+# records back in, through a small LRU cache.
+import bisect
+import dataclasses
+import heapq
+import sqlite3
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from coldstore import RECEIVE, ROOM, SEND, match_query
+from framing import CODECS
+from logs import get_logger
+from ids import id_floor
+from rooms import PUBLIC
+from search import DEFAULT_LIMIT, SCAN_BUDGET, tokenize
+
+DEFAULT_SHARDS = 16
+SPILL_TARGET = 0.9          # a spill brings the hot tier down to this share of the budget
+THROTTLE_FACTOR = 2         # throttle() waits while the hot tier is over this many budgets
+CHANGES_SHARE = 0.05        # share of the budget for the list of removals/expiries
+PAGED_LIMIT = 1024          # records paged back in from the cold tier and kept in RAM
+COLD_FETCH = 500            # ids per cold-tier lookup
+SPILL_BATCH = 10000         # messages per cold-tier transaction
+# Rough RAM cost of a hot message beyond its content: the record, its id and
+# time strings, the index entry, and per recipient a mailbox entry and a
+# search posting. Only used to decide when to spill.
+RECORD_OVERHEAD = 400
+RECIPIENT_BYTES = 80
+CHANGE_BYTES = 150
+
+_dumps, _loads = CODECS['json']
+log = get_logger('store')
+
+
+def parse_size(text):
+    """'512M' -> 536870912; K, M and G are powers of 1024."""
+    text = text.strip().upper().removesuffix('B')
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    scale = units.get(text[-1:], 1)
+    size = int(float(text[:-1] if text[-1:] in units else text) * scale)
+    if size <= 0:
+        raise ValueError("size must be positive")
+    return size
+
+
+@dataclass(slots=True)
+class MessageRecord:
+    id: str
+    action: str             # MESSAGE / TEMPORARY / REPLY, DELETE once expired
+    sender: str
+    receiver: tuple         # recipients, not including the sender
+    content: str
+    time: str
+    private: bool = False
+    optional: str = None    # id of the message replied to
+    ttl: float = None       # lifetime of a TEMPORARY message, in seconds
+    changed: int = None     # snowflake taken when it was last removed/expired
+    room: str = None        # room it was sent to; members are looked up, not stored
+    public: bool = False    # sent to "all": filed once on the PUBLIC timeline, `receiver` stays empty
+
+    @classmethod
+    def from_message(cls, message):
+        return cls(
+            id=message['id'],
+            action=message['action'],
+            sender=message['sender'],
+            receiver=() if message.get('public') else tuple(message.get('receiver') or ()),
+            content=message.get('content') or '',
+            time=message.get('time'),
+            private=bool(message.get('private')),
+            optional=message.get('optional'),
+            ttl=message.get('ttl'),
+            changed=message.get('changed'),
+            room=message.get('room'),
+            public=bool(message.get('public')),
+        )
+
+    def to_message(self):
+        """
+        Protocol dict sent to clients. A public message names its audience
+        as ["all"], so it stays the same size however many users got it.
+        """
+        message = {
+            "id": self.id,
+            "action": self.action,
+            "sender": self.sender,
+            "receiver": ["all"] if self.public else list(self.receiver),
+            "content": self.content,
+            "time": self.time,
+            "private": self.private,
+            "optional": self.optional,
+        }
+        if self.ttl is not None:
+            message["ttl"] = self.ttl
+        if self.room is not None:
+            message["room"] = self.room
+        return message
+
+    def to_entry(self):
+        """
+        Everything from_message() needs to rebuild it, for the message log
+        and the bus. A public message is just flagged as such: its size
+        doesn't depend on how many users are online.
+        """
+        message = self.to_message()
+        if self.public:
+            message["receiver"] = []
+            message["public"] = True
+        return message
+
+    @property
+    def timeline(self):
+        """The shared timeline it is filed on: its room, PUBLIC, or None (mailboxes only)."""
+        return PUBLIC if self.public else self.room
+
+    def audience(self):
+        """Everybody who holds this message: recipients and sender (a room's members come on top)."""
+        return list(self.receiver) + [self.sender]
+
+    def visible_to(self, user_id, rooms=()):
+        """`rooms`: the timelines `user_id` reads, its rooms and PUBLIC."""
+        return self.sender == user_id or user_id in self.receiver or \
+            (self.timeline is not None and self.timeline in rooms)
+
+
+def message_order(message_id):
+    return int(message_id)
+
+
+_FIELDS = tuple(field.name for field in dataclasses.fields(MessageRecord))
+
+
+def encode_record(record):
+    return _dumps([getattr(record, name) for name in _FIELDS])
+
+
+def decode_record(data):
+    record = MessageRecord(*_loads(data))
+    record.receiver = tuple(record.receiver)
+    return record
+
+
+def approx_size(record):
+    return RECORD_OVERHEAD + len(record.content) + RECIPIENT_BYTES * len(record.receiver)
+
+
+def _plain_lock(lock, kind):
+    return lock
+
+
+class Mailbox:
+    __slots__ = ('send', 'receive', 'lock')
+
+    def __init__(self, wrap_lock=_plain_lock):
+        self.send = []      # ids of messages this user sent, in id order
+        self.receive = []   # ids of messages delivered to this user, in id order
+        self.lock = wrap_lock(threading.Lock(), 'mailbox')
+
+
+class _Shard:
+    __slots__ = ('by_id', 'lock')
+
+    def __init__(self, wrap_lock=_plain_lock):
+        self.by_id = {}
+        # Re-entrant so callers can hold it around add()/get() plus their
+        # own bookkeeping (e.g. logging) and keep it all atomic.
+        self.lock = wrap_lock(threading.RLock(), 'store_shard')
+
+
+class MessageStore:
+    """
+    Thread-safe without any server-wide lock: the id index is split into
+    `shards` independently locked dicts and every mailbox has its own lock,
+    so deliveries between unrelated users never wait on each other.
+    Record fields are mutated under lock_for(record.id).
+    `wrap_lock(lock, kind)` may wrap the shard ('store_shard') and mailbox
+    ('mailbox') locks, e.g. in a metrics.TimedLock.
+    Lock order: shard, then hot tier/changes list, then the cold store.
+    """
+
+    def __init__(self, shards=DEFAULT_SHARDS, wrap_lock=_plain_lock):
+        self._wrap_lock = wrap_lock
+        self._shards = [_Shard(wrap_lock) for _ in range(shards)]
+        self._mailboxes = {}
+        self._mailboxes_lock = threading.Lock()
+        self._rooms = {}        # room -> Mailbox, only `receive` is used
+        self._changes = []      # (changed, message id), sorted
+        self._changes_lock = threading.Lock()
+        # Tiering, see enable_cold()
+        self.budget = None
+        self.horizon = 0            # every message with an id up to this one is cold
+        self.changes_horizon = 0    # every change up to this snowflake is in the cold tier
+        self._cold = None
+        self._on_spill = None
+        self._hot = []              # heap of (id, approx size) of the records in RAM
+        self._hot_bytes = 0
+        self._hot_lock = threading.Condition(threading.Lock())
+        self._changes_limit = 0
+        self._spill_wanted = threading.Event()
+        self._paged = OrderedDict()     # message id -> record paged back in, LRU order
+        self._paged_lock = threading.Lock()
+        # Counters
+        self.spills = 0
+        self.spilled = 0
+        self.paged_in = 0
+
+    def __len__(self):
+        hot = sum(len(shard.by_id) for shard in self._shards)
+        return hot + (len(self._cold) if self._cold is not None else 0)
+
+    # Tiering
+
+    def enable_cold(self, cold, budget, on_spill=None):
+        """
+        Keep the messages in RAM under roughly `budget` bytes and spill the
+        rest to `cold` (a coldstore.ColdStore). `on_spill(horizon)` is
+        called after every spill, e.g. to drop search postings of messages
+        that went cold.
+        """
+        self._cold = cold
+        self.budget = budget
+        self._changes_limit = max(int(budget * CHANGES_SHARE) // CHANGE_BYTES, 100)
+        self._on_spill = on_spill
+        threading.Thread(target=self._spill_loop, daemon=True).start()
+
+    @property
+    def hot_bytes(self):
+        return self._hot_bytes
+
+    def _admit(self, record):
+        # Caller holds the record's shard lock. False: the record belongs
+        # in the cold tier already (relayed late by another worker).
+        key = message_order(record.id)
+        size = approx_size(record)
+        with self._hot_lock:
+            if key <= self.horizon:
+                return False
+            heapq.heappush(self._hot, (key, size))
+            self._hot_bytes += size
+            if self._hot_bytes > self.budget:
+                self._spill_wanted.set()
+        return True
+
+    def throttle(self):
+        """
+        Wait while the hot tier is far over budget, for bulk loads that add
+        faster than the spill thread writes. Must not be called holding a
+        store lock.
+        """
+        if self._cold is None:
+            return
+        with self._hot_lock:
+            while self._hot_bytes > self.budget * THROTTLE_FACTOR:
+                self._spill_wanted.set()
+                self._hot_lock.wait(0.1)
+
+    def _spill_loop(self):
+        while True:
+            self._spill_wanted.wait()
+            self._spill_wanted.clear()
+            try:
+                # Down to SPILL_TARGET once, not after every new message:
+                # under steady load that would never stop spilling tiny
+                # batches.
+                spilled = count = self.spill()
+                while count == SPILL_BATCH:
+                    count = self.spill()
+                    spilled += count
+                self._spill_changes()
+            except (sqlite3.Error, OSError) as e:
+                log.error('spill_failed', error=e)
+                continue
+            if spilled and self._on_spill is not None:
+                self._on_spill(self.horizon)
+
+    def spill(self):
+        """
+        Move up to SPILL_BATCH of the oldest hot messages to the cold tier,
+        as long as the hot tier is over SPILL_TARGET of the budget. Returns
+        how many went.
+        """
+        with self._hot_lock:
+            keys = []
+            target = self.budget * SPILL_TARGET
+            while self._hot and self._hot_bytes > target and len(keys) < SPILL_BATCH:
+                key, size = heapq.heappop(self._hot)
+                self._hot_bytes -= size
+                keys.append(key)
+            if not keys:
+                return 0
+            # From now on reads at or below the horizon also look in the
+            # cold tier, and late arrivals go straight there.
+            self.horizon = max(self.horizon, keys[-1])
+            self._hot_lock.notify_all()
+        spilled = []
+        for key in keys:
+            shard = self._shard(str(key))
+            with shard.lock:
+                record = shard.by_id.get(str(key))
+                if record is not None:
+                    spilled.append((record, encode_record(record)))
+        self._cold.add([self._cold_row(record, data) for record, data in spilled])
+        for record, data in spilled:
+            shard = self._shard(record.id)
+            with shard.lock:
+                current = encode_record(record)
+                if current != data:
+                    # Changed while it was being written out.
+                    self._cold.update(message_order(record.id), current)
+                del shard.by_id[record.id]
+        self._trim_folders([record for record, _ in spilled])
+        self.spills += 1
+        self.spilled += len(spilled)
+        return len(keys)
+
+    def _cold_row(self, record, data):
+        entries = [(record.sender, SEND)] + [(user_id, RECEIVE) for user_id in record.receiver]
+        if record.timeline is not None:
+            entries.append((record.timeline, ROOM))
+        return (message_order(record.id), data, entries, record.content, ' '.join(record.audience()),
+                record.timeline)
+
+    def _trim_folders(self, records):
+        # Drop the ids that went cold from the front of the mailboxes and
+        # timelines that held them.
+        boxes = {}
+        for record in records:
+            mailbox = self._mailboxes.get(record.sender)
+            if mailbox is not None:
+                boxes[id(mailbox), 'send'] = mailbox, 'send'
+            for user_id in record.receiver:
+                mailbox = self._mailboxes.get(user_id)
+                if mailbox is not None:
+                    boxes[id(mailbox), 'receive'] = mailbox, 'receive'
+            if record.timeline is not None and record.timeline in self._rooms:
+                timeline = self._rooms[record.timeline]
+                boxes[id(timeline), 'receive'] = timeline, 'receive'
+        horizon = self.horizon
+        for box, folder in boxes.values():
+            with box.lock:
+                ids = getattr(box, folder)
+                del ids[:bisect.bisect_right(ids, horizon, key=message_order)]
+
+    def _spill_changes(self):
+        with self._changes_lock:
+            if len(self._changes) <= self._changes_limit:
+                return
+            count = len(self._changes) - int(self._changes_limit * SPILL_TARGET)
+            batch = self._changes[:count]
+            self._cold.add_changes([(changed, message_order(message_id)) for changed, message_id in batch])
+            del self._changes[:count]
+            self.changes_horizon = max(self.changes_horizon, batch[-1][0])
+
+    def save(self, record):
+        """
+        Write a changed record back if it lives in the cold tier. Caller
+        holds lock_for(record.id).
+        """
+        if self._cold is not None and record.id not in self._shard(record.id).by_id:
+            self._cold.update(message_order(record.id), encode_record(record))
+
+    def _page_in(self, shard, message_id):
+        try:
+            key = message_order(message_id)
+        except (TypeError, ValueError):
+            return None
+        if key > self.horizon:
+            return None
+        with shard.lock:
+            # One object per paged in message, so changes made under the
+            # lock are seen by everybody holding it.
+            record = shard.by_id.get(message_id)
+            if record is not None:
+                return record
+            with self._paged_lock:
+                record = self._paged.get(message_id)
+                if record is not None:
+                    self._paged.move_to_end(message_id)
+                    return record
+            data = self._cold.get(key)
+            if data is None:
+                return None
+            record = decode_record(data)
+            with self._paged_lock:
+                self._paged[message_id] = record
+                if len(self._paged) > PAGED_LIMIT:
+                    self._paged.popitem(last=False)
+            self.paged_in += 1
+            return record
+
+    def _peek_many(self, keys):
+        # Records for cold ids without filling the paged cache (for scans).
+        records = {}
+        missing = []
+        for key in keys:
+            message_id = str(key)
+            record = self._shard(message_id).by_id.get(message_id) or self._paged.get(message_id)
+            if record is not None:
+                records[key] = record
+            else:
+                missing.append(key)
+        for start in range(0, len(missing), COLD_FETCH):
+            for key, data in self._cold.get_many(missing[start:start + COLD_FETCH]).items():
+                records[key] = decode_record(data)
+        return records
+
+    def search_cold(self, query, user_id, since=None, until=None, pattern=None, cursor=None,
+                    limit=DEFAULT_LIMIT, budget=SCAN_BUDGET, rooms=()):
+        """
+        SearchIndex.search() for the messages below the horizon, which the
+        index no longer holds. Same arguments and result.
+        """
+        words = tokenize(query)
+        low = id_floor(since) if since is not None else 0
+        high = self.horizon + 1
+        if until is not None:
+            high = min(high, id_floor(until))
+        if cursor is not None:
+            high = min(high, int(cursor))
+        if self._cold is None or not words or high <= low:
+            return [], None
+        keys = self._cold.search(match_query(words, user_id, rooms), low, high, budget)
+        records = self._peek_many(keys)
+        results = []
+        for i, key in enumerate(keys):
+            if len(results) == limit:
+                return results, str(keys[i - 1])
+            record = records.get(key)
+            if record is None or not record.visible_to(user_id, rooms) or not words <= tokenize(record.content):
+                continue
+            if pattern is not None and not pattern.search(record.content):
+                continue
+            results.append(record)
+        return results, (str(keys[-1]) if len(keys) == budget else None)
+
+    def stats(self):
+        return {
+            'hot_bytes': self._hot_bytes,
+            'hot_messages': len(self._hot),
+            'cold_messages': len(self._cold) if self._cold is not None else 0,
+            'cold_bytes': self._cold.size() if self._cold is not None else 0,
+            'horizon': self.horizon,
+            'spills': self.spills,
+            'spilled': self.spilled,
+            'paged_in': self.paged_in,
+            'changes': len(self._changes),
+        }
+
+    def __contains__(self, message_id):
+        return message_id in self._shard(message_id).by_id
+
+    def _shard(self, message_id):
+        return self._shards[hash(message_id) % len(self._shards)]
+
+    def lock_for(self, message_id):
+        """The lock guarding this message's record."""
+        return self._shard(message_id).lock
+
+    def open_mailbox(self, user_id):
+        mailbox = self._mailboxes.get(user_id)
+        if mailbox is None:
+            with self._mailboxes_lock:
+                mailbox = self._mailboxes.setdefault(user_id, Mailbox(self._wrap_lock))
+        return mailbox
+
+    def has_mailbox(self, user_id):
+        return user_id in self._mailboxes
+
+    def mailbox(self, user_id):
+        return self._mailboxes[user_id]
+
+    def _timeline(self, room):
+        timeline = self._rooms.get(room)
+        if timeline is None:
+            with self._mailboxes_lock:
+                timeline = self._rooms.setdefault(room, Mailbox(self._wrap_lock))
+        return timeline
+
+    def add(self, record):
+        """
+        Index a new message and append it to the sender's mailbox, plus the
+        recipients' mailboxes or, for a room or public message, its timeline.
+        """
+        shard = self._shard(record.id)
+        with shard.lock:
+            if self._cold is not None and not self._admit(record):
+                self._cold.add([self._cold_row(record, encode_record(record))])
+                if record.changed is not None:
+                    self.changed(record)
+                return record
+            shard.by_id[record.id] = record
+        self._file(self.open_mailbox(record.sender), 'send', record.id)
+        if record.timeline is not None:
+            self._file(self._timeline(record.timeline), 'receive', record.id)
+        for user_id in record.receiver:
+            self._file(self.open_mailbox(user_id), 'receive', record.id)
+        if record.changed is not None:
+            self.changed(record)
+        return record
+
+    def _file(self, mailbox, folder, message_id):
+        with mailbox.lock:
+            ids = getattr(mailbox, folder)
+            if not ids or message_order(ids[-1]) < message_order(message_id):
+                ids.append(message_id)
+            else:
+                # Relayed from another worker slightly out of order.
+                bisect.insort(ids, message_id, key=message_order)
+
+    def changed(self, record):
+        """Note that `record` was modified at record.changed (a snowflake)."""
+        with self._changes_lock:
+            bisect.insort(self._changes, (record.changed, record.id))
+            if self._cold is not None and len(self._changes) > self._changes_limit:
+                self._spill_wanted.set()
+
+    def changed_since(self, user_id, since, rooms=()):
+        """Messages `user_id` (a member of `rooms`) holds that were modified after snowflake `since`."""
+        with self._changes_lock:
+            start = bisect.bisect_right(self._changes, int(since), key=lambda change: change[0])
+            ids = [message_id for _, message_id in self._changes[start:]]
+            if self._cold is not None and int(since) < self.changes_horizon:
+                ids = [str(key) for key in self._cold.changed_between(int(since), self.changes_horizon)] + ids
+            ids = dict.fromkeys(ids)
+        records = (self.get(message_id) for message_id in ids)
+        return [record for record in records if record is not None and record.visible_to(user_id, rooms)]
+
+    def history(self, user_id, before=None, after=None, limit=50, rooms=()):
+        """
+        Up to `limit` of the user's messages (sent, received and on the
+        timelines of `rooms`), newest first, with ids strictly between
+        `after` and `before` when given.
+        """
+        folders = []
+        mailbox = self._mailboxes.get(user_id)
+        if mailbox is not None:
+            folders += [(mailbox, 'send'), (mailbox, 'receive')]
+        folders += [(self._rooms[room], 'receive') for room in rooms if room in self._rooms]
+        page = set()    # own room messages are in two folders
+        for box, folder in folders:
+            with box.lock:
+                ids = getattr(box, folder)
+                high = len(ids) if before is None else bisect.bisect_left(ids, int(before), key=message_order)
+                low = 0 if after is None else bisect.bisect_right(ids, int(after), key=message_order)
+                page.update(ids[max(low, high - limit):high])
+        page = sorted(page, key=message_order, reverse=True)[:limit]
+        if self._cold is not None and (len(page) < limit or message_order(page[-1]) <= self.horizon):
+            # The rest of the page is below the horizon.
+            cold_folders = [(user_id, SEND), (user_id, RECEIVE)] + [(room, ROOM) for room in rooms]
+            cold_before = None if before is None else int(before)
+            cold_after = None if after is None else int(after)
+            for owner, folder in cold_folders:
+                page.extend(str(key) for key in self._cold.folder(owner, folder, cold_before, cold_after, limit))
+            page = sorted(set(page), key=message_order, reverse=True)[:limit]
+        records = (self.get(message_id) for message_id in page)
+        return [record for record in records if record is not None]
+
+    def get(self, message_id):
+        shard = self._shard(message_id)
+        record = shard.by_id.get(message_id)
+        if record is None and self._cold is not None:
+            return self._page_in(shard, message_id)
+        return record
+
+    def sent_by(self, user_id):
+        return self._records(user_id, 'send')
+
+    def received_by(self, user_id):
+        return self._records(user_id, 'receive')
+
+    def _records(self, user_id, folder):
+        mailbox = self._mailboxes.get(user_id)
+        if mailbox is None:
+            return []
+        with mailbox.lock:
+            ids = list(getattr(mailbox, folder))
+        return [self.get(i) for i in ids]
@@ -0,0 +1,26 @@
+# Regression tests for the --workers bus.
+#
+#   python -m pytest tests
+import os
+import queue
+import socket
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from bus import BusClient, BusHub
+
+
+def test_will_reaches_the_others_when_a_worker_disappears(tmp_path):
+    hub = BusHub(str(tmp_path / 'bus.sock'))
+    hub.bind()
+    hub.start()
+    events = queue.Queue()
+    survivor = BusClient(hub.path, on_event=events.put, will={'type': 'exit', 'worker': 0})
+    survivor.connect()
+    dying = BusClient(hub.path, on_event=lambda event: None, will={'type': 'exit', 'worker': 1})
+    dying.connect()
+    dying.publish({'type': 'leave', 'user_id': 'a', 'worker': 1})
+    assert events.get(timeout=5) == {'type': 'leave', 'user_id': 'a', 'worker': 1}
+    dying._sock.shutdown(socket.SHUT_RDWR)   # as if the process died
+    assert events.get(timeout=5) == {'type': 'exit', 'worker': 1}
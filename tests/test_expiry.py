@@ -0,0 +1,44 @@
+# Regression tests for TEMPORARY message expiry.
+#
+#   python -m pytest tests
+import math
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+import server
+from expiry import ExpiryScheduler
+
+
+@pytest.mark.parametrize('ttl', ['nan', 'NaN', 'inf', '-inf', float('nan'), float('inf')])
+def test_message_ttl_rejects_non_finite(ttl):
+    assert server.message_ttl({'ttl': ttl}) == server.TIME_TO_LIVE
+
+
+def test_message_ttl_clamps():
+    assert server.message_ttl({'ttl': 0.1}) == 1
+    assert server.message_ttl({'ttl': 10 ** 9}) == server.MAX_TIME_TO_LIVE
+    assert server.message_ttl({'ttl': 'soon'}) == server.TIME_TO_LIVE
+    assert server.message_ttl({}) == server.TIME_TO_LIVE
+
+
+@pytest.mark.parametrize('ttl', [math.nan, math.inf, -math.inf])
+def test_schedule_refuses_non_finite(ttl):
+    scheduler = ExpiryScheduler(lambda key: None)
+    with pytest.raises(ValueError):
+        scheduler.schedule('a', ttl)
+    assert len(scheduler) == 0
+
+
+def test_expiry_still_runs_after_a_non_finite_ttl():
+    expired = threading.Event()
+    scheduler = ExpiryScheduler(lambda key: expired.set())
+    threading.Thread(target=scheduler.run, daemon=True).start()
+    with pytest.raises(ValueError):
+        scheduler.schedule('bad', math.nan)
+    scheduler.schedule('good', 0.05)
+    assert expired.wait(2)
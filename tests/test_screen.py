@@ -0,0 +1,28 @@
+# Regression tests for the client's screen layout.
+#
+#   python -m pytest tests
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client'))
+
+import client
+from renderer import clip, visible_length
+
+
+def test_clip_keeps_escapes_and_resets():
+    assert clip('\033[90mabcdef\033[0m', 4) == '\033[90mabcd\033[0m'
+    assert clip('short', 10) == 'short'
+
+
+def test_long_roster_leaves_room_for_history(monkeypatch):
+    monkeypatch.setattr(client, 'ACTIVE_CLIENTS', dict.fromkeys(map(str, range(100))))
+    monkeypatch.setattr(client, 'my_user_id', 'me')
+    monkeypatch.setattr(client, 'MESSAGES', client.MessageStore())
+    client.MESSAGES.add({'action': 'MESSAGE', 'id': 1, 'sender': 'a',
+                         'content': 'hello ' * 40, 'time': 't', 'private': False})
+    lines = client.compose_screen(50, 30)
+    assert len(lines) <= 50
+    assert all(visible_length(line) <= 30 for line in lines)
+    assert '... +92 more' in lines
+    assert any('ID: 1' in line for line in lines)
@@ -0,0 +1,44 @@
+# Regression tests for SEARCH requests.
+#
+#   python -m pytest tests
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+import server
+from framing import HEADER_SIZE, decode_message
+
+
+class Outbound(list):
+    def put(self, frame):
+        self.append(decode_message(frame[HEADER_SIZE:]))
+
+
+@pytest.mark.parametrize('request_', [
+    {'content': ['hello']},
+    {'content': 'hello', 'cursor': 'abc'},
+    {'content': 'hello', 'since': 'nan'},
+    {'content': 'hello', 'until': float('inf')},
+])
+def test_invalid_search_gets_an_error(request_):
+    outbound = Outbound()
+    server.send_search_results('u1', request_, outbound)
+    assert len(outbound) == 1 and outbound[0]['error'].startswith('Invalid search')
+
+
+def test_empty_page_ends_the_request_with_a_cursor(monkeypatch):
+    calls = []
+
+    def search(*args, cursor=None, **kwargs):
+        calls.append(cursor)
+        return [], 1000 - len(calls)
+
+    monkeypatch.setattr(server.SEARCH, 'search', search)
+    outbound = Outbound()
+    server.send_search_results('u1', {'content': 'hello', 'limit': 500}, outbound)
+    assert len(calls) == 1
+    assert outbound == [{'action': 'SEARCH_RESULT', 'content': 'hello', 'results': [],
+                         'cursor': 999, 'done': True}]